@@ -14,6 +14,11 @@ Requirements:
 Usage:
     sudo python3 snsm-agent.py                    # Auto-detect interface
     sudo python3 snsm-agent.py -i eth0            # Specific interface
+    sudo python3 snsm-agent.py --engine scapy     # Scapy capture engine
+    sudo python3 snsm-agent.py --ring             # TPACKET_V3 ring buffer (Linux)
+    sudo python3 snsm-agent.py --exclude 22       # Drop SSH traffic in the kernel
+    sudo python3 snsm-agent.py --workers 4        # 4 capture processes (Linux)
+    python3 snsm-agent.py --read capture.pcapng --output flows.ndjson
     sudo python3 snsm-agent.py --simple           # Simple mode (no root needed)
     
 Author: SNSM Security Platform
@@ -21,21 +26,43 @@ Version: 1.0.0
 """
 
 import argparse
+import asyncio
+import bisect
+import copy
+import functools
+import heapq
+import http.client
+import ipaddress
 import json
 import logging
+import math
+import mmap
+import multiprocessing
 import os
 import platform
+import queue
+import random
+import re
+import select
 import signal
 import socket
+import ssl
+import struct
+import subprocess
 import sys
 import threading
 import time
-from collections import defaultdict
-from dataclasses import dataclass, field
+import tracemalloc
+import zlib
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-from urllib.request import Request, urlopen
-from urllib.error import URLError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Optional, Any
+from urllib.parse import urlsplit
+from urllib.request import Request, getproxies, proxy_bypass, urlopen
 
 # ============================================================================
 # CONFIGURATION
@@ -46,13 +73,92 @@ API_KEY = "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.eyJpc3MiOiJzdXBhYmFzZSIsInJlZiI6
 
 FLOW_UPLOAD_INTERVAL = 5  # seconds
 HEARTBEAT_INTERVAL = 30   # seconds
+ALERT_INTERVAL = 1        # seconds between alert dispatches
+SIMPLE_POLL_INTERVAL = 1  # seconds between connection table polls (--simple)
 MAX_FLOWS_PER_BATCH = 100
 
+# Agent identity: the agent_id from agent-register is kept here and reused on restart
+AGENT_VERSION = "1.0.0-python"
+IDENTITY_FILE = os.path.join(os.path.expanduser("~"), ".snsm", "identity.json")
+REGISTER_RETRY_MIN = 5       # seconds before the first registration retry...
+REGISTER_RETRY_MAX = 300     # ...doubling up to this while the backend is unreachable
+
+# Flow uploads. columnar/ndjson and gzip need the updated agent-flows function;
+# json without compression is what every deployed backend accepts
+UPLOAD_FORMAT = "json"       # json | columnar | ndjson
+UPLOAD_COMPRESS = False      # gzip request bodies
+UPLOAD_GZIP_LEVEL = 1        # fast; columnar data compresses well regardless
+UPLOAD_CHUNK_ROWS = 1000     # flows per encoded chunk
+UPLOAD_MIN_BATCH_ROWS = 100  # adaptive batch size: floor and growth step...
+UPLOAD_MAX_BATCH_ROWS = 5000 # ...and ceiling
+UPLOAD_BATCH_BYTES = 512 * 1024  # uncompressed body size per batch
+UPLOAD_TARGET_LATENCY = 2.0  # seconds; slower batches shrink the batch size
+UPLOAD_CONCURRENCY = 2       # flow batches in flight
+UPLOAD_QUEUE_FLOWS = 100_000 # flows waiting to be sent before the overflow policy applies
+UPLOAD_OVERFLOW = "aggregate"  # aggregate | drop
+UPLOAD_RETRIES = 2           # resends of a failed batch
+UPLOAD_RETRY_DELAY = 5       # seconds
+
+# Outage spool: batches the backend did not accept are kept on disk and replayed
+SPOOL_DIR = os.path.join(os.path.expanduser("~"), ".snsm", "spool")
+SPOOL_MAX_MB = 256           # oldest segments are deleted beyond this
+SPOOL_SEGMENT_BYTES = 4 << 20
+SPOOL_FSYNC = "interval"     # always | interval | never
+SPOOL_FSYNC_INTERVAL = 1.0   # seconds between fsyncs with the interval policy
+SPOOL_DRAIN_RATE = 2         # batches per second replayed once the backend is back
+SPOOL_RETRY_INTERVAL = 15    # seconds between replay attempts while it is down
+
+# Backend connections
+HTTP_POOL_SIZE = 4           # keep-alive connections, and the cap on requests in flight
+HTTP_TIMEOUT = 30            # seconds per request
+HTTP_IDLE_TIMEOUT = 50       # seconds before an idle connection is not reused
+HTTP_BACKOFF_BASE = 1.0      # seconds; reconnect delay doubles per failure...
+HTTP_BACKOFF_MAX = 60.0      # ...up to this, with full jitter
+HTTP_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Flow table (NetFlow-style expiry)
+FLOW_ACTIVE_TIMEOUT = 60     # seconds before a long-running flow is checkpointed
+FLOW_IDLE_TIMEOUT = 15       # seconds without packets before a flow is closed
+FLOW_TABLE_MAX = 100_000     # flows held before the oldest are closed early
+
+# Flow aggregation before upload (--aggregate)
+AGGREGATE_INTERVAL = 60      # seconds of low-value flows rolled into one summary row
+AGGREGATE_MIN_SCORE = 10     # flows with this threat score or more keep full detail...
+AGGREGATE_MIN_BYTES = 100_000  # ...as do flows with this many bytes or more
+AGGREGATE_MAX_SUMMARIES = 50_000  # summaries held before the interval is cut short
+AGGREGATE_TOP_K = 10         # talkers and services reported per interval
+AGGREGATE_TOP_COUNTERS = 1000  # Space-Saving counters behind each top-K list
+
+# Networks counted as local when a flow's ports do not show the server side
+# (--local-net replaces these); the host's own interface addresses are always local
+LOCAL_NETWORKS = ["10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "fc00::/7", "fe80::/10"]
+IP_TEXT_CACHE = 65536        # text forms of recently serialised addresses kept
+
 # Threat detection thresholds
 PORTSCAN_THRESHOLD = 20      # ports in window
 PORTSCAN_WINDOW = 10         # seconds
 DDOS_THRESHOLD = 100         # packets in window
 DDOS_WINDOW = 5              # seconds
+WINDOW_BUCKETS = 50          # time buckets per packet-rate window
+
+# Detector state limits
+DETECTOR_MAX_SOURCES = 50_000     # tracked source addresses
+DETECTOR_MEMORY_MB = 64           # estimated detector state budget
+DETECTOR_STATE_TTL = 60           # seconds before an idle source is dropped
+DETECTOR_MAX_PORTS = 256          # distinct ports remembered per source
+RATE_LIMIT_TTL = 300              # longest alert cooldown
+
+# Sketch detector (--detector sketch)
+SKETCH_ROWS = 2                   # independent rows per spread sketch
+SKETCH_WIDTH = 16384              # cells per row
+HLL_REGISTERS = 32                # HyperLogLog registers per cell
+CM_ROWS = 4                       # Count-Min rows
+CM_WIDTH = 16384                  # Count-Min counters per row
+HEAVY_HITTERS = 32                # top sources by packet rate kept per window
+HOSTSCAN_THRESHOLD = 50           # hosts on one port in PORTSCAN_WINDOW
+DISTRIBUTED_SCAN_PORTS = 100      # service ports of one host in PORTSCAN_WINDOW
+DISTRIBUTED_SCAN_SOURCES = 10     # ... probed by at least this many sources
+EPHEMERAL_PORT_MIN = 32768        # client ports, ignored for distributed scans
 
 # Service port mapping
 SERVICE_PORTS = {
@@ -64,6 +170,67 @@ SERVICE_PORTS = {
 
 SUSPICIOUS_PORTS = {22, 23, 3389, 445, 135, 139, 1433, 3306, 5432}
 MALICIOUS_PORTS = {4444, 5555, 6666, 31337, 12345, 6667}
+# Ports taken as the server side of a flow, along with every port below 1024
+SERVER_PORTS = frozenset(SERVICE_PORTS) | SUSPICIOUS_PORTS | MALICIOUS_PORTS
+
+# Flow threat score: the weights of the rules a flow matches, capped at 100
+SCORE_WEIGHTS = {
+    "large_upload": 10,       # bytes_sent over SCORE_UPLOAD_BYTES
+    "large_download": 15,     # bytes_recv over SCORE_DOWNLOAD_BYTES
+    "packet_burst": 20,       # over SCORE_BURST_PACKETS in under SCORE_BURST_SECONDS
+    "suspicious_port": 10,    # dst_port in SUSPICIOUS_PORTS
+    "malicious_port": 40,     # dst_port in MALICIOUS_PORTS
+}
+SCORE_UPLOAD_BYTES = 1_000_000
+SCORE_DOWNLOAD_BYTES = 10_000_000
+SCORE_BURST_PACKETS = 100
+SCORE_BURST_SECONDS = 5
+
+# Signature rules (--rules)
+RULES_RELOAD_INTERVAL = 5         # seconds between checks of the rules file for changes
+SIGNATURE_INSPECT_BYTES = 2048    # payload bytes searched for content patterns
+SIGNATURE_COOLDOWN = 60           # seconds between alerts for one rule and source
+SIGNATURE_VARS = {                # defaults for $NAME in rules; "var" lines override
+    "HOME_NET": "[10.0.0.0/8,172.16.0.0/12,192.168.0.0/16,fc00::/7]",
+    "EXTERNAL_NET": "!$HOME_NET",
+    "HTTP_PORTS": "[80,8000,8080,8888]",
+}
+
+# Blocklist (backend agent-blocklist)
+BLOCKLIST_REFRESH_INTERVAL = 60   # seconds between conditional fetches
+BLOCKLIST_COOLDOWN = 60           # seconds between alerts for one blocklisted address
+BLOCKLIST_CACHE = 65536           # remembered network-lookup verdicts per address
+NFT_TABLE = "snsm"                # inet table owned by --nft-sync
+
+# Raw capture engine
+CAPTURE_SNAPLEN = 65535      # bytes copied per frame
+CAPTURE_RCVBUF = 8 << 20     # socket receive buffer (bytes)
+
+# TPACKET_V3 ring buffer (--ring)
+RING_BLOCK_SIZE = 1 << 20    # bytes per block (multiple of the page size)
+RING_BLOCKS = 64             # blocks in the ring
+RING_RETIRE_TIMEOUT = 100    # ms before a partially filled block is handed over
+
+# Multi-process capture (--workers)
+CAPTURE_TICK = 1.0           # seconds between capture-loop housekeeping
+
+# Overload sampling: past these limits whole flows are sampled 1 in N (N a power of two)
+OVERLOAD_DROP_RATIO = 0.001  # kernel drops per captured packet in one tick
+OVERLOAD_LAG = 0.5           # seconds the oldest unread ring block may wait (--ring)
+OVERLOAD_MAX_SAMPLING = 64   # N never grows beyond this
+OVERLOAD_RECOVER_TICKS = 10  # ticks without overload before N is halved
+
+# Metrics endpoint (--metrics)
+METRICS_HOST = "127.0.0.1"   # bind address when --metrics gives only a port
+METRICS_SAMPLE = 64          # capture stages are timed on one packet in this many
+METRICS_BUCKETS_US = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                      10000, 50000, 250000, 1000000)
+
+# Profiling (--profile, SIGUSR1 starts / SIGUSR2 stops)
+PROFILE_DIR = os.path.join(os.path.expanduser("~"), ".snsm", "profiles")
+PROFILE_INTERVAL = 0.01      # seconds between stack samples of every thread
+PROFILE_TRACE_FRAMES = 1     # tracemalloc frames kept per allocation (--profile-memory)
+PROFILE_TOP_ALLOCATIONS = 30 # allocation sites listed in the .alloc.txt report
 
 # ============================================================================
 # LOGGING SETUP
@@ -95,30 +262,404 @@ def setup_logging(verbose: bool = False):
     logging.basicConfig(level=level, handlers=[handler])
     return logging.getLogger('snsm')
 
+# ============================================================================
+# METRICS (--metrics)
+# ============================================================================
+
+# parse .. signatures are timed on sampled packets; the rest on every call
+METRICS_STAGES = ("parse", "flow_update", "analyze", "signatures", "lock_wait",
+                  "export", "encode", "upload")
+_METRICS_BOUNDS_NS = tuple(us * 1000 for us in METRICS_BUCKETS_US)
+
+
+class StageTimings:
+    """Latency histograms per pipeline stage in fixed microsecond buckets.
+    
+    Recording is one bisect and two additions with no lock; a rare lost
+    update between upload threads is accepted to keep the hot path cheap.
+    """
+    
+    def __init__(self):
+        self.counts = {stage: [0] * (len(METRICS_BUCKETS_US) + 1) for stage in METRICS_STAGES}
+        self.sum_ns = dict.fromkeys(METRICS_STAGES, 0)
+    
+    def observe(self, stage: str, ns: int):
+        self.counts[stage][bisect.bisect_left(_METRICS_BOUNDS_NS, ns)] += 1
+        self.sum_ns[stage] += ns
+    
+    def timed_chunks(self, stage: str, chunks) -> Iterator:
+        """Pass ``chunks`` through, recording the time spent producing them."""
+        clock = time.perf_counter_ns
+        spent = 0
+        chunks = iter(chunks)
+        while True:
+            start = clock()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                break
+            finally:
+                spent += clock() - start
+            yield chunk
+        self.observe(stage, spent)
+    
+    def merge(self, other: "StageTimings"):
+        for stage, counts in other.counts.items():
+            mine = self.counts[stage]
+            for i, count in enumerate(counts):
+                mine[i] += count
+            self.sum_ns[stage] += other.sum_ns[stage]
+    
+    def percentile(self, stage: str, pct: float) -> float:
+        """Upper bound (µs) of the bucket holding the given percentile."""
+        counts = self.counts[stage]
+        target, seen = sum(counts) * pct / 100, 0
+        if not target:
+            return 0.0
+        for bound, count in zip(METRICS_BUCKETS_US + (float("inf"),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+def render_prometheus(timings: StageTimings, gauges: Dict[str, Any]) -> str:
+    """Prometheus text exposition of the stage histograms and gauges."""
+    lines = [
+        f"# HELP snsm_stage_seconds Time per pipeline stage (capture stages: 1 in "
+        f"{METRICS_SAMPLE} packets sampled)",
+        "# TYPE snsm_stage_seconds histogram",
+    ]
+    for stage in METRICS_STAGES:
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS_US + (None,), timings.counts[stage]):
+            cumulative += count
+            le = "+Inf" if bound is None else repr(bound / 1e6)
+            lines.append(f'snsm_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'snsm_stage_seconds_sum{{stage="{stage}"}} {timings.sum_ns[stage] / 1e9}')
+        lines.append(f'snsm_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+    for name, value in sorted(gauges.items()):
+        if isinstance(value, (int, float)):
+            lines.append(f"# TYPE snsm_{name} gauge")
+            lines.append(f"snsm_{name} {float(value)!r}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_json(timings: StageTimings, gauges: Dict[str, Any]) -> dict:
+    """The same metrics as a JSON document, with percentiles precomputed."""
+    stages = {}
+    for stage in METRICS_STAGES:
+        counts = timings.counts[stage]
+        total = sum(counts)
+        stages[stage] = {
+            "count": total,
+            "avg_us": round(timings.sum_ns[stage] / total / 1000, 2) if total else 0.0,
+            "p50_us": timings.percentile(stage, 50),
+            "p99_us": timings.percentile(stage, 99),
+            "buckets_us": {str(bound): count for bound, count in
+                           zip(METRICS_BUCKETS_US + ("inf",), counts)},
+        }
+    return {"sample_every": METRICS_SAMPLE, "stages": stages, "gauges": gauges}
+
+
+class MetricsServer:
+    """Serves ``/metrics`` (Prometheus text) and ``/metrics.json`` on a local port.
+    
+    ``collect`` returns ``(StageTimings, gauges)`` and runs on the server
+    thread for every scrape, so nothing is computed between scrapes.
+    """
+    
+    def __init__(self, host: str, port: int, collect: Callable[[], tuple],
+                 logger: logging.Logger):
+        self.host = host
+        self.port = port
+        self.collect = collect
+        self.logger = logger
+        self._server: Optional[ThreadingHTTPServer] = None
+    
+    def start(self):
+        collect, logger = self.collect, self.logger
+        
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.partition("?")[0]
+                if path not in ("/metrics", "/metrics.json"):
+                    self.send_error(404)
+                    return
+                try:
+                    timings, gauges = collect()
+                    if path == "/metrics":
+                        body = render_prometheus(timings, gauges).encode()
+                        content_type = "text/plain; version=0.0.4"
+                    else:
+                        body = json.dumps(metrics_json(timings, gauges)).encode()
+                        content_type = "application/json"
+                except Exception as e:
+                    logger.debug(f"Metrics collection failed: {e}")
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, *args):
+                pass
+        
+        server_class = ThreadingHTTPServer
+        if ":" in self.host:
+            server_class = type("ThreadingHTTPServer6", (ThreadingHTTPServer,),
+                                {"address_family": socket.AF_INET6})
+        self._server = server_class((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, name="snsm-metrics",
+                         daemon=True).start()
+        host = f"[{self.host}]" if ":" in self.host else self.host
+        self.logger.info(f"✓ Metrics on http://{host}:{self.port}/metrics")
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+# ============================================================================
+# PROFILING (--profile, SIGUSR1 / SIGUSR2)
+# ============================================================================
+
+class Profiler:
+    """Wall-clock stack sampler, optionally with tracemalloc, switched at run time.
+    
+    While running, a thread reads every other thread's stack each
+    PROFILE_INTERVAL and counts the collapsed stacks. On stop it writes
+    ``snsm-<pid>-<time>.folded`` (input for flamegraph.pl or speedscope) to
+    ``directory``. With ``memory``, tracemalloc records new allocations too
+    and ``.alloc.txt`` lists the largest allocation sites; tracing slows the
+    packet path several times over, so it is opt-in. When off there is no
+    thread and no tracing.
+    """
+    
+    def __init__(self, directory: str, logger: logging.Logger, memory: bool = False):
+        self.directory = directory
+        self.logger = logger
+        self.memory = memory
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+    
+    def start(self):
+        """Start sampling; a no-op while running or still writing the last profile."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop_event = threading.Event()
+        if self.memory:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        self._thread = threading.Thread(target=self._sample, args=(self._stop_event,),
+                                        name="snsm-profiler", daemon=True)
+        self._thread.start()
+        self.logger.info(f"Profiling started (pid {os.getpid()})")
+    
+    def stop(self, wait: bool = False):
+        """Stop sampling; the profile is written on the sampler thread."""
+        thread = self._thread
+        if thread is None:
+            return
+        self._stop_event.set()
+        if wait:
+            thread.join()
+    
+    def _sample(self, stop_event: threading.Event):
+        started = time.time()
+        me = threading.get_ident()
+        names: Dict[int, str] = {}
+        labels: Dict[Any, str] = {}              # code object -> frame label
+        stacks: Dict[str, int] = {}
+        samples = 0
+        while not stop_event.wait(PROFILE_INTERVAL):
+            samples += 1
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = (f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                                                f":{code.co_firstlineno})")
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                key = ";".join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+        self._write(stacks, samples, started)
+    
+    def _write(self, stacks: Dict[str, int], samples: int, started: float):
+        snapshot = None
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            traced, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            snapshot = snapshot.filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ))
+        base = os.path.join(self.directory, f"snsm-{os.getpid()}-"
+                            f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(started))}")
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            with open(base + ".folded", "w", encoding="utf-8") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in stacks.items())
+            if snapshot is not None:
+                with open(base + ".alloc.txt", "w", encoding="utf-8") as f:
+                    f.write(f"# {time.time() - started:.1f}s profiled, {traced / 1024:.1f} KiB "
+                            f"allocated since start still live (peak {peak / 1024:.1f} KiB)\n")
+                    for stat in snapshot.statistics("traceback")[:PROFILE_TOP_ALLOCATIONS]:
+                        f.write(f"\n{stat.size / 1024:.1f} KiB in {stat.count} blocks\n")
+                        f.writelines(f"  {line}\n" for line in stat.traceback.format())
+        except OSError as e:
+            self.logger.error(f"Cannot write profile to {self.directory}: {e}")
+            return
+        self.logger.info(f"Profile written: {base}.folded ({samples} samples)"
+                         f"{f', {base}.alloc.txt' if snapshot is not None else ''}")
+
 # ============================================================================
 # DATA CLASSES
 # ============================================================================
 
-@dataclass
+def iso_timestamp(timestamp: Optional[float] = None) -> str:
+    """UTC ISO-8601 time for the backend (now if ``timestamp`` is None)."""
+    when = datetime.utcnow() if timestamp is None else datetime.utcfromtimestamp(timestamp)
+    return when.isoformat() + "Z"
+
+
+def pack_ip(text: str) -> bytes:
+    """Packed network-order form (4 or 16 bytes) of a textual address."""
+    if ":" in text:
+        return socket.inet_pton(socket.AF_INET6, text.partition("%")[0])   # drop any %scope
+    return socket.inet_pton(socket.AF_INET, text)
+
+
+@functools.lru_cache(maxsize=IP_TEXT_CACHE)
+def format_ip(packed: bytes) -> str:
+    """Textual form of a packed address, for serialisation and logs."""
+    return socket.inet_ntop(socket.AF_INET if len(packed) == 4 else socket.AF_INET6, packed)
+
+
+class PrefixTable:
+    """Longest-prefix match from packed addresses to values.
+    
+    Host addresses (/32, /128) are one dict probe on the packed bytes. Other
+    networks are bucketed by prefix length per address size and probed
+    longest prefix first, one probe per distinct length.
+    """
+    
+    def __init__(self, items=()):
+        self.hosts: Dict[bytes, Any] = {}
+        buckets: Dict[int, Dict[int, dict]] = {4: {}, 16: {}}
+        for network, value in items:
+            packed = network.network_address.packed
+            if network.prefixlen == network.max_prefixlen:
+                self.hosts[packed] = value
+                continue
+            shift = network.max_prefixlen - network.prefixlen
+            buckets[len(packed)].setdefault(shift, {})[int(network.network_address) >> shift] = value
+        # address size -> [(shift, {network: value})], smallest shift first
+        self.networks = {size: sorted(tables.items()) for size, tables in buckets.items()}
+    
+    def __contains__(self, ip: bytes) -> bool:
+        return self.get(ip) is not None
+    
+    def get(self, ip: bytes) -> Any:
+        value = self.hosts.get(ip)
+        if value is not None:
+            return value
+        networks = self.networks.get(len(ip))
+        if networks:
+            key = int.from_bytes(ip, "big")
+            for shift, table in networks:
+                value = table.get(key >> shift)
+                if value is not None:
+                    return value
+        return None
+
+
+def drain_queue(q: "queue.SimpleQueue") -> list:
+    """Everything currently in ``q``, without blocking."""
+    items = []
+    try:
+        while True:
+            items.append(q.get_nowait())
+    except queue.Empty:
+        return items
+
+
 class Flow:
-    src_ip: str
-    dst_ip: str
-    src_port: int
-    dst_port: int
-    protocol: str
-    bytes_sent: int = 0
-    bytes_recv: int = 0
-    packets_sent: int = 0
-    packets_recv: int = 0
-    start_time: float = field(default_factory=time.time)
-    end_time: float = field(default_factory=time.time)
-    service: Optional[str] = None
-    threat_score: int = 0
-    
-    def to_dict(self) -> dict:
+    """One bidirectional flow: ``sent`` counts src -> dst, ``recv`` dst -> src.
+    
+    Addresses are packed (see ``pack_ip``) and only turned into text when
+    the flow is serialised.
+    """
+    __slots__ = ("src_ip", "dst_ip", "src_port", "dst_port", "protocol",
+                 "bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                 "start_time", "end_time", "service", "threat_score", "sampling_rate")
+    
+    def __init__(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+                 protocol: str, bytes_sent: int = 0, bytes_recv: int = 0,
+                 packets_sent: int = 0, packets_recv: int = 0,
+                 start_time: Optional[float] = None, end_time: Optional[float] = None,
+                 service: Optional[str] = None, threat_score: int = 0,
+                 sampling_rate: int = 1):
+        if start_time is None:
+            start_time = time.time()
+        self.src_ip = src_ip
+        self.dst_ip = dst_ip
+        self.src_port = src_port
+        self.dst_port = dst_port
+        self.protocol = protocol
+        self.bytes_sent = bytes_sent
+        self.bytes_recv = bytes_recv
+        self.packets_sent = packets_sent
+        self.packets_recv = packets_recv
+        self.start_time = start_time
+        self.end_time = start_time if end_time is None else end_time
+        self.service = service
+        self.threat_score = threat_score
+        self.sampling_rate = sampling_rate   # 1-in-N the counts are scaled by
+    
+    def absorb(self, other: "Flow"):
+        """Add a flow between the same hosts into this one; ports that differ become 0."""
+        if self.src_port != other.src_port:
+            self.src_port = 0
+        if self.dst_port != other.dst_port:
+            self.dst_port = 0
+        self.bytes_sent += other.bytes_sent
+        self.bytes_recv += other.bytes_recv
+        self.packets_sent += other.packets_sent
+        self.packets_recv += other.packets_recv
+        self.start_time = min(self.start_time, other.start_time)
+        self.end_time = max(self.end_time, other.end_time)
+        self.threat_score = max(self.threat_score, other.threat_score)
+        self.sampling_rate = max(self.sampling_rate, other.sampling_rate)
+    
+    def checkpoint(self, now: float) -> "Flow":
+        """Return the counts so far as a record and restart counting at ``now``."""
+        record = Flow(self.src_ip, self.dst_ip, self.src_port, self.dst_port,
+                      self.protocol, self.bytes_sent, self.bytes_recv,
+                      self.packets_sent, self.packets_recv,
+                      self.start_time, self.end_time, self.service,
+                      sampling_rate=self.sampling_rate)
+        self.bytes_sent = self.bytes_recv = self.packets_sent = self.packets_recv = 0
+        self.start_time = now
+        return record
+    
+    def to_dict(self, timestamp: Optional[float] = None) -> dict:
         return {
-            "src_ip": self.src_ip,
-            "dst_ip": self.dst_ip,
+            "src_ip": format_ip(self.src_ip),
+            "dst_ip": format_ip(self.dst_ip),
             "src_port": self.src_port,
             "dst_port": self.dst_port,
             "protocol": self.protocol,
@@ -129,76 +670,762 @@ class Flow:
             "duration": round(self.end_time - self.start_time, 3),
             "service": self.service or SERVICE_PORTS.get(self.dst_port),
             "threat_score": self.threat_score,
-            "timestamp": datetime.utcnow().isoformat() + "Z"
+            "sampling_rate": self.sampling_rate,
+            "timestamp": iso_timestamp(timestamp)
         }
 
+def flow_key(src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int, proto: str) -> tuple:
+    """Canonical key shared by both directions of a connection."""
+    if src_ip < dst_ip or (src_ip == dst_ip and src_port <= dst_port):
+        return (proto, src_ip, src_port, dst_ip, dst_port)
+    return (proto, dst_ip, dst_port, src_ip, src_port)
+
+
+class FlowTable:
+    """Bidirectional flow cache with NetFlow-style active and idle timeouts.
+    
+    Both directions of a connection share one record, oriented from client
+    to server so that ``dst_port`` is the service port and ``sent`` is the
+    client's traffic (see ``server_first``). ``export()`` closes flows idle
+    for ``idle_timeout`` and checkpoints flows running longer than
+    ``active_timeout``; other flows stay in the table. When the table is
+    full, the least recently active flow is closed. Not thread-safe:
+    captures call it under their own lock.
+    """
+    
+    def __init__(self, is_local: Callable[[bytes], bool],
+                 active_timeout: float = FLOW_ACTIVE_TIMEOUT,
+                 idle_timeout: float = FLOW_IDLE_TIMEOUT,
+                 max_flows: int = FLOW_TABLE_MAX):
+        self.is_local = is_local
+        self.active_timeout = active_timeout
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.flows: "OrderedDict[tuple, Flow]" = OrderedDict()  # least recently active first
+        self.closed: List[Flow] = []     # closed early, awaiting export
+        self.evicted = 0                 # flows closed early because the table was full
+    
+    def __len__(self) -> int:
+        return len(self.flows)
+    
+    def server_first(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int) -> bool:
+        """Whether a connection's first packet goes from the server to the client.
+        
+        The server side is the port below 1024 or listed in SERVER_PORTS,
+        or else the lower port. With equal ports (ICMP) the local endpoint
+        is taken as the client.
+        """
+        if src_port != dst_port:
+            src_server = src_port < 1024 or src_port in SERVER_PORTS
+            if src_server != (dst_port < 1024 or dst_port in SERVER_PORTS):
+                return src_server
+            return src_port < dst_port
+        return self.is_local(dst_ip) and not self.is_local(src_ip)
+    
+    def _evict(self):
+        self.closed.append(self.flows.popitem(last=False)[1])
+        self.evicted += 1
+    
+    def update(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+               proto: str, length: int, now: float, rate: int = 1) -> bool:
+        """Count one packet; False if overload sampling leaves its flow out.
+        
+        The keep-or-skip choice is made once, when the flow is created at
+        sampling ``rate`` (a power of two): a new flow is kept if its key
+        hashes to 0 mod ``rate``. A kept flow counts every packet ``rate``
+        times, the rate it was created at, however the rate changes later.
+        The key is direction-free, so both directions share the choice.
+        """
+        key = flow_key(src_ip, dst_ip, src_port, dst_port, proto)
+        flows = self.flows
+        flow = flows.get(key)
+        if flow is None:
+            if rate != 1 and hash(key) & (rate - 1):
+                return False
+            if len(flows) >= self.max_flows:
+                self._evict()
+            if self.server_first(src_ip, dst_ip, src_port, dst_port):
+                flow = Flow(dst_ip, src_ip, dst_port, src_port, proto, start_time=now,
+                            sampling_rate=rate)
+            else:
+                flow = Flow(src_ip, dst_ip, src_port, dst_port, proto, start_time=now,
+                            sampling_rate=rate)
+            flows[key] = flow
+        else:
+            flows.move_to_end(key)
+            if now > flow.end_time:
+                flow.end_time = now
+        
+        weight = flow.sampling_rate
+        if weight != 1:
+            length *= weight
+        if src_port == flow.src_port and src_ip == flow.src_ip:
+            flow.bytes_sent += length
+            flow.packets_sent += weight
+        else:
+            flow.bytes_recv += length
+            flow.packets_recv += weight
+        return True
+    
+    def add(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int, proto: str,
+            bytes_sent: int, bytes_recv: int, packets_sent: int, packets_recv: int,
+            now: float):
+        """Add counts measured elsewhere (socket counters) for src -> dst and back."""
+        key = flow_key(src_ip, dst_ip, src_port, dst_port, proto)
+        flows = self.flows
+        flow = flows.get(key)
+        if flow is None:
+            if len(flows) >= self.max_flows:
+                self._evict()
+            if self.server_first(src_ip, dst_ip, src_port, dst_port):
+                flow = Flow(dst_ip, src_ip, dst_port, src_port, proto, start_time=now)
+            else:
+                flow = Flow(src_ip, dst_ip, src_port, dst_port, proto, start_time=now)
+            flows[key] = flow
+        else:
+            flows.move_to_end(key)
+            if now > flow.end_time:
+                flow.end_time = now
+        
+        if src_port == flow.src_port and src_ip == flow.src_ip:
+            flow.bytes_sent += bytes_sent
+            flow.bytes_recv += bytes_recv
+            flow.packets_sent += packets_sent
+            flow.packets_recv += packets_recv
+        else:
+            flow.bytes_sent += bytes_recv
+            flow.bytes_recv += bytes_sent
+            flow.packets_sent += packets_recv
+            flow.packets_recv += packets_sent
+    
+    def export(self, now: float, flush: bool = False) -> List[Flow]:
+        """Close idle flows and checkpoint long-running ones; ``flush`` closes all."""
+        records, self.closed = self.closed, []
+        idle_cutoff = now - self.idle_timeout
+        active_cutoff = now - self.active_timeout
+        expired = []
+        for key, flow in self.flows.items():
+            if flush or flow.end_time <= idle_cutoff:
+                expired.append(key)
+                if flow.packets_sent or flow.packets_recv:
+                    records.append(flow)
+            elif flow.start_time <= active_cutoff and (flow.packets_sent or flow.packets_recv):
+                records.append(flow.checkpoint(now))
+        for key in expired:
+            del self.flows[key]
+        return records
+    
+    def merge(self, records: List[Flow]):
+        """Add exported records into a table of pending records (shard merge)."""
+        flows = self.flows
+        for record in records:
+            key = flow_key(record.src_ip, record.dst_ip, record.src_port,
+                           record.dst_port, record.protocol)
+            flow = flows.get(key)
+            if flow is None:
+                flows[key] = record
+                continue
+            if flow.src_ip == record.src_ip and flow.src_port == record.src_port:
+                flow.bytes_sent += record.bytes_sent
+                flow.bytes_recv += record.bytes_recv
+                flow.packets_sent += record.packets_sent
+                flow.packets_recv += record.packets_recv
+            else:
+                flow.bytes_sent += record.bytes_recv
+                flow.bytes_recv += record.bytes_sent
+                flow.packets_sent += record.packets_recv
+                flow.packets_recv += record.packets_sent
+            flow.start_time = min(flow.start_time, record.start_time)
+            flow.end_time = max(flow.end_time, record.end_time)
+            flow.sampling_rate = max(flow.sampling_rate, record.sampling_rate)
+    
+    def drain(self) -> List[Flow]:
+        """Take every record (for tables used only to merge)."""
+        records = list(self.flows.values())
+        self.flows = OrderedDict()
+        return records
+
+@dataclass
+class CaptureOptions:
+    engine: str = "raw"
+    ring: bool = False
+    ring_block_size: int = RING_BLOCK_SIZE
+    ring_blocks: int = RING_BLOCKS
+    ring_timeout: int = RING_RETIRE_TIMEOUT
+    filter: str = ""
+    exclude: List["ExcludeRule"] = field(default_factory=list)
+    local_networks: List[str] = field(default_factory=lambda: list(LOCAL_NETWORKS))
+    workers: int = 1
+    read: str = ""
+    replay_speed: float = 0.0
+    active_timeout: float = FLOW_ACTIVE_TIMEOUT
+    idle_timeout: float = FLOW_IDLE_TIMEOUT
+    metrics_sample: int = 0      # time one packet in this many (0 = off)
+    overload_sampling: bool = True  # sample flows when the kernel drops packets
+    profile: bool = False        # profile from startup (workers too)
+    profile_memory: bool = False # trace allocations while profiling
+    profile_dir: str = PROFILE_DIR
+
+@dataclass
+class UploadOptions:
+    format: str = UPLOAD_FORMAT
+    compress: bool = UPLOAD_COMPRESS
+    overflow: str = UPLOAD_OVERFLOW
+    spool_dir: str = SPOOL_DIR   # empty disables the spool
+    spool_max_mb: int = SPOOL_MAX_MB
+    spool_fsync: str = SPOOL_FSYNC
+
 @dataclass
 class Alert:
     signature_id: str
     signature_name: str
     severity: str
     category: str
-    src_ip: str
-    dst_ip: str
+    src_ip: bytes                 # packed
+    dst_ip: bytes
     src_port: int
     dst_port: int
     protocol: str
+    # (key, seconds) of a cooldown not keyed on the source; capture shards
+    # split sources, so ShardedCapture applies it again across shards
+    cooldown: Optional[tuple] = None
     
-    def to_dict(self) -> dict:
-        return {
+    def to_dict(self, timestamp: Optional[float] = None) -> dict:
+        record = {
             "signature_id": self.signature_id,
             "signature_name": self.signature_name,
             "severity": self.severity,
             "category": self.category,
-            "src_ip": self.src_ip,
-            "dst_ip": self.dst_ip,
+            "src_ip": format_ip(self.src_ip),
+            "dst_ip": format_ip(self.dst_ip),
             "src_port": self.src_port,
             "dst_port": self.dst_port,
             "protocol": self.protocol
         }
+        if timestamp is not None:
+            record["timestamp"] = iso_timestamp(timestamp)
+        return record
+
+# ============================================================================
+# FLOW AGGREGATION (--aggregate)
+# ============================================================================
+
+class SpaceSaving:
+    """Heaviest items of a weighted stream in ``capacity`` counters (Space-Saving).
+    
+    An item heavier than ``total / capacity`` is always tracked, and a
+    count overestimates the true weight by at most its ``errors`` entry.
+    A new item takes over the smallest counter, found through a heap that
+    holds one entry per item and is brought up to date lazily.
+    """
+    
+    def __init__(self, capacity: int = AGGREGATE_TOP_COUNTERS):
+        self.capacity = capacity
+        self.counts: Dict[Any, int] = {}
+        self.errors: Dict[Any, int] = {}
+        self.total = 0
+        self._heap: List[tuple] = []             # (count when last fixed, item)
+    
+    def add(self, item, weight: int):
+        self.total += weight
+        counts = self.counts
+        if item in counts:
+            counts[item] += weight
+            return
+        heap = self._heap
+        if len(counts) < self.capacity:
+            counts[item] = weight
+            self.errors[item] = 0
+            heapq.heappush(heap, (weight, item))
+            return
+        while True:
+            count, victim = heap[0]
+            current = counts[victim]
+            if current == count:
+                break
+            heapq.heapreplace(heap, (current, victim))
+        heapq.heapreplace(heap, (count + weight, item))
+        del counts[victim], self.errors[victim]
+        counts[item] = count + weight
+        self.errors[item] = count
+    
+    def top(self, k: int) -> List[tuple]:
+        """(item, count, error) of the ``k`` largest counters."""
+        errors = self.errors
+        return [(item, count, errors[item]) for item, count in
+                heapq.nlargest(k, self.counts.items(), key=lambda kv: kv[1])]
+
+
+class FlowAggregator:
+    """Rolls low-value flows up into per-interval summaries before upload.
+    
+    Flows with a threat score of at least ``min_score`` or at least
+    ``min_bytes`` of traffic are uploaded as they are. The rest are merged
+    per (src, dst, dst_port, protocol) and sent once per ``interval``.
+    Flows run from client to server, so ``dst_port`` is the service port;
+    the client port becomes 0 once flows with different ones are merged.
+    Top talkers (hosts by bytes) and services (protocol and port by bytes)
+    are kept over the same interval.
+    """
+    
+    def __init__(self, interval: float = AGGREGATE_INTERVAL, min_score: int = AGGREGATE_MIN_SCORE,
+                 min_bytes: int = AGGREGATE_MIN_BYTES,
+                 max_summaries: int = AGGREGATE_MAX_SUMMARIES):
+        self.interval = interval
+        self.min_score = min_score
+        self.min_bytes = min_bytes
+        self.max_summaries = max_summaries
+        self.input_flows = 0
+        self.output_rows = 0
+        self.top: Dict[str, list] = {"top_talkers": [], "top_services": []}  # last interval
+        self._summaries: Dict[tuple, Flow] = {}
+        self._talkers = SpaceSaving()
+        self._services = SpaceSaving()
+        self._window_start: Optional[float] = None
+    
+    def add(self, flows: List[Flow], now: float, flush: bool = False) -> List[Flow]:
+        """Flows to upload now: the detailed ones, plus the summaries when the interval ends."""
+        if self._window_start is None:
+            self._window_start = now
+        rows = []
+        summaries = self._summaries
+        talker, service = self._talkers.add, self._services.add
+        min_score, min_bytes = self.min_score, self.min_bytes
+        for flow in flows:
+            volume = flow.bytes_sent + flow.bytes_recv
+            talker(flow.src_ip, volume)
+            talker(flow.dst_ip, volume)
+            service((flow.protocol, flow.dst_port), volume)
+            if flow.threat_score >= min_score or volume >= min_bytes:
+                rows.append(flow)
+                continue
+            key = (flow.src_ip, flow.dst_ip, flow.dst_port, flow.protocol)
+            into = summaries.get(key)
+            if into is None:
+                summaries[key] = flow
+            else:
+                into.absorb(flow)
+        self.input_flows += len(flows)
+        if (flush or now - self._window_start >= self.interval
+                or len(summaries) >= self.max_summaries):
+            rows.extend(summaries.values())
+            self._close_window(now)
+        self.output_rows += len(rows)
+        return rows
+    
+    def _close_window(self, now: float):
+        self.top = {
+            "top_talkers": [
+                {"ip": format_ip(ip), "bytes": count, "error": error}
+                for ip, count, error in self._talkers.top(AGGREGATE_TOP_K)
+            ],
+            "top_services": [
+                {"protocol": proto, "port": port, "service": SERVICE_PORTS.get(port),
+                 "bytes": count, "error": error}
+                for (proto, port), count, error in self._services.top(AGGREGATE_TOP_K)
+            ],
+        }
+        self._summaries = {}
+        self._talkers = SpaceSaving()
+        self._services = SpaceSaving()
+        self._window_start = now
+    
+    def stats(self) -> dict:
+        return {
+            "aggregate_input_flows": self.input_flows,
+            "aggregate_output_rows": self.output_rows,
+            "aggregate_pending_summaries": len(self._summaries),
+            **self.top,
+        }
 
 # ============================================================================
 # API CLIENT
 # ============================================================================
 
+FLOW_COLUMNS = ("src_ip", "dst_ip", "src_port", "dst_port", "protocol",
+                "bytes_sent", "bytes_recv", "packets_sent", "packets_recv",
+                "duration", "service", "threat_score", "sampling_rate")
+
+
+class FlowBatchEncoder:
+    """Serializes flow batches for the agent-flows function.
+    
+    ``json`` is the original list of flow objects; ``columnar`` sends each
+    field name once with its values as an array; ``ndjson`` sends a header
+    line, then one array of values per flow. The batch timestamp is computed
+    once. ``encode()`` yields the body in chunks, gzip-compressed unless
+    disabled, so it can be sent with chunked transfer encoding.
+    """
+    FORMATS = ("columnar", "ndjson", "json")
+    # Approximate uncompressed bytes per flow, not counting the two IPs
+    ROW_BYTES = {"columnar": 50, "ndjson": 50, "json": 258}
+    IP_BYTES = {4: 15, 16: 39}    # longest text form of a packed address
+    
+    def __init__(self, fmt: str = UPLOAD_FORMAT, compress: bool = UPLOAD_COMPRESS,
+                 chunk_rows: int = UPLOAD_CHUNK_ROWS):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"unknown upload format {fmt!r}")
+        self.fmt = fmt
+        self.compress = compress
+        self.chunk_rows = chunk_rows
+    
+    def headers(self) -> Dict[str, str]:
+        headers = {
+            "Content-Type": "application/x-ndjson" if self.fmt == "ndjson" else "application/json"
+        }
+        if self.compress:
+            headers["Content-Encoding"] = "gzip"
+        return headers
+    
+    def row_bytes(self, flow: Flow) -> int:
+        """Estimated uncompressed size of one flow in the body."""
+        ip_bytes = self.IP_BYTES
+        return self.ROW_BYTES[self.fmt] + ip_bytes[len(flow.src_ip)] + ip_bytes[len(flow.dst_ip)]
+    
+    @staticmethod
+    def columns(flows: List[Flow]) -> Dict[str, list]:
+        return {
+            "src_ip": [format_ip(f.src_ip) for f in flows],
+            "dst_ip": [format_ip(f.dst_ip) for f in flows],
+            "src_port": [f.src_port for f in flows],
+            "dst_port": [f.dst_port for f in flows],
+            "protocol": [f.protocol for f in flows],
+            "bytes_sent": [f.bytes_sent for f in flows],
+            "bytes_recv": [f.bytes_recv for f in flows],
+            "packets_sent": [f.packets_sent for f in flows],
+            "packets_recv": [f.packets_recv for f in flows],
+            "duration": [round(f.end_time - f.start_time, 3) for f in flows],
+            "service": [f.service or SERVICE_PORTS.get(f.dst_port) for f in flows],
+            "threat_score": [f.threat_score for f in flows],
+            "sampling_rate": [f.sampling_rate for f in flows],
+        }
+    
+    def _chunks(self, agent_id: str, flows: List[Flow],
+                timestamp: Optional[float]) -> Iterator[str]:
+        dumps = json.JSONEncoder(separators=(",", ":")).encode
+        stamp = iso_timestamp(timestamp)
+        columns = self.columns(flows)
+        step = self.chunk_rows
+        # Each row carries its own rate; the batch gets the highest as a summary
+        sampling = max((f.sampling_rate for f in flows), default=1)
+        
+        if self.fmt == "columnar":
+            yield (f'{{"agent_id":{dumps(agent_id)},"format":"columnar",'
+                   f'"timestamp":"{stamp}","count":{len(flows)},"sampling_rate":{sampling},'
+                   f'"columns":{{')
+            for i, name in enumerate(FLOW_COLUMNS):
+                yield f'{"," if i else ""}"{name}":{dumps(columns[name])}'
+            yield "}}"
+            return
+        
+        rows = list(zip(*(columns[name] for name in FLOW_COLUMNS)))
+        if self.fmt == "ndjson":
+            yield dumps({"agent_id": agent_id, "timestamp": stamp,
+                         "sampling_rate": sampling, "columns": FLOW_COLUMNS}) + "\n"
+            for i in range(0, len(rows), step):
+                yield "".join(dumps(row) + "\n" for row in rows[i:i + step])
+            return
+        
+        keys = FLOW_COLUMNS + ("timestamp",)
+        stamp = (stamp,)
+        yield f'{{"agent_id":{dumps(agent_id)},"sampling_rate":{sampling},"flows":['
+        for i in range(0, len(rows), step):
+            chunk = dumps([dict(zip(keys, row + stamp)) for row in rows[i:i + step]])
+            yield ("," if i else "") + chunk[1:-1]
+        yield "]}"
+    
+    def encode(self, agent_id: str, flows: List[Flow],
+               timestamp: Optional[float] = None) -> Iterator[bytes]:
+        chunks = (chunk.encode() for chunk in self._chunks(agent_id, flows, timestamp))
+        if not self.compress:
+            yield from chunks
+            return
+        gzip = zlib.compressobj(UPLOAD_GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = gzip.compress(chunk)
+            if data:
+                yield data
+        yield gzip.flush()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to one backend host.
+    
+    Idle connections are reused, so steady uploads skip the TCP and TLS
+    handshake. At most ``size`` requests are in flight; further callers wait
+    for a slot. A request that fails on a reused connection (the server may
+    have closed it while idle) is retried once on a fresh one. Failed
+    connects back off exponentially with full jitter, and requests fail
+    fast until the backoff expires.
+    """
+    
+    def __init__(self, base_url: str, size: int = HTTP_POOL_SIZE,
+                 timeout: float = HTTP_TIMEOUT):
+        parts = urlsplit(base_url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname or ""
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._context = ssl.create_default_context() if parts.scheme == "https" else None
+        proxy = getproxies().get(parts.scheme)
+        self._proxy = urlsplit(proxy) if proxy and not proxy_bypass(self.host) else None
+        self._idle: List[tuple] = []             # (connection, last used)
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._connect_failures = 0
+        self._retry_at = 0.0
+        # Metrics
+        self.requests = 0
+        self.reused = 0
+        self.connects = 0
+        self.errors = 0
+        self.latency_buckets = [0] * (len(HTTP_LATENCY_BUCKETS_MS) + 1)
+        self._latency_sum = 0.0
+    
+    def _new_connection(self) -> http.client.HTTPConnection:
+        host, port = self.host, self.port
+        if self._proxy:
+            host, port = self._proxy.hostname, self._proxy.port or 8080
+        if self._context is not None:
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=self._context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        if self._proxy:
+            conn.set_tunnel(self.host, self.port)
+        return conn
+    
+    def _connect(self) -> http.client.HTTPConnection:
+        now = time.monotonic()
+        with self._lock:
+            if now < self._retry_at:
+                self.errors += 1
+                raise ConnectionError(
+                    f"backing off reconnects to {self.host} for {self._retry_at - now:.1f}s")
+        conn = self._new_connection()
+        try:
+            conn.connect()
+            # Headers and body chunks go out as separate writes; don't let
+            # Nagle hold them behind the server's delayed ACK
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            with self._lock:
+                self.errors += 1
+                self._connect_failures += 1
+                ceiling = min(HTTP_BACKOFF_MAX,
+                              HTTP_BACKOFF_BASE * 2 ** (self._connect_failures - 1))
+                self._retry_at = time.monotonic() + random.uniform(0, ceiling)
+            conn.close()
+            raise
+        with self._lock:
+            self._connect_failures = 0
+            self.connects += 1
+        return conn
+    
+    def _checkout(self) -> tuple:
+        """Return (connection, reused); reuses the most recently idle connection."""
+        cutoff = time.monotonic() - HTTP_IDLE_TIMEOUT
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if last_used > cutoff:
+                    return conn, True
+                conn.close()
+        return self._connect(), False
+    
+    def _record(self, elapsed: float, reused: bool):
+        ms = elapsed * 1000
+        bucket = 0
+        while bucket < len(HTTP_LATENCY_BUCKETS_MS) and ms > HTTP_LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+        with self._lock:
+            self.requests += 1
+            self.reused += reused
+            self.latency_buckets[bucket] += 1
+            self._latency_sum += elapsed
+    
+    def request(self, method: str, path: str, body, headers: Dict[str, str]) -> tuple:
+        """Send one request; return (status, body bytes, response headers).
+        
+        ``body`` is bytes or a callable returning an iterable of chunks, which
+        is sent with chunked transfer encoding and may be called again for a
+        retry.
+        """
+        with self._slots:
+            for attempt in (0, 1):
+                conn, reused = self._checkout()
+                start = time.perf_counter()
+                try:
+                    if callable(body):
+                        conn.request(method, self.base_path + path, body(), headers,
+                                     encode_chunked=True)
+                    else:
+                        conn.request(method, self.base_path + path, body, headers)
+                    resp = conn.getresponse()
+                    data = resp.read()
+                except (OSError, http.client.HTTPException):
+                    conn.close()
+                    if reused and attempt == 0:
+                        continue                 # stale keep-alive connection
+                    with self._lock:
+                        self.errors += 1
+                    raise
+                self._record(time.perf_counter() - start, reused)
+                if resp.will_close:
+                    conn.close()
+                else:
+                    with self._lock:
+                        self._idle.append((conn, time.monotonic()))
+                return resp.status, data, resp.headers
+    
+    def latency_percentile(self, pct: float) -> float:
+        """Upper bound (ms) of the histogram bucket holding the given percentile."""
+        with self._lock:
+            total = sum(self.latency_buckets)
+            if not total:
+                return 0.0
+            target, seen = total * pct / 100, 0
+            for bound, count in zip(HTTP_LATENCY_BUCKETS_MS + (float("inf"),), self.latency_buckets):
+                seen += count
+                if seen >= target:
+                    return bound
+        return float("inf")
+    
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.requests
+            stats = {
+                "upload_requests": requests,
+                "upload_connections": self.connects,
+                "upload_errors": self.errors,
+                "upload_reuse_ratio": round(self.reused / requests, 3) if requests else 0.0,
+                "upload_latency_avg_ms": round(self._latency_sum * 1000 / requests, 1) if requests else 0.0,
+            }
+        stats["upload_latency_p50_ms"] = self.latency_percentile(50)
+        stats["upload_latency_p99_ms"] = self.latency_percentile(99)
+        return stats
+    
+    def histogram(self) -> Dict[str, int]:
+        """Request latency histogram, keyed by bucket upper bound in ms."""
+        with self._lock:
+            return {
+                f"le_{bound}": count for bound, count in
+                zip(HTTP_LATENCY_BUCKETS_MS + ("inf",), self.latency_buckets)
+            }
+    
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+def load_identity(path: str, backend_url: str, hostname: str) -> Optional[dict]:
+    """Registration saved by an earlier run against this backend, or None.
+    
+    A saved identity is reused only for the same host name and agent
+    version, so either change registers the agent again.
+    """
+    try:
+        with open(path, encoding="utf-8") as f:
+            identity = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if (not isinstance(identity, dict) or not identity.get("agent_id")
+            or identity.get("backend_url") != backend_url
+            or identity.get("hostname") != hostname
+            or identity.get("version") != AGENT_VERSION):
+        return None
+    return identity
+
+
+def save_identity(path: str, identity: dict):
+    """Write ``identity`` atomically, readable by the owner only."""
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(identity, f, indent=2)
+    os.replace(tmp, path)
+
+
 class SNSMClient:
-    def __init__(self, backend_url: str, api_key: str, logger: logging.Logger):
+    def __init__(self, backend_url: str, api_key: str, logger: logging.Logger,
+                 upload_options: Optional[UploadOptions] = None):
         self.backend_url = backend_url
         self.api_key = api_key
         self.logger = logger
         self.agent_id: Optional[str] = None
+        self.registration: dict = {}             # what agent-register was sent and returned
+        options = upload_options or UploadOptions()
+        self.encoder = FlowBatchEncoder(options.format, options.compress)
+        self.pool = ConnectionPool(backend_url)
+        # Background uploads share the pool's in-flight limit
+        self._executor = ThreadPoolExecutor(HTTP_POOL_SIZE, thread_name_prefix="snsm-upload")
+        self._pending = threading.BoundedSemaphore(HTTP_POOL_SIZE * 2)
+        self.timings = StageTimings()            # encode and upload stages
         
     def _request(self, endpoint: str, data: dict) -> Optional[dict]:
-        url = f"{self.backend_url}/{endpoint}"
+        return self._post(endpoint, json.dumps(data).encode(),
+                          {"Content-Type": "application/json"})
+    
+    def _post(self, endpoint: str, body, headers: Dict[str, str]) -> Optional[dict]:
+        """POST a body (bytes, or a callable returning chunks to send chunked) and decode the reply."""
         headers = {
-            "Content-Type": "application/json",
+            **headers,
             "apikey": self.api_key,
             "Authorization": f"Bearer {self.api_key}"
         }
         
         try:
-            req = Request(url, data=json.dumps(data).encode(), headers=headers)
-            with urlopen(req, timeout=30) as resp:
-                return json.loads(resp.read().decode())
-        except URLError as e:
+            status, data, _ = self.pool.request("POST", f"/{endpoint}", body, headers)
+            if status >= 400:
+                self.logger.error(f"API request to {endpoint} failed: HTTP {status}")
+                return None
+            return json.loads(data.decode())
+        except (OSError, http.client.HTTPException) as e:
             self.logger.error(f"API request to {endpoint} failed: {e}")
             return None
         except Exception as e:
             self.logger.error(f"Unexpected error: {e}")
             return None
     
+    def submit(self, send: Callable[..., bool], *args) -> Future:
+        """Run an upload in the background; blocks while too many are queued."""
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(send, *args)
+        except RuntimeError:                     # executor already shut down
+            self._pending.release()
+            raise
+        future.add_done_callback(lambda _: self._pending.release())
+        return future
+    
+    def stats(self) -> dict:
+        return self.pool.stats()
+    
+    def close(self):
+        """Wait for background uploads, then close the pooled connections."""
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+    
     def register(self, hostname: str, ip_address: str) -> bool:
         self.logger.info("Registering agent with SNSM backend...")
         
-        response = self._request("agent-register", {
+        registration = {
             "hostname": hostname,
             "ip_address": ip_address,
-            "version": "1.0.0-python",
+            "version": AGENT_VERSION,
             "os": f"{platform.system()} {platform.release()}"
-        })
+        }
+        response = self._request("agent-register", registration)
         
         if response and "agent_id" in response:
             self.agent_id = response["agent_id"]
+            self.registration = {**registration, "agent_id": self.agent_id,
+                                 "backend_url": self.backend_url,
+                                 "registered_at": iso_timestamp()}
             self.logger.info(f"✓ Registered! Agent ID: {self.agent_id[:8]}...")
             self.logger.info(f"✓ Monitoring IP: {ip_address}")
             return True
@@ -206,24 +1433,30 @@ class SNSMClient:
         self.logger.error("Failed to register agent")
         return False
     
-    def send_flows(self, flows: List[Flow]) -> bool:
+    def send_flows(self, flows: List[Flow], timestamp: Optional[float] = None) -> bool:
         if not self.agent_id or not flows:
             return False
         
-        response = self._request("agent-flows", {
-            "agent_id": self.agent_id,
-            "flows": [f.to_dict() for f in flows]
-        })
+        agent_id = self.agent_id
+        timings = self.timings
+        # Chunks are encoded while the body streams, so "upload" includes "encode"
+        start = time.perf_counter_ns()
+        response = self._post(
+            "agent-flows",
+            lambda: timings.timed_chunks("encode", self.encoder.encode(agent_id, flows, timestamp)),
+            self.encoder.headers()
+        )
+        timings.observe("upload", time.perf_counter_ns() - start)
         
         return response is not None
     
-    def send_alerts(self, alerts: List[Alert]) -> bool:
+    def send_alerts(self, alerts: List[Alert], timestamp: Optional[float] = None) -> bool:
         if not self.agent_id or not alerts:
             return False
         
         response = self._request("agent-suricata", {
             "agent_id": self.agent_id,
-            "alerts": [a.to_dict() for a in alerts]
+            "alerts": [a.to_dict(timestamp) for a in alerts]
         })
         
         return response is not None
@@ -236,68 +1469,739 @@ class SNSMClient:
             "agent_id": self.agent_id,
             **stats
         }) is not None
+    
+    def fetch_blocklist(self, etag: str = "") -> Optional[tuple]:
+        """GET the blocklist; return (etag, entries), or None on failure.
+        
+        ``entries`` is None when the server answers 304 to ``etag``.
+        """
+        headers = {
+            "apikey": self.api_key,
+            "Authorization": f"Bearer {self.api_key}"
+        }
+        if self.agent_id:
+            headers["X-Agent-Id"] = self.agent_id
+        if etag:
+            headers["If-None-Match"] = etag
+        try:
+            status, data, response_headers = self.pool.request("GET", "/agent-blocklist", None, headers)
+            if status == 304:
+                return etag, None
+            if status >= 400:
+                self.logger.error(f"Blocklist fetch failed: HTTP {status}")
+                return None
+            return response_headers.get("ETag", ""), json.loads(data.decode()).get("blocklist", [])
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self.logger.error(f"Blocklist fetch failed: {e}")
+            return None
 
-# ============================================================================
-# THREAT DETECTOR
-# ============================================================================
-
-class ThreatDetector:
-    def __init__(self, logger: logging.Logger):
+class NDJSONWriter:
+    """Drop-in replacement for SNSMClient that writes records to a local file.
+    
+    Every flow, alert and heartbeat becomes one JSON line tagged with its
+    ``type``; ``path`` may be ``-`` for stdout.
+    """
+    
+    def __init__(self, path: str, logger: logging.Logger):
+        self.path = path
         self.logger = logger
-        self.port_tracker: Dict[str, List[tuple]] = defaultdict(list)
-        self.packet_tracker: Dict[str, List[float]] = defaultdict(list)
-        self.rate_limiter: Dict[str, float] = {}
-        self.alert_count = 0
-        
-    def _rate_limited(self, key: str, cooldown: int = 60) -> bool:
-        now = time.time()
-        if key in self.rate_limiter:
-            if now - self.rate_limiter[key] < cooldown:
-                return True
-        self.rate_limiter[key] = now
-        return False
+        self.agent_id: Optional[str] = None
+        self._file = sys.stdout if path == "-" else open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self.timings = StageTimings()
     
-    def analyze_packet(self, src_ip: str, dst_ip: str, src_port: int, 
-                       dst_port: int, protocol: str, local_ip: str) -> List[Alert]:
-        alerts = []
-        now = time.time()
-        
-        # Clean old entries
-        cutoff = now - 60
-        self.port_tracker[src_ip] = [(p, t) for p, t in self.port_tracker[src_ip] if t > cutoff]
-        self.packet_tracker[src_ip] = [t for t in self.packet_tracker[src_ip] if t > cutoff]
+    def _write(self, records: List[dict]):
+        start = time.perf_counter_ns()
+        with self._lock:
+            self._file.write("".join(json.dumps(r) + "\n" for r in records))
+            self._file.flush()
+        self.timings.observe("upload", time.perf_counter_ns() - start)
+    
+    def submit(self, send: Callable[..., bool], *args) -> Future:
+        """Writes are local and quick, so run them inline."""
+        future: Future = Future()
+        future.set_result(send(*args))
+        return future
+    
+    def stats(self) -> dict:
+        return {}
+    
+    def register(self, hostname: str, ip_address: str) -> bool:
+        self.agent_id = f"offline-{hostname}"
+        self.logger.info(f"✓ Writing records to {self.path}")
+        return True
+    
+    def send_flows(self, flows: List[Flow], timestamp: Optional[float] = None) -> bool:
+        self._write([{"type": "flow", **f.to_dict(timestamp)} for f in flows])
+        return True
+    
+    def send_alerts(self, alerts: List[Alert], timestamp: Optional[float] = None) -> bool:
+        self._write([{"type": "alert", **a.to_dict(timestamp)} for a in alerts])
+        return True
+    
+    def heartbeat(self, stats: dict) -> bool:
+        self._write([{"type": "heartbeat", "agent_id": self.agent_id, **stats}])
+        return True
+    
+    def close(self):
+        if self._file is not sys.stdout:
+            self._file.close()
+
+
+class Spool:
+    """On-disk buffer for flow and alert batches the backend did not accept.
+    
+    Each batch is one NDJSON line with its original timestamp, appended with
+    a single write to numbered segment files that roll over at
+    ``SPOOL_SEGMENT_BYTES``. The ``fsync`` policy is ``always``, ``interval``
+    (at most once per ``SPOOL_FSYNC_INTERVAL``) or ``never``. Past
+    ``max_bytes`` the oldest segments are deleted.
+    
+    A drainer thread replays segments oldest first, at ``SPOOL_DRAIN_RATE``
+    batches per second, and deletes each one once it has been sent. While
+    the backend is down it makes one attempt per ``SPOOL_RETRY_INTERVAL``.
+    Segments left by a previous run are replayed too. Delivery is
+    at-least-once: a batch in flight when the agent dies is sent again.
+    """
+    FSYNC = ("always", "interval", "never")
+    SUFFIX = ".spool"
+    
+    def __init__(self, directory: str, client: SNSMClient, logger: logging.Logger,
+                 max_bytes: int = SPOOL_MAX_MB << 20, fsync: str = SPOOL_FSYNC):
+        if fsync not in self.FSYNC:
+            raise ValueError(f"unknown fsync policy {fsync!r}")
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.directory = directory
+        self.client = client
+        self.logger = logger
+        self.max_bytes = max_bytes
+        self.fsync = fsync
         
-        # Track ports and packets
-        if dst_port and (dst_port, now) not in self.port_tracker[src_ip]:
-            self.port_tracker[src_ip].append((dst_port, now))
-        self.packet_tracker[src_ip].append(now)
+        self._segments = deque()                 # [seq, bytes], oldest first
+        for name in sorted(os.listdir(directory)):
+            seq = name[:-len(self.SUFFIX)]
+            if name.endswith(self.SUFFIX) and seq.isdigit():
+                size = os.path.getsize(self._path(int(seq)))
+                if size:
+                    self._segments.append([int(seq), size])
+                else:
+                    os.remove(self._path(int(seq)))
+        self._next_seq = self._segments[-1][0] + 1 if self._segments else 0
+        self._file = None                        # segment being written, always _segments[-1]
+        self._last_sync = 0.0
+        self._last_warning = 0.0
+        self._replay_offset = (None, 0)          # (seq, byte offset) of a partly replayed segment
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        # Metrics
+        self.bytes = sum(size for _, size in self._segments)
+        self.spooled_batches = 0
+        self.replayed_batches = 0
+        self.evicted_bytes = 0
+        if self._segments:
+            self.logger.info(f"Spool holds {self.bytes >> 10} KB from a previous run, replaying")
         
-        # PORT SCAN DETECTION
+        self._drainer = threading.Thread(target=self._drain_loop, name="snsm-spool", daemon=True)
+        self._drainer.start()
+    
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{seq:012d}{self.SUFFIX}")
+    
+    def write_flows(self, flows: List[Flow], timestamp: Optional[float] = None):
+        self._append({
+            "kind": "flows",
+            "timestamp": time.time() if timestamp is None else timestamp,
+            "rows": [[format_ip(f.src_ip), format_ip(f.dst_ip)]
+                     + [getattr(f, name) for name in Flow.__slots__[2:]] for f in flows],
+        })
+    
+    def write_alerts(self, alerts: List[Alert], timestamp: Optional[float] = None):
+        self._append({
+            "kind": "alerts",
+            "timestamp": time.time() if timestamp is None else timestamp,
+            "rows": [a.to_dict() for a in alerts],
+        })
+    
+    def _append(self, record: dict):
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode()
+        with self._lock:
+            if self._file is None or self._segments[-1][1] >= SPOOL_SEGMENT_BYTES:
+                self._roll()
+            self._file.write(line)
+            self._segments[-1][1] += len(line)
+            self.bytes += len(line)
+            self.spooled_batches += 1
+            now = time.monotonic()
+            if self.fsync == "always" or (
+                    self.fsync == "interval" and now - self._last_sync >= SPOOL_FSYNC_INTERVAL):
+                os.fsync(self._file.fileno())
+                self._last_sync = now
+            if self.bytes > self.max_bytes:
+                self._evict()
+        self._wake.set()
+    
+    def _roll(self):
+        """Close the current segment and start a new one (lock held)."""
+        self._close_segment()
+        self._file = open(self._path(self._next_seq), "ab", buffering=0)
+        self._segments.append([self._next_seq, 0])
+        self._next_seq += 1
+    
+    def _close_segment(self):
+        if self._file is not None:
+            if self.fsync != "never":
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+    
+    def _evict(self):
+        """Delete the oldest closed segments until under the cap (lock held)."""
+        evicted = 0
+        while self.bytes > self.max_bytes and len(self._segments) > 1:
+            seq, size = self._segments.popleft()
+            try:
+                os.remove(self._path(seq))
+            except FileNotFoundError:
+                pass
+            self.bytes -= size
+            evicted += size
+        self.evicted_bytes += evicted
+        now = time.monotonic()
+        if evicted and now - self._last_warning >= 60:
+            self._last_warning = now
+            self.logger.warning(f"Spool over {self.max_bytes >> 20} MB, deleting the oldest "
+                                f"records ({self.evicted_bytes >> 10} KB so far)")
+    
+    def _oldest(self) -> Optional[int]:
+        """The oldest segment to replay, closing the current one if it is the only one."""
+        with self._lock:
+            if not self._segments:
+                return None
+            if self._file is not None and len(self._segments) == 1:
+                if not self._segments[0][1]:
+                    return None
+                self._close_segment()
+            return self._segments[0][0]
+    
+    def _send(self, record: dict) -> bool:
+        timestamp = record["timestamp"]
+        if record["kind"] == "flows":
+            return self.client.send_flows(
+                [Flow(pack_ip(row[0]), pack_ip(row[1]), *row[2:]) for row in record["rows"]],
+                timestamp)
+        return self.client.send_alerts(
+            [Alert(**{**row, "src_ip": pack_ip(row["src_ip"]), "dst_ip": pack_ip(row["dst_ip"])})
+             for row in record["rows"]], timestamp)
+    
+    def _replay(self, seq: int) -> bool:
+        """Send one segment; False if the backend refused a batch."""
+        offset = self._replay_offset[1] if self._replay_offset[0] == seq else 0
+        try:
+            with open(self._path(seq), "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    if self._stop.is_set():
+                        return False
+                    try:
+                        record = json.loads(line)
+                    except ValueError:               # torn write from a crash
+                        offset += len(line)
+                        continue
+                    if not self._send(record):
+                        self._replay_offset = (seq, offset)
+                        return False
+                    offset += len(line)
+                    self.replayed_batches += 1
+                    self._stop.wait(1 / SPOOL_DRAIN_RATE)
+        except FileNotFoundError:                    # evicted while replaying
+            pass
+        with self._lock:
+            if self._segments and self._segments[0][0] == seq:
+                self.bytes -= self._segments.popleft()[1]
+                try:
+                    os.remove(self._path(seq))
+                except FileNotFoundError:
+                    pass
+        self._replay_offset = (None, 0)
+        return True
+    
+    def _drain_loop(self):
+        while not self._stop.is_set():
+            seq = self._oldest()
+            if seq is None:
+                self._wake.wait(SPOOL_RETRY_INTERVAL)
+                self._wake.clear()
+            elif not self._replay(seq):
+                self._stop.wait(SPOOL_RETRY_INTERVAL)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "spool_bytes": self.bytes,
+                "spool_segments": len(self._segments),
+                "spool_batches": self.spooled_batches,
+                "spool_replayed_batches": self.replayed_batches,
+                "spool_evicted_bytes": self.evicted_bytes,
+            }
+    
+    def close(self, timeout: float = 5.0):
+        self._stop.set()
+        self._wake.set()
+        self._drainer.join(timeout)
+        with self._lock:
+            self._close_segment()
+
+
+class UploadPipeline:
+    """Splits exported flows into batches and sends them to the backend.
+    
+    A batch is cut when it reaches ``batch_rows`` flows or
+    ``UPLOAD_BATCH_BYTES`` of estimated body, whichever is first. The row
+    limit adapts like TCP congestion control. Fast successful batches grow
+    it by ``UPLOAD_MIN_BATCH_ROWS``, and a failure or a batch slower than
+    ``UPLOAD_TARGET_LATENCY`` halves it. ``concurrency`` senders drain the
+    queue. A failed batch is requeued up to ``UPLOAD_RETRIES`` times.
+    
+    ``put()`` never waits for the network. When more than ``max_queued``
+    flows are waiting, the ``aggregate`` policy merges queued flows that
+    differ only in source port. If that is not enough, or with the ``drop``
+    policy, the oldest flows are dropped. With a ``spool``, they are written
+    to it instead, as are batches that run out of retries. Spool writes
+    happen after the queue lock is released, so disk I/O never holds up
+    the senders or another ``put()``.
+    """
+    OVERFLOW = ("aggregate", "drop")
+    
+    def __init__(self, client: SNSMClient, logger: logging.Logger,
+                 overflow: str = UPLOAD_OVERFLOW, spool: Optional[Spool] = None,
+                 concurrency: int = UPLOAD_CONCURRENCY, max_queued: int = UPLOAD_QUEUE_FLOWS):
+        if overflow not in self.OVERFLOW:
+            raise ValueError(f"unknown overflow policy {overflow!r}")
+        self.client = client
+        self.logger = logger
+        self.overflow = overflow
+        self.spool = spool
+        self.max_queued = max_queued
+        self.batch_rows = min(1000, UPLOAD_MAX_BATCH_ROWS)
+        self._pending = deque()                  # [flows, timestamp, attempts, offset]
+        self._cond = threading.Condition()
+        self._closing = False
+        self._last_warning = 0.0
+        # Metrics
+        self.queued = 0
+        self.in_flight = 0
+        self.sent_flows = 0
+        self.sent_batches = 0
+        self.failed_flows = 0
+        self.dropped_flows = 0
+        self.spooled_flows = 0
+        self.aggregated_flows = 0
+        self._senders = [
+            threading.Thread(target=self._send_loop, name=f"snsm-batch-{i}", daemon=True)
+            for i in range(concurrency)
+        ]
+        for sender in self._senders:
+            sender.start()
+    
+    def put(self, flows: List[Flow], timestamp: Optional[float] = None):
+        shed = []
+        with self._cond:
+            self._pending.append([flows, timestamp, 0, 0])
+            self.queued += len(flows)
+            if self.queued > self.max_queued:
+                self._shed(shed)
+            self._cond.notify_all()
+        self._spool_shed(shed)
+    
+    @staticmethod
+    def aggregate(flows: List[Flow]) -> List[Flow]:
+        """Merge flows with the same hosts, destination port and protocol.
+        
+        The given flows are left as they are; a flow that absorbs others is
+        a copy.
+        """
+        merged: Dict[tuple, Flow] = {}
+        copied = set()
+        for flow in flows:
+            key = (flow.src_ip, flow.dst_ip, flow.dst_port, flow.protocol)
+            into = merged.get(key)
+            if into is None:
+                merged[key] = flow
+                continue
+            if key not in copied:
+                copied.add(key)
+                into = merged[key] = copy.copy(into)
+            into.absorb(flow)
+        return list(merged.values())
+    
+    def _shed(self, shed: list):
+        """Bring the queue back under ``max_queued`` (lock held)."""
+        before = self.queued
+        if self.overflow == "aggregate":
+            # Only adjacent items with the same timestamp are merged, so flows
+            # keep their export time; a merged item keeps the most retries used
+            pending = deque()
+            for flows, timestamp, attempts, offset in self._pending:
+                if pending and pending[-1][1] == timestamp:
+                    last = pending[-1]
+                    last[0].extend(flows[offset:])
+                    last[2] = max(last[2], attempts)
+                else:
+                    pending.append([flows[offset:], timestamp, attempts, 0])
+            queued = 0
+            for item in pending:
+                item[0] = self.aggregate(item[0])
+                queued += len(item[0])
+            self._pending = pending
+            self.aggregated_flows += self.queued - queued
+            self.queued = queued
+        while self.queued > self.max_queued:
+            item = self._pending[0]
+            flows, timestamp, _, offset = item
+            end = min(len(flows), offset + self.queued - self.max_queued)
+            if end == len(flows):
+                self._pending.popleft()
+            else:
+                item[3] = end
+            self.queued -= end - offset
+            self._discard(flows[offset:end], timestamp, shed)
+        now = time.monotonic()
+        if now - self._last_warning >= 60:
+            self._last_warning = now
+            self.logger.warning(
+                f"Upload backlog over {self.max_queued} flows, {self.overflow} policy "
+                f"shed {before - self.queued} (dropped {self.dropped_flows}, "
+                f"spooled {self.spooled_flows} so far)")
+    
+    def _discard(self, flows: List[Flow], timestamp: Optional[float], shed: list):
+        """Set aside flows for the spool, or count them as lost (lock held)."""
+        if self.spool:
+            shed.append((flows, timestamp))
+            self.spooled_flows += len(flows)
+        else:
+            self.dropped_flows += len(flows)
+    
+    def _spool_shed(self, shed: list):
+        """Write what ``_discard`` set aside, outside the lock."""
+        for flows, timestamp in shed:
+            self.spool.write_flows(flows, timestamp)
+    
+    def _next_batch(self) -> tuple:
+        """Cut a batch from the head of the queue (lock held)."""
+        item = self._pending[0]
+        flows, timestamp, attempts, offset = item
+        end = min(len(flows), offset + self.batch_rows)
+        row_bytes = self.client.encoder.row_bytes
+        size = 0
+        for i in range(offset, end):
+            size += row_bytes(flows[i])
+            if size > UPLOAD_BATCH_BYTES and i > offset:
+                end = i
+                break
+        if end == len(flows):
+            self._pending.popleft()
+        else:
+            item[3] = end
+        self.queued -= end - offset
+        return flows[offset:end], timestamp, attempts
+    
+    def _adapt(self, ok: bool, elapsed: float, rows: int):
+        """Additive increase, multiplicative decrease of the batch size (lock held)."""
+        if ok and elapsed <= UPLOAD_TARGET_LATENCY:
+            if rows >= self.batch_rows:
+                self.batch_rows = min(UPLOAD_MAX_BATCH_ROWS,
+                                      self.batch_rows + UPLOAD_MIN_BATCH_ROWS)
+        else:
+            self.batch_rows = max(UPLOAD_MIN_BATCH_ROWS, self.batch_rows // 2)
+    
+    def _send_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closing:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                batch, timestamp, attempts = self._next_batch()
+                self.in_flight += 1
+            
+            start = time.monotonic()
+            ok = self.client.send_flows(batch, timestamp)
+            elapsed = time.monotonic() - start
+            
+            shed = []
+            retry = False
+            with self._cond:
+                self.in_flight -= 1
+                self._adapt(ok, elapsed, len(batch))
+                if ok:
+                    self.sent_flows += len(batch)
+                    self.sent_batches += 1
+                    self.logger.debug(f"Sent {len(batch)} flows in {elapsed * 1000:.0f} ms "
+                                      f"(total: {self.sent_flows})")
+                elif attempts < UPLOAD_RETRIES and not self._closing:
+                    self._pending.appendleft([batch, timestamp, attempts + 1, 0])
+                    self.queued += len(batch)
+                    if self.queued > self.max_queued:
+                        self._shed(shed)
+                    retry = True
+                elif self.spool:
+                    self._discard(batch, timestamp, shed)
+                else:
+                    self.failed_flows += len(batch)
+                self._cond.notify_all()
+            self._spool_shed(shed)
+            if retry:
+                # Give the backend a moment before this sender tries again
+                with self._cond:
+                    self._cond.wait(UPLOAD_RETRY_DELAY)
+    
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "upload_queue_flows": self.queued,
+                "upload_batch_flows": self.batch_rows,
+                "upload_sent_flows": self.sent_flows,
+                "upload_failed_flows": self.failed_flows,
+                "upload_dropped_flows": self.dropped_flows,
+                "upload_spooled_flows": self.spooled_flows,
+                "upload_aggregated_flows": self.aggregated_flows,
+            }
+    
+    def close(self, timeout: Optional[float] = None):
+        """Send what is queued (no more retries), then stop the senders.
+        
+        Flows still queued when ``timeout`` runs out go to the spool.
+        """
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for sender in self._senders:
+            sender.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        shed = []
+        with self._cond:
+            while self._pending:
+                flows, timestamp, _, offset = self._pending.popleft()
+                self.queued -= len(flows) - offset
+                self._discard(flows[offset:], timestamp, shed)
+        self._spool_shed(shed)
+
+# ============================================================================
+# THREAT DETECTOR
+# ============================================================================
+
+class WindowCounter:
+    """Event count over a sliding time window, kept in a ring of time buckets.
+    
+    ``add()`` is O(1) amortized and memory is fixed at ``buckets`` ints; the
+    window edge is accurate to one bucket (window / buckets seconds).
+    """
+    __slots__ = ("width", "counts", "total", "head")
+    
+    def __init__(self, window: float, buckets: int = WINDOW_BUCKETS):
+        self.width = window / buckets
+        self.counts = [0] * buckets
+        self.total = 0
+        self.head = 0    # absolute index of the newest bucket
+    
+    def add(self, now: float) -> int:
+        """Count one event at ``now``; return the number of events in the window."""
+        bucket = int(now / self.width)
+        counts = self.counts
+        if bucket > self.head:
+            size = len(counts)
+            if bucket - self.head >= size:
+                counts[:] = [0] * size
+                self.total = 0
+            else:
+                for i in range(self.head + 1, bucket + 1):
+                    self.total -= counts[i % size]
+                    counts[i % size] = 0
+            self.head = bucket
+        # Late (out-of-order) events are counted in the newest bucket
+        counts[self.head % len(counts)] += 1
+        self.total += 1
+        return self.total
+    
+    def clear(self):
+        self.counts[:] = [0] * len(self.counts)
+        self.total = 0
+
+
+class SourceState:
+    """Sliding-window detection state for one source address.
+    
+    ``ports`` maps destination port -> last time seen, ordered oldest first,
+    so expired ports drop off the front and its length is the distinct-port
+    count for the port-scan window.
+    """
+    __slots__ = ("ports", "packets", "last_seen")
+    
+    def __init__(self):
+        self.ports: "OrderedDict[int, float]" = OrderedDict()
+        self.packets = WindowCounter(DDOS_WINDOW)
+        self.last_seen = 0.0
+
+
+# Approximate heap cost of detector state (CPython 3, 64-bit)
+SOURCE_STATE_BYTES = 900
+PORT_ENTRY_BYTES = 150
+RATE_LIMIT_ENTRY_BYTES = 200
+
+
+class ThreatDetector:
+    """Per-source sliding-window detection with bounded state.
+    
+    Sources and alert cooldowns live in LRU-ordered tables. Sources idle for
+    DETECTOR_STATE_TTL are dropped, and when the table exceeds
+    ``max_sources`` or the estimated ``memory_budget`` the least recently
+    seen sources are evicted, so a spoofed-source flood costs detection
+    history for quiet sources rather than unbounded memory.
+    """
+    
+    def __init__(self, logger: logging.Logger,
+                 max_sources: int = DETECTOR_MAX_SOURCES,
+                 memory_budget: int = DETECTOR_MEMORY_MB << 20,
+                 score_weights: Optional[Dict[str, int]] = None):
+        self.logger = logger
+        self.max_sources = max_sources
+        self.memory_budget = memory_budget
+        self.score_weights = {**SCORE_WEIGHTS, **(score_weights or {})}
+        self._port_scores = {port: self.score_weights["suspicious_port"] for port in SUSPICIOUS_PORTS}
+        for port in MALICIOUS_PORTS:
+            self._port_scores[port] = self._port_scores.get(port, 0) + self.score_weights["malicious_port"]
+        self.signatures: Optional["SignatureEngine"] = None    # --rules
+        self.blocklist: Optional["Blocklist"] = None
+        self.sources: "OrderedDict[bytes, SourceState]" = OrderedDict()
+        self.rate_limiter: "OrderedDict[tuple, float]" = OrderedDict()
+        self.alert_count = 0
+        self.port_entries = 0
+        self.evicted_idle = 0
+        self.evicted_pressure = 0
+        
+    def _rate_limited(self, key: tuple, cooldown: int = 60,
+                      now: Optional[float] = None) -> bool:
+        if now is None:
+            now = time.time()
+        limiter = self.rate_limiter
+        last = limiter.get(key)
+        if last is not None:
+            if now - last < cooldown:
+                return True
+            limiter.move_to_end(key)
+        limiter[key] = now
+        # Entries are in last-fired order; anything past the longest cooldown is dead
+        while limiter and now - next(iter(limiter.values())) >= RATE_LIMIT_TTL:
+            limiter.popitem(last=False)
+        return False
+    
+    def state_bytes(self) -> int:
+        """Estimated heap used by detector state."""
+        return (len(self.sources) * SOURCE_STATE_BYTES
+                + self.port_entries * PORT_ENTRY_BYTES
+                + len(self.rate_limiter) * RATE_LIMIT_ENTRY_BYTES)
+    
+    def _evict(self, now: float):
+        """Drop idle sources, then least recently seen ones while over the limits."""
+        sources = self.sources
+        cutoff = now - DETECTOR_STATE_TTL
+        while sources:
+            state = next(iter(sources.values()))
+            if state.last_seen > cutoff:
+                break
+            self.port_entries -= len(sources.popitem(last=False)[1].ports)
+            self.evicted_idle += 1
+        
+        # Under pressure shed whichever table is larger; a dropped cooldown
+        # only means that alert may repeat early
+        limiter = self.rate_limiter
+        evicted = 0
+        while len(limiter) > self.max_sources:
+            limiter.popitem(last=False)
+        while len(sources) > 1 and (len(sources) > self.max_sources
+                                    or self.state_bytes() > self.memory_budget):
+            if len(limiter) * RATE_LIMIT_ENTRY_BYTES > len(sources) * SOURCE_STATE_BYTES:
+                limiter.popitem(last=False)
+            else:
+                self.port_entries -= len(sources.popitem(last=False)[1].ports)
+            evicted += 1
+        if evicted:
+            self.evicted_pressure += evicted
+            if not self._rate_limited(("state-pressure",), now=now):
+                self.logger.warning(
+                    f"Detector state at capacity ({len(sources)} sources, "
+                    f"~{self.state_bytes() >> 20} MB); evicting least recently seen"
+                )
+    
+    def stats(self) -> dict:
+        """State table counters for the heartbeat."""
+        return {
+            "detector_sources": len(self.sources),
+            "detector_state_bytes": self.state_bytes(),
+            "detector_evicted_idle": self.evicted_idle,
+            "detector_evicted_pressure": self.evicted_pressure,
+        }
+    
+    def analyze_packet(self, src_ip: bytes, dst_ip: bytes, src_port: int, 
+                       dst_port: int, protocol: str, local_ip: bytes,
+                       now: Optional[float] = None) -> List[Alert]:
+        alerts = []
+        if now is None:
+            now = time.time()
+        
+        sources = self.sources
+        state = sources.get(src_ip)
+        grew = state is None
+        if grew:
+            state = sources[src_ip] = SourceState()
+        else:
+            sources.move_to_end(src_ip)
+        if now > state.last_seen:
+            state.last_seen = now
+        
+        # Track ports and expire those outside the scan window
+        ports = state.ports
+        if dst_port:
+            if dst_port in ports:
+                ports.move_to_end(dst_port)
+            else:
+                grew = True
+                self.port_entries += 1
+                if len(ports) >= DETECTOR_MAX_PORTS:
+                    ports.popitem(last=False)
+                    self.port_entries -= 1
+            ports[dst_port] = now
         window_start = now - PORTSCAN_WINDOW
-        recent_ports = set(p for p, t in self.port_tracker[src_ip] if t > window_start)
-        if len(recent_ports) >= PORTSCAN_THRESHOLD:
-            if not self._rate_limited(f"portscan-{src_ip}"):
+        while ports and next(iter(ports.values())) <= window_start:
+            ports.popitem(last=False)
+            self.port_entries -= 1
+        recent_packets = state.packets.add(now)
+        
+        # PORT SCAN DETECTION
+        recent_ports = len(ports)
+        if recent_ports >= PORTSCAN_THRESHOLD:
+            if not self._rate_limited(("portscan", src_ip), now=now):
                 self.alert_count += 1
                 alerts.append(Alert(
                     signature_id=f"SNSM-PORTSCAN-{self.alert_count}",
-                    signature_name=f"Port scan detected ({len(recent_ports)} ports)",
+                    signature_name=f"Port scan detected ({recent_ports} ports)",
                     severity="high",
                     category="Port Scan Detected",
                     src_ip=src_ip, dst_ip=dst_ip,
                     src_port=src_port, dst_port=dst_port,
                     protocol=protocol
                 ))
-                self.port_tracker[src_ip] = []
+                self.port_entries -= len(ports)
+                ports.clear()
         
         # DDoS DETECTION
-        window_start = now - DDOS_WINDOW
-        recent_packets = [t for t in self.packet_tracker[src_ip] if t > window_start]
-        if len(recent_packets) >= DDOS_THRESHOLD:
-            if not self._rate_limited(f"ddos-{src_ip}"):
+        if recent_packets >= DDOS_THRESHOLD:
+            if not self._rate_limited(("ddos", src_ip), now=now):
                 self.alert_count += 1
                 alerts.append(Alert(
                     signature_id=f"SNSM-DDOS-{self.alert_count}",
-                    signature_name=f"High packet rate ({len(recent_packets)} pkts/{DDOS_WINDOW}s)",
+                    signature_name=f"High packet rate ({recent_packets} pkts/{DDOS_WINDOW}s)",
                     severity="critical",
                     category="DDoS Attack Detected",
                     src_ip=src_ip, dst_ip=dst_ip,
@@ -305,9 +2209,23 @@ class ThreatDetector:
                     protocol=protocol
                 ))
         
+        self._check_ports(alerts, src_ip, dst_ip, src_port, dst_port,
+                          protocol, local_ip, now)
+        if self.blocklist is not None and self.blocklist.entries:
+            self._check_blocklist(alerts, src_ip, dst_ip, src_port, dst_port, protocol, now)
+        
+        # State only grows on a new source or port, so only then can it overflow
+        if grew or alerts:
+            self._evict(now)
+        return alerts
+    
+    def _check_ports(self, alerts: List[Alert], src_ip: bytes, dst_ip: bytes,
+                     src_port: int, dst_port: int, protocol: str,
+                     local_ip: bytes, now: float):
+        """Single-packet checks shared by every detector mode."""
         # SUSPICIOUS PORT DETECTION
         if dst_port in SUSPICIOUS_PORTS and dst_ip == local_ip:
-            if not self._rate_limited(f"suspicious-{src_ip}-{dst_port}", 300):
+            if not self._rate_limited(("suspicious", src_ip, dst_port), 300, now):
                 self.alert_count += 1
                 alerts.append(Alert(
                     signature_id=f"SNSM-SUSP-{self.alert_count}",
@@ -321,7 +2239,7 @@ class ThreatDetector:
         
         # MALICIOUS PORT DETECTION
         if dst_port in MALICIOUS_PORTS or src_port in MALICIOUS_PORTS:
-            if not self._rate_limited(f"malicious-{src_ip}-{dst_port}", 60):
+            if not self._rate_limited(("malicious", src_ip, dst_port), 60, now):
                 self.alert_count += 1
                 alerts.append(Alert(
                     signature_id=f"SNSM-MAL-{self.alert_count}",
@@ -332,192 +2250,2692 @@ class ThreatDetector:
                     src_port=src_port, dst_port=dst_port,
                     protocol=protocol
                 ))
-        
+    
+    def is_critical(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+                    now: float) -> bool:
+        """Whether a packet's flow keeps exact counters under overload sampling."""
+        if dst_port in MALICIOUS_PORTS or src_port in MALICIOUS_PORTS:
+            return True
+        blocklist = self.blocklist
+        return (blocklist is not None and bool(blocklist.entries)
+                and (blocklist.lookup(src_ip, now) is not None
+                     or blocklist.lookup(dst_ip, now) is not None))
+    
+    def _check_blocklist(self, alerts: List[Alert], src_ip: bytes, dst_ip: bytes,
+                         src_port: int, dst_port: int, protocol: str, now: float):
+        """Critical alert for traffic from or to a blocklisted address."""
+        lookup = self.blocklist.lookup
+        src_entry = lookup(src_ip, now)
+        dst_entry = lookup(dst_ip, now)
+        if src_entry is None and dst_entry is None:
+            return
+        for ip, direction, entry in ((src_ip, "from", src_entry), (dst_ip, "to", dst_entry)):
+            key = ("blocklist", ip)
+            if entry is None or self._rate_limited(key, BLOCKLIST_COOLDOWN, now):
+                continue
+            self.alert_count += 1
+            alerts.append(Alert(
+                signature_id=f"SNSM-BLOCK-{self.alert_count}",
+                signature_name=f"Traffic {direction} blocklisted {entry.network} ({entry.reason})",
+                severity="critical",
+                category="Blocklisted Host",
+                src_ip=src_ip, dst_ip=dst_ip,
+                src_port=src_port, dst_port=dst_port,
+                protocol=protocol, cooldown=(key, BLOCKLIST_COOLDOWN)
+            ))
+    
+    def match_signatures(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+                         protocol: str, frame, payload_offset: int,
+                         now: Optional[float] = None) -> List[Alert]:
+        """Alerts for the signature rules one packet matches."""
+        alerts = []
+        for rule in self.signatures.match(src_ip, dst_ip, src_port, dst_port,
+                                          protocol, frame, payload_offset):
+            if self._rate_limited(("sig", rule.sid, src_ip), SIGNATURE_COOLDOWN, now):
+                continue
+            self.alert_count += 1
+            alerts.append(Alert(
+                signature_id=f"SNSM-SIG-{rule.sid}",
+                signature_name=rule.msg,
+                severity=rule.severity,
+                category=rule.category,
+                src_ip=src_ip, dst_ip=dst_ip,
+                src_port=src_port, dst_port=dst_port,
+                protocol=protocol
+            ))
         return alerts
     
-    def calculate_threat_score(self, flow: Flow, local_ip: str) -> int:
+    def calculate_threat_score(self, flow: Flow, local_ip: bytes) -> int:
+        weights = self.score_weights
         score = 0
         
         # Large data transfer
-        if flow.bytes_sent > 1_000_000:
-            score += 10
-        if flow.bytes_recv > 10_000_000:
-            score += 15
+        if flow.bytes_sent > SCORE_UPLOAD_BYTES:
+            score += weights["large_upload"]
+        if flow.bytes_recv > SCORE_DOWNLOAD_BYTES:
+            score += weights["large_download"]
         
         # High packet rate in short time
         duration = flow.end_time - flow.start_time
         total_packets = flow.packets_sent + flow.packets_recv
-        if total_packets > 100 and duration < 5:
-            score += 20
+        if total_packets > SCORE_BURST_PACKETS and duration < SCORE_BURST_SECONDS:
+            score += weights["packet_burst"]
         
         # Suspicious ports
         if flow.dst_port in SUSPICIOUS_PORTS:
-            score += 10
+            score += weights["suspicious_port"]
         if flow.dst_port in MALICIOUS_PORTS:
-            score += 40
+            score += weights["malicious_port"]
         
         return min(score, 100)
+    
+    def score_flows(self, flows: List[Flow]):
+        """Set ``threat_score`` on a batch of exported flows.
+        
+        Same result as ``calculate_threat_score`` per flow, with the lookups
+        hoisted out of the loop. There is deliberately no NumPy path: copying
+        the fields out of the Flow objects costs as much as this loop (see
+        ``score_flows_numpy`` in snsm-bench.py).
+        """
+        weights = self.score_weights
+        upload, download, burst = (weights["large_upload"], weights["large_download"],
+                                   weights["packet_burst"])
+        port_scores = self._port_scores
+        for flow in flows:
+            score = port_scores.get(flow.dst_port, 0)
+            if flow.bytes_sent > SCORE_UPLOAD_BYTES:
+                score += upload
+            if flow.bytes_recv > SCORE_DOWNLOAD_BYTES:
+                score += download
+            if (flow.packets_sent + flow.packets_recv > SCORE_BURST_PACKETS
+                    and flow.end_time - flow.start_time < SCORE_BURST_SECONDS):
+                score += burst
+            flow.threat_score = min(score, 100)
+
+
+HASH_MASK = (1 << 64) - 1
+
+
+class SpreadSketch:
+    """Distinct items per key in fixed memory (a Count-Min of HyperLogLogs).
+    
+    Each key maps to one cell per row and every cell is a small HyperLogLog,
+    so keys sharing a cell merge their items. The estimate is the minimum
+    over rows: relative standard error about 1.04/sqrt(registers) (18% at
+    32, exact-ish linear counting below ~80 items), plus an overcount limited
+    to the items of keys that collide with it in every row.
+    """
+    __slots__ = ("rows", "width", "m", "shift", "alpha", "registers", "inv_sum", "zeros")
+    
+    def __init__(self, rows: int = SKETCH_ROWS, width: int = SKETCH_WIDTH,
+                 registers: int = HLL_REGISTERS):
+        self.rows = rows
+        self.width = width
+        self.m = registers                       # power of two, at most 128
+        self.shift = registers.bit_length() - 1
+        self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(
+            registers, 0.7213 / (1 + 1.079 / registers))
+        self.reset()
+    
+    def rotate(self, epoch: int):
+        """Start the counting window ``epoch``."""
+        self.reset()
+    
+    def reset(self):
+        cells = self.rows * self.width
+        self.registers = bytearray(cells * self.m)
+        # Per-cell sum of 2^-register and count of empty registers, kept incrementally
+        self.inv_sum = array("d", [float(self.m)]) * cells
+        self.zeros = array("B", [self.m]) * cells
+    
+    def memory_bytes(self) -> int:
+        cells = self.rows * self.width
+        return len(self.registers) + cells * 9
+    
+    def _cells(self, key_hash: int) -> List[int]:
+        key_hash &= HASH_MASK
+        width = self.width
+        return [row * width + (key_hash >> (16 * row)) % width for row in range(self.rows)]
+    
+    def _estimate(self, cell: int) -> float:
+        m = self.m
+        estimate = self.alpha * m * m / self.inv_sum[cell]
+        zeros = self.zeros[cell]
+        if zeros and estimate <= 2.5 * m:
+            estimate = m * math.log(m / zeros)
+        return estimate
+    
+    def add(self, key_hash: int, item_hash: int) -> float:
+        """Add an item under a key; return the key's new estimate, or 0 if unchanged."""
+        m = self.m
+        item_hash &= HASH_MASK
+        register = item_hash & (m - 1)
+        rest = item_hash >> self.shift
+        rank = (rest & -rest).bit_length() if rest else 65 - self.shift
+        registers, inv_sum, zeros = self.registers, self.inv_sum, self.zeros
+        cells = self._cells(key_hash)
+        changed = False
+        for cell in cells:
+            index = cell * m + register
+            old = registers[index]
+            if rank > old:
+                registers[index] = rank
+                inv_sum[cell] += 2.0 ** -rank - 2.0 ** -old
+                if not old:
+                    zeros[cell] -= 1
+                changed = True
+        if not changed:
+            return 0
+        return min(self._estimate(cell) for cell in cells)
+    
+    def estimate(self, key_hash: int) -> float:
+        return min(self._estimate(cell) for cell in self._cells(key_hash))
+
+
+class SharedSpreadSketch(SpreadSketch):
+    """A SpreadSketch in memory shared with capture workers forked after it.
+    
+    Capture shards each see their own sources, so the per-destination
+    sketches are shared for them to count every source. Registers only
+    grow, and two workers racing on one register can at worst lose the
+    lower rank, which HyperLogLog tolerates. Estimates are therefore
+    computed from the registers, not from per-process running sums.
+    """
+    __slots__ = ("epoch",)
+    
+    def __init__(self, ctx, rows: int = SKETCH_ROWS, width: int = SKETCH_WIDTH,
+                 registers: int = HLL_REGISTERS):
+        self.epoch = ctx.Value("q", -1)
+        self.registers = mmap.mmap(-1, rows * width * registers)   # anonymous, MAP_SHARED
+        super().__init__(rows, width, registers)
+    
+    def rotate(self, epoch: int):
+        """Start window ``epoch``; the first worker to get there clears it for all."""
+        with self.epoch.get_lock():
+            if epoch > self.epoch.value:
+                self.epoch.value = epoch
+                self.reset()
+    
+    def reset(self):
+        self.registers[:] = bytes(len(self.registers))
+    
+    def memory_bytes(self) -> int:
+        return len(self.registers)
+    
+    def _estimate(self, cell: int) -> float:
+        m = self.m
+        registers = self.registers[cell * m:(cell + 1) * m]
+        estimate = self.alpha * m * m / sum(2.0 ** -rank for rank in registers)
+        zeros = registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            estimate = m * math.log(m / zeros)
+        return estimate
+    
+    def add(self, key_hash: int, item_hash: int) -> float:
+        m = self.m
+        item_hash &= HASH_MASK
+        register = item_hash & (m - 1)
+        rest = item_hash >> self.shift
+        rank = (rest & -rest).bit_length() if rest else 65 - self.shift
+        registers = self.registers
+        cells = self._cells(key_hash)
+        changed = False
+        for cell in cells:
+            index = cell * m + register
+            if rank > registers[index]:
+                registers[index] = rank
+                changed = True
+        if not changed:
+            return 0
+        return min(self._estimate(cell) for cell in cells)
+
+
+class CountMinSketch:
+    """Approximate counts per key in fixed memory, with conservative update.
+    
+    Estimates never undercount; with probability 1 - e^-rows the overcount
+    is at most e/width of everything added since the last reset.
+    """
+    __slots__ = ("rows", "width", "counters")
+    
+    def __init__(self, rows: int = CM_ROWS, width: int = CM_WIDTH):
+        self.rows = rows
+        self.width = width
+        self.reset()
+    
+    def reset(self):
+        self.counters = array("I", [0]) * (self.rows * self.width)
+    
+    def memory_bytes(self) -> int:
+        return self.counters.itemsize * len(self.counters)
+    
+    def add(self, key_hash: int) -> int:
+        """Count one event for a key; return its estimated count."""
+        key_hash &= HASH_MASK
+        counters, width = self.counters, self.width
+        cells = [row * width + (key_hash >> (16 * row)) % width for row in range(self.rows)]
+        count = min([counters[cell] for cell in cells]) + 1
+        for cell in cells:
+            if counters[cell] < count:
+                counters[cell] = count
+        return count
+
+
+class SketchDetector(ThreatDetector):
+    """Fixed-memory detector for links with very many active sources.
+    
+    Per-window sketches replace the per-source tables. Spread sketches count
+    distinct ports per source, hosts per source and port, and service ports
+    and sources per destination; the last pair catches distributed scans
+    that no single source reveals. A Count-Min sketch counts packets per
+    source, with the heaviest sources of the window kept in a top-k list.
+    
+    Windows are tumbling rather than sliding, so a burst that straddles a
+    window boundary is counted in two halves. Memory is the same for ten
+    sources or ten million; only alert cooldowns are kept per source,
+    bounded as in ThreatDetector.
+    """
+    
+    def __init__(self, logger: logging.Logger,
+                 max_sources: int = DETECTOR_MAX_SOURCES,
+                 memory_budget: int = DETECTOR_MEMORY_MB << 20,
+                 score_weights: Optional[Dict[str, int]] = None):
+        super().__init__(logger, max_sources, memory_budget, score_weights)
+        self.src_ports = SpreadSketch()
+        self.src_hosts = SpreadSketch()
+        self.dst_ports = SpreadSketch()
+        self.dst_sources = SpreadSketch()
+        self.packet_counts = CountMinSketch()
+        self.heavy_hitters: Dict[bytes, int] = {}
+        self._hitter_floor = 0
+        self._scan_epoch = -1
+        self._rate_epoch = -1
+    
+    def _rotate(self, now: float):
+        """Start new sketch windows once ``now`` crosses a window boundary."""
+        scan_epoch = int(now // PORTSCAN_WINDOW)
+        if scan_epoch > self._scan_epoch:
+            self._scan_epoch = scan_epoch
+            for sketch in (self.src_ports, self.src_hosts, self.dst_ports, self.dst_sources):
+                sketch.rotate(scan_epoch)
+        rate_epoch = int(now // DDOS_WINDOW)
+        if rate_epoch > self._rate_epoch:
+            self._rate_epoch = rate_epoch
+            if self.heavy_hitters:
+                top = sorted(self.heavy_hitters.items(), key=lambda kv: -kv[1])[:5]
+                self.logger.debug(f"Top sources: {', '.join(f'{format_ip(ip)} ({n})' for ip, n in top)}")
+            self.packet_counts.reset()
+            self.heavy_hitters = {}
+            self._hitter_floor = 0
+    
+    def _track_heavy_hitter(self, src_ip: bytes, count: int):
+        hitters = self.heavy_hitters
+        if src_ip in hitters or len(hitters) < HEAVY_HITTERS:
+            hitters[src_ip] = count
+        elif count > self._hitter_floor:
+            del hitters[min(hitters, key=hitters.get)]
+            hitters[src_ip] = count
+            self._hitter_floor = min(hitters.values())
+    
+    def state_bytes(self) -> int:
+        return (sum(sketch.memory_bytes() for sketch in (
+                    self.src_ports, self.src_hosts, self.dst_ports,
+                    self.dst_sources, self.packet_counts))
+                + len(self.rate_limiter) * RATE_LIMIT_ENTRY_BYTES)
+    
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "detector_top_source_packets": max(self.heavy_hitters.values(), default=0),
+        }
+    
+    def analyze_packet(self, src_ip: bytes, dst_ip: bytes, src_port: int,
+                       dst_port: int, protocol: str, local_ip: bytes,
+                       now: Optional[float] = None) -> List[Alert]:
+        alerts = []
+        if now is None:
+            now = time.time()
+        self._rotate(now)
+        src_hash = hash(src_ip)
+        
+        if dst_port:
+            # Items are the bare port, so sources sharing a cell only inflate
+            # each other's count with ports the other source really used.
+            # Hashed as bytes: tuple hashes of consecutive ports share too
+            # many bits for HyperLogLog ranks, undercounting scans ~3x
+            port_hash = hash(dst_port.to_bytes(2, "big"))
+            
+            # PORT SCAN DETECTION
+            ports = self.src_ports.add(src_hash, port_hash)
+            if ports >= PORTSCAN_THRESHOLD:
+                if not self._rate_limited(("portscan", src_ip), now=now):
+                    self.alert_count += 1
+                    alerts.append(Alert(
+                        signature_id=f"SNSM-PORTSCAN-{self.alert_count}",
+                        signature_name=f"Port scan detected ({round(ports)} ports)",
+                        severity="high",
+                        category="Port Scan Detected",
+                        src_ip=src_ip, dst_ip=dst_ip,
+                        src_port=src_port, dst_port=dst_port,
+                        protocol=protocol
+                    ))
+            
+            # HOST SWEEP DETECTION (one port across many hosts)
+            if src_ip != local_ip:
+                hosts = self.src_hosts.add(hash((src_ip, dst_port)), hash(dst_ip))
+                if hosts >= HOSTSCAN_THRESHOLD:
+                    if not self._rate_limited(("hostscan", src_ip, dst_port), now=now):
+                        self.alert_count += 1
+                        alerts.append(Alert(
+                            signature_id=f"SNSM-HOSTSCAN-{self.alert_count}",
+                            signature_name=f"Host sweep detected ({round(hosts)} hosts on port {dst_port})",
+                            severity="high",
+                            category="Port Scan Detected",
+                            src_ip=src_ip, dst_ip=dst_ip,
+                            src_port=src_port, dst_port=dst_port,
+                            protocol=protocol
+                        ))
+            
+            # DISTRIBUTED SCAN DETECTION (many sources, one destination)
+            if dst_port < EPHEMERAL_PORT_MIN:
+                dst_hash = hash(dst_ip)
+                self.dst_sources.add(dst_hash, src_hash)
+                ports = self.dst_ports.add(dst_hash, port_hash)
+                if ports >= DISTRIBUTED_SCAN_PORTS:
+                    sources = self.dst_sources.estimate(dst_hash)
+                    key = ("distscan", dst_ip)
+                    if (sources >= DISTRIBUTED_SCAN_SOURCES
+                            and not self._rate_limited(key, now=now)):
+                        self.alert_count += 1
+                        alerts.append(Alert(
+                            signature_id=f"SNSM-DISTSCAN-{self.alert_count}",
+                            signature_name=(f"Distributed port scan ({round(ports)} ports "
+                                            f"from ~{round(sources)} sources)"),
+                            severity="high",
+                            category="Port Scan Detected",
+                            src_ip=src_ip, dst_ip=dst_ip,
+                            src_port=src_port, dst_port=dst_port,
+                            protocol=protocol, cooldown=(key, 60)
+                        ))
+        
+        # DDoS DETECTION
+        packets = self.packet_counts.add(src_hash)
+        if packets > self._hitter_floor:
+            self._track_heavy_hitter(src_ip, packets)
+        if packets >= DDOS_THRESHOLD:
+            if not self._rate_limited(("ddos", src_ip), now=now):
+                self.alert_count += 1
+                alerts.append(Alert(
+                    signature_id=f"SNSM-DDOS-{self.alert_count}",
+                    signature_name=f"High packet rate ({packets} pkts/{DDOS_WINDOW}s)",
+                    severity="critical",
+                    category="DDoS Attack Detected",
+                    src_ip=src_ip, dst_ip=dst_ip,
+                    src_port=src_port, dst_port=dst_port,
+                    protocol=protocol
+                ))
+        
+        self._check_ports(alerts, src_ip, dst_ip, src_port, dst_port,
+                          protocol, local_ip, now)
+        if self.blocklist is not None and self.blocklist.entries:
+            self._check_blocklist(alerts, src_ip, dst_ip, src_port, dst_port, protocol, now)
+        
+        if alerts:
+            self._evict(now)
+        return alerts
+
+
+DETECTORS = {"exact": ThreatDetector, "sketch": SketchDetector}
+
+# ============================================================================
+# SIGNATURE ENGINE (--rules)
+# ============================================================================
+
+@dataclass
+class SignatureRule:
+    """One rule from the rules file."""
+    sid: int
+    msg: str
+    severity: str
+    category: str
+    protocol: str                 # tcp, udp, icmp or ip (any)
+    src_nets: tuple               # (networks, negated networks); no networks = any
+    src_ports: tuple              # allowed (low, high) port ranges
+    dst_nets: tuple
+    dst_ports: tuple
+    contents: List[tuple] = field(default_factory=list)   # (pattern, nocase)
+
+
+RULE_PROTOCOLS = ("tcp", "udp", "icmp", "ip")
+RULE_SEVERITIES = ("critical", "high", "medium", "low")
+# Options accepted but not enforced: content is matched anywhere in the payload
+RULE_IGNORED_OPTIONS = {"rev", "gid", "metadata", "reference", "flow", "fast_pattern",
+                        "depth", "offset", "distance", "within", "target"}
+
+
+def _split_list(text: str) -> List[str]:
+    """Split a comma-separated list at the top bracket level."""
+    items, depth, start = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch == "[":
+            depth += 1
+        elif ch == "]":
+            depth -= 1
+        elif ch == "," and not depth:
+            items.append(text[start:i])
+            start = i + 1
+    items.append(text[start:])
+    return [item for item in items if item]
+
+
+def _expand_vars(spec: str, variables: Dict[str, str]) -> str:
+    for _ in range(10):
+        if "$" not in spec:
+            return spec
+        try:
+            spec = re.sub(r"\$(\w+)", lambda m: variables[m.group(1)], spec)
+        except KeyError as e:
+            raise ValueError(f"unknown variable ${e.args[0]}")
+    raise ValueError("variables nested too deeply")
+
+
+def _list_items(spec: str) -> tuple:
+    """Return (negated, items) for an address or port field."""
+    negated = spec.startswith("!")
+    body = spec[1:] if negated else spec
+    if body.startswith("["):
+        if not body.endswith("]"):
+            raise ValueError(f"unterminated list {spec!r}")
+        return negated, _split_list(body[1:-1])
+    return negated, [body]
+
+
+def _parse_addresses(spec: str) -> tuple:
+    """Return (networks, negated networks) for an address field."""
+    negated, items = _list_items(spec)
+    networks, excluded, any_seen = [], [], False
+    for item in items:
+        if item.startswith("[") or item.startswith("!["):
+            inner, inner_excluded = _parse_addresses(item)
+            networks += inner
+            excluded += inner_excluded
+            any_seen = any_seen or not inner
+        elif item == "any":
+            any_seen = True
+        else:
+            try:
+                network = ipaddress.ip_network(item.lstrip("!"), strict=False)
+            except ValueError:
+                raise ValueError(f"bad address {item!r}")
+            (excluded if item.startswith("!") else networks).append(network)
+    if any_seen:
+        networks = []
+    if negated:
+        if excluded or not networks:
+            raise ValueError(f"cannot negate {spec!r}")
+        return [], networks
+    return networks, excluded
+
+
+def _port_range(text: str) -> tuple:
+    low, sep, high = text.partition(":")
+    try:
+        low = int(low) if low else 0
+        high = (int(high) if high else 65535) if sep else low
+    except ValueError:
+        raise ValueError(f"bad port {text!r}")
+    if not 0 <= low <= high <= 65535:
+        raise ValueError(f"bad port range {text!r}")
+    return low, high
+
+
+def _subtract_ranges(ranges: List[tuple], holes: List[tuple]) -> List[tuple]:
+    for hole_low, hole_high in holes:
+        remaining = []
+        for low, high in ranges:
+            if hole_high < low or hole_low > high:
+                remaining.append((low, high))
+                continue
+            if low < hole_low:
+                remaining.append((low, hole_low - 1))
+            if hole_high < high:
+                remaining.append((hole_high + 1, high))
+        ranges = remaining
+    return ranges
+
+
+def _parse_ports(spec: str) -> tuple:
+    """Return the sorted, non-overlapping (low, high) ranges a port field allows."""
+    negated, items = _list_items(spec)
+    allowed, excluded = [], []
+    for item in items:
+        if item.startswith("[") or item.startswith("!["):
+            allowed += _parse_ports(item)
+        elif item == "any":
+            allowed.append((0, 65535))
+        elif item.startswith("!"):
+            excluded.append(_port_range(item[1:]))
+        else:
+            allowed.append(_port_range(item))
+    allowed = _subtract_ranges(allowed or [(0, 65535)], excluded)
+    if negated:
+        allowed = _subtract_ranges([(0, 65535)], allowed)
+    merged = []
+    for low, high in sorted(allowed):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    if not merged:
+        raise ValueError(f"port field {spec!r} matches nothing")
+    return tuple(merged)
+
+
+def _split_options(text: str) -> Iterator[tuple]:
+    """Yield (keyword, value) from a rule's option list, honouring quotes and escapes."""
+    option, quoted, escaped = [], False, False
+    for ch in text:
+        if escaped:
+            option.append(ch)
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif ch == '"':
+            quoted = not quoted
+            option.append(ch)
+        elif ch == ";" and not quoted:
+            keyword, _, value = "".join(option).partition(":")
+            if keyword.strip():
+                yield keyword.strip(), value.strip()
+            option = []
+        else:
+            option.append(ch)
+    if quoted:
+        raise ValueError("unterminated string in options")
+    keyword, _, value = "".join(option).partition(":")
+    if keyword.strip():
+        yield keyword.strip(), value.strip()
+
+
+def _unquote(value: str) -> str:
+    if len(value) < 2 or value[0] != '"' or value[-1] != '"':
+        raise ValueError(f"expected a quoted string, got {value!r}")
+    return value[1:-1]
+
+
+def _decode_content(value: str) -> bytes:
+    """Decode a content string: text with |hex bytes| sections."""
+    if value.startswith("!"):
+        raise ValueError("negated content is not supported")
+    parts = _unquote(value).split("|")
+    if len(parts) % 2 == 0:
+        raise ValueError(f"unbalanced | in content {value}")
+    pattern = bytearray()
+    for i, part in enumerate(parts):
+        try:
+            pattern += bytes.fromhex(part) if i % 2 else part.encode()
+        except ValueError:
+            raise ValueError(f"bad hex in content {value}")
+    if not pattern:
+        raise ValueError("empty content")
+    return bytes(pattern)
+
+
+def _parse_rule(line: str, variables: Dict[str, str]) -> List[SignatureRule]:
+    header, paren, options = line.partition("(")
+    options = options.rstrip()
+    if not paren or not options.endswith(")"):
+        raise ValueError("missing option list")
+    header = re.sub(r"\s*,\s*", ",", header)
+    header = re.sub(r"\[\s+", "[", re.sub(r"\s+\]", "]", header))
+    fields = header.split()
+    if len(fields) != 7:
+        raise ValueError("expected: alert <proto> <src> <port> -> <dst> <port> (...)")
+    action, protocol, src, src_port, direction, dst, dst_port = fields
+    if action != "alert":
+        raise ValueError(f"unsupported action {action!r}")
+    if protocol not in RULE_PROTOCOLS:
+        raise ValueError(f"unsupported protocol {protocol!r}")
+    if direction not in ("->", "<>"):
+        raise ValueError(f"bad direction {direction!r}")
+    
+    sid, msg, category, severity, priority, contents = None, "", "Signature Match", None, None, []
+    for keyword, value in _split_options(options[:-1]):
+        if keyword == "msg":
+            msg = _unquote(value)
+        elif keyword == "sid":
+            sid = int(value)
+        elif keyword == "content":
+            contents.append((_decode_content(value), False))
+        elif keyword == "nocase":
+            if not contents:
+                raise ValueError("nocase before any content")
+            contents[-1] = (contents[-1][0].lower(), True)
+        elif keyword == "classtype":
+            category = value
+        elif keyword == "priority":
+            priority = int(value)
+        elif keyword == "severity":
+            if value not in RULE_SEVERITIES:
+                raise ValueError(f"severity must be one of {', '.join(RULE_SEVERITIES)}")
+            severity = value
+        elif keyword not in RULE_IGNORED_OPTIONS:
+            raise ValueError(f"unsupported option {keyword!r}")
+    if sid is None:
+        raise ValueError("rule has no sid")
+    if severity is None:
+        # Suricata priorities: 1 is the most severe
+        severity = ("medium" if priority is None else "high" if priority <= 1
+                    else "medium" if priority == 2 else "low")
+    
+    rule = SignatureRule(
+        sid=sid, msg=msg or f"Signature {sid}", severity=severity, category=category,
+        protocol=protocol,
+        src_nets=_parse_addresses(_expand_vars(src, variables)),
+        src_ports=_parse_ports(_expand_vars(src_port, variables)),
+        dst_nets=_parse_addresses(_expand_vars(dst, variables)),
+        dst_ports=_parse_ports(_expand_vars(dst_port, variables)),
+        contents=contents,
+    )
+    if direction == "<>":
+        return [rule, replace(rule, src_nets=rule.dst_nets, src_ports=rule.dst_ports,
+                              dst_nets=rule.src_nets, dst_ports=rule.src_ports)]
+    return [rule]
+
+
+def parse_rules(text: str, logger: Optional[logging.Logger] = None) -> tuple:
+    """Parse a rules file; return (rules, number of lines skipped).
+    
+    Lines are a Suricata subset: ``var NAME value`` definitions and
+    ``alert <proto> <src> <port> -> <dst> <port> (options)`` rules. A line
+    that cannot be parsed is skipped with a warning rather than failing the
+    whole file.
+    """
+    variables = dict(SIGNATURE_VARS)
+    rules, sids, skipped = [], set(), 0
+    pending, start = "", 0
+    lines = []
+    for number, raw in enumerate(text.splitlines(), 1):
+        line = raw.strip()
+        if not pending:
+            start = number
+        if line.endswith("\\"):
+            pending += line[:-1] + " "
+            continue
+        line, pending = pending + line, ""
+        if line and not line.startswith("#"):
+            lines.append((start, line))
+    
+    for number, line in lines:
+        try:
+            keyword = line.split(None, 1)[0]
+            if keyword in ("var", "ipvar", "portvar"):
+                parts = line.split(None, 2)
+                if len(parts) != 3:
+                    raise ValueError(f"expected: {keyword} NAME value")
+                variables[parts[1].lstrip("$")] = re.sub(r"\s*,\s*", ",", parts[2])
+                continue
+            parsed = _parse_rule(line, variables)
+            if parsed[0].sid in sids:
+                raise ValueError(f"duplicate sid {parsed[0].sid}")
+            sids.add(parsed[0].sid)
+            rules += parsed
+        except ValueError as e:
+            skipped += 1
+            if logger:
+                logger.warning(f"Rules line {number}: {e}; skipped")
+    return rules, skipped
+
+
+class AhoCorasick:
+    """Multi-pattern byte search compiled to a DFA.
+    
+    ``scan`` does one table lookup per payload byte however many patterns
+    there are, and returns the OR of the bits of the patterns it saw. Bytes
+    that occur in no pattern share one column, which keeps a row per state
+    down to the pattern alphabet instead of 256 entries.
+    """
+    __slots__ = ("classes", "rows", "out")
+    
+    def __init__(self, patterns: List[tuple]):
+        symbols = sorted({byte for pattern, _ in patterns for byte in pattern})
+        self.classes = bytearray(256)           # byte -> column; 0 = in no pattern
+        for column, byte in enumerate(symbols, 1):
+            self.classes[byte] = column
+        width = len(symbols) + 1
+        
+        goto, out = [{}], [0]
+        for pattern, bit in patterns:
+            state = 0
+            for column in pattern.translate(self.classes):
+                nxt = goto[state].get(column)
+                if nxt is None:
+                    nxt = goto[state][column] = len(goto)
+                    goto.append({})
+                    out.append(0)
+                state = nxt
+            out[state] |= bit
+        
+        rows = [None] * len(goto)
+        rows[0] = array("I", [0]) * width
+        for column, nxt in goto[0].items():
+            rows[0][column] = nxt
+        fail = [0] * len(goto)
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            fallback = rows[fail[state]]
+            row = array("I", fallback)
+            for column, nxt in goto[state].items():
+                row[column] = nxt
+                fail[nxt] = fallback[column]
+                pending.append(nxt)
+            rows[state] = row
+            out[state] |= out[fail[state]]
+        self.rows = rows
+        self.out = out
+    
+    def memory_bytes(self) -> int:
+        return sum(len(row) for row in self.rows) * 4
+    
+    def scan(self, data: bytes) -> int:
+        rows, out = self.rows, self.out
+        state = found = 0
+        for column in data.translate(self.classes):
+            state = rows[state][column]
+            if out[state]:
+                found |= out[state]
+        return found
+
+
+class PrefixIndex:
+    """Bitmask of the rules whose address field contains an address.
+    
+    Networks are bucketed by family and prefix length, so a lookup costs one
+    dict probe per distinct prefix length in the rules, not one per rule.
+    """
+    
+    def __init__(self):
+        self.any = 0                      # rules with no positive networks
+        self._include = {4: {}, 6: {}}    # family -> prefix length -> network -> mask
+        self._exclude = {4: {}, 6: {}}
+    
+    def add(self, bit: int, nets: tuple):
+        networks, excluded = nets
+        if not networks:
+            self.any |= bit
+        for tables, group in ((self._include, networks), (self._exclude, excluded)):
+            for network in group:
+                by_length = tables[network.version].setdefault(network.prefixlen, {})
+                key = int(network.network_address) >> (network.max_prefixlen - network.prefixlen)
+                by_length[key] = by_length.get(key, 0) | bit
+    
+    def compile(self):
+        """Freeze the buckets into (shift, table) lists for lookup."""
+        def shifts(tables, bits):
+            return [(bits - length, table) for length, table in sorted(tables.items())]
+        self._lookup = {          # keyed by packed address size
+            4: (shifts(self._include[4], 32), shifts(self._exclude[4], 32)),
+            16: (shifts(self._include[6], 128), shifts(self._exclude[6], 128)),
+        }
+    
+    def lookup(self, ip: bytes) -> int:
+        include, exclude = self._lookup[len(ip)]
+        if not include and not exclude:
+            return self.any
+        value = int.from_bytes(ip, "big")
+        mask = self.any
+        for shift, table in include:
+            mask |= table.get(value >> shift, 0)
+        for shift, table in exclude:
+            if mask:
+                mask &= ~table.get(value >> shift, 0)
+        return mask
+
+
+def _port_table(entries: List[tuple]) -> list:
+    """Per-port bitmask of the rules whose (bit, ranges) allow that port."""
+    adds, removes = {}, {}
+    for bit, ranges in entries:
+        for low, high in ranges:
+            adds[low] = adds.get(low, 0) | bit
+            removes[high + 1] = removes.get(high + 1, 0) | bit
+    table = [0] * 65536
+    mask = 0
+    points = sorted(set(adds) | set(removes))
+    for i, point in enumerate(points):
+        if point > 65535:
+            break
+        mask = (mask & ~removes.get(point, 0)) | adds.get(point, 0)
+        end = points[i + 1] if i + 1 < len(points) else 65536
+        table[point:end] = [mask] * (end - point)
+    return table
+
+
+def _bits(mask: int) -> Iterator[int]:
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class RuleSet:
+    """Signature rules compiled for per-packet matching.
+    
+    Each header field narrows a bitmask of candidate rules (bit i is rule i):
+    protocol and ports are single table reads, each address one dict probe
+    per distinct prefix length, and payload patterns go through a single
+    Aho-Corasick pass only when a candidate that survived the header checks
+    has content. No step loops over the rules.
+    """
+    
+    def __init__(self, rules: List[SignatureRule]):
+        self.rules = rules
+        self.count = len({rule.sid for rule in rules})
+        any_protocol = 0
+        by_protocol = {"tcp": 0, "udp": 0, "icmp": 0}
+        self.src_nets, self.dst_nets = PrefixIndex(), PrefixIndex()
+        src_ports, dst_ports = [], []
+        pattern_bits: Dict[tuple, int] = {}
+        self.pattern_rules: List[int] = []       # pattern -> rules that use it
+        self.required = [0] * len(rules)         # pattern bits each rule needs
+        self.content_rules = self.case_rules = self.nocase_rules = 0
+        self.multi_content = 0                   # rules with more than one pattern
+        
+        for i, rule in enumerate(rules):
+            bit = 1 << i
+            if rule.protocol == "ip":
+                any_protocol |= bit
+            else:
+                by_protocol[rule.protocol] |= bit
+            self.src_nets.add(bit, rule.src_nets)
+            self.dst_nets.add(bit, rule.dst_nets)
+            src_ports.append((bit, rule.src_ports))
+            dst_ports.append((bit, rule.dst_ports))
+            for content in rule.contents:
+                if content not in pattern_bits:
+                    pattern_bits[content] = 1 << len(pattern_bits)
+                    self.pattern_rules.append(0)
+                pattern_bit = pattern_bits[content]
+                self.pattern_rules[pattern_bit.bit_length() - 1] |= bit
+                self.required[i] |= pattern_bit
+                self.content_rules |= bit
+                if content[1]:
+                    self.nocase_rules |= bit
+                else:
+                    self.case_rules |= bit
+            if len(rule.contents) > 1:
+                self.multi_content |= bit
+        
+        self.protocols = {name: mask | any_protocol for name, mask in by_protocol.items()}
+        self.other_protocols = any_protocol
+        self.src_nets.compile()
+        self.dst_nets.compile()
+        self.src_ports = _port_table(src_ports)
+        self.dst_ports = _port_table(dst_ports)
+        self.case_automaton = AhoCorasick(
+            [(pattern, bit) for (pattern, nocase), bit in pattern_bits.items() if not nocase])
+        self.nocase_automaton = AhoCorasick(
+            [(pattern, bit) for (pattern, nocase), bit in pattern_bits.items() if nocase])
+    
+    def memory_bytes(self) -> int:
+        return self.case_automaton.memory_bytes() + self.nocase_automaton.memory_bytes()
+    
+    def match(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+              protocol: str, frame, payload_offset: int) -> List[SignatureRule]:
+        candidates = (self.protocols.get(protocol, self.other_protocols)
+                      & self.dst_ports[dst_port] & self.src_ports[src_port])
+        if candidates:
+            candidates &= self.dst_nets.lookup(dst_ip)
+        if candidates:
+            candidates &= self.src_nets.lookup(src_ip)
+        if not candidates:
+            return []
+        
+        needs_payload = candidates & self.content_rules
+        if needs_payload:
+            candidates ^= needs_payload
+            payload = b""
+            if frame is not None:
+                payload = bytes(frame[payload_offset:payload_offset + SIGNATURE_INSPECT_BYTES])
+            if payload:
+                found = 0
+                if needs_payload & self.case_rules:
+                    found |= self.case_automaton.scan(payload)
+                if needs_payload & self.nocase_rules:
+                    found |= self.nocase_automaton.scan(payload.lower())
+                # Work from the patterns seen, not the rules waiting on them
+                hits = 0
+                for pattern in _bits(found):
+                    hits |= self.pattern_rules[pattern]
+                hits &= needs_payload
+                for i in _bits(hits & self.multi_content):
+                    if self.required[i] & ~found:
+                        hits ^= 1 << i
+                candidates |= hits
+        return [self.rules[i] for i in _bits(candidates)]
+
+
+class SignatureEngine:
+    """Rules loaded from a file and recompiled when the file changes.
+    
+    A reload compiles a new RuleSet off to the side and swaps it in with one
+    assignment, so packets keep matching the old rules until the new ones
+    are ready. A file that cannot be read leaves the old rules in place.
+    """
+    
+    def __init__(self, path: str, logger: logging.Logger):
+        self.path = path
+        self.logger = logger
+        self.ruleset = RuleSet([])
+        self.skipped = 0
+        self.reloads = 0
+        self._stamp = ()                  # (mtime, size) of the loaded file
+        self.maybe_reload()
+    
+    def maybe_reload(self) -> bool:
+        """Recompile the rules if the file changed since the last load."""
+        try:
+            st = os.stat(self.path)
+            stamp = (st.st_mtime_ns, st.st_size)
+        except OSError:
+            stamp = None
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError) as e:
+            self.logger.error(f"Cannot read rules {self.path}: {e}; keeping "
+                              f"{self.ruleset.count} loaded rules")
+            return False
+        started = time.perf_counter()
+        rules, skipped = parse_rules(text, self.logger)
+        ruleset = RuleSet(rules)
+        self.ruleset, self.skipped = ruleset, skipped
+        self.reloads += 1
+        self.logger.info(
+            f"Loaded {ruleset.count} signature rules from {self.path}"
+            f"{f' ({skipped} skipped)' if skipped else ''} in "
+            f"{(time.perf_counter() - started) * 1000:.0f} ms"
+        )
+        return True
+    
+    def match(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+              protocol: str, frame, payload_offset: int) -> List[SignatureRule]:
+        return self.ruleset.match(src_ip, dst_ip, src_port, dst_port,
+                                  protocol, frame, payload_offset)
+    
+    def stats(self) -> dict:
+        return {
+            "signature_rules": self.ruleset.count,
+            "signature_skipped": self.skipped,
+            "signature_reloads": self.reloads,
+            "signature_automaton_bytes": self.ruleset.memory_bytes(),
+        }
+
+
+# ============================================================================
+# BLOCKLIST
+# ============================================================================
+
+@dataclass
+class BlocklistEntry:
+    network: Any                  # ipaddress.IPv4Network / IPv6Network
+    reason: str
+    source: str
+    expires: Optional[float]      # epoch seconds, None = never
+
+
+def parse_blocklist(records: List[dict], now: float) -> tuple:
+    """Turn agent-blocklist records into entries; return (entries, bad records).
+    
+    Records that have already expired are dropped.
+    """
+    entries, bad = [], 0
+    for record in records:
+        try:
+            network = ipaddress.ip_network(str(record["ip_address"]).strip(), strict=False)
+            expires = record.get("expires_at")
+            if expires:
+                expires = datetime.fromisoformat(expires.replace("Z", "+00:00")).timestamp()
+                if expires <= now:
+                    continue
+        except (KeyError, ValueError, TypeError, AttributeError):
+            bad += 1
+            continue
+        entries.append(BlocklistEntry(network, record.get("reason") or "blocklisted",
+                                      record.get("source") or "", expires or None))
+    return entries, bad
+
+
+class Blocklist:
+    """Known-bad addresses and networks with expiry, for a per-packet check.
+    
+    Entries are held in a ``PrefixTable``: single addresses are one dict
+    probe on the packed address the packet parser produces, networks one
+    probe per distinct prefix length, longest first. The network verdict is
+    then cached per address until the next load.
+    ``load`` builds new tables and swaps them in with one assignment, so
+    capture threads never see a half-built index.
+    """
+    
+    def __init__(self):
+        self.entries: List[BlocklistEntry] = []
+        self.etag = ""
+        self.updates = 0
+        self.not_modified = 0
+        # entries by prefix, address -> network verdict
+        self._tables = (PrefixTable(), {})
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+    
+    def load(self, entries: List[BlocklistEntry]):
+        self._tables = (PrefixTable((entry.network, entry) for entry in entries), {})
+        self.entries = entries
+    
+    def update(self, records: List[dict], etag: str, now: float) -> int:
+        """Replace the entries with a fresh agent-blocklist response; return bad records."""
+        entries, bad = parse_blocklist(records, now)
+        self.load(entries)
+        self.etag = etag
+        self.updates += 1
+        return bad
+    
+    def purge(self, now: float) -> int:
+        """Drop expired entries; return how many went."""
+        live = [e for e in self.entries if e.expires is None or e.expires > now]
+        expired = len(self.entries) - len(live)
+        if expired:
+            self.load(live)
+        return expired
+    
+    def lookup(self, ip: bytes, now: float) -> Optional[BlocklistEntry]:
+        table, verdicts = self._tables
+        entry = table.hosts.get(ip)
+        if entry is None:
+            entry = verdicts.get(ip, verdicts)
+            if entry is verdicts:
+                entry = table.get(ip)
+                if len(verdicts) >= BLOCKLIST_CACHE:
+                    verdicts.clear()
+                verdicts[ip] = entry
+            if entry is None:
+                return None
+        if entry.expires is not None and entry.expires <= now:
+            return None
+        return entry
+    
+    def stats(self) -> dict:
+        return {
+            "blocklist_entries": len(self.entries),
+            "blocklist_updates": self.updates,
+            "blocklist_not_modified": self.not_modified,
+        }
+
+
+class NftBlocklistSync:
+    """Mirror the blocklist into nftables sets in one transaction (--nft-sync).
+    
+    The agent owns ``table inet snsm``: two sets (IPv4 and IPv6) and the
+    chains that drop traffic from and to their members. Every sync deletes
+    and recreates the table in one ``nft -f`` run, which the kernel applies
+    atomically, so there is no moment with a partial set and no rule per
+    address. Expiry is handed to the kernel as per-element timeouts.
+    """
+    
+    def __init__(self, logger: logging.Logger, table: str = NFT_TABLE):
+        self.logger = logger
+        self.table = table
+        self.enabled = True
+        self.synced = 0
+    
+    def script(self, entries: List[BlocklistEntry], now: float) -> str:
+        elements = {4: [], 6: []}
+        # Interval sets reject overlapping elements: keep only the outermost networks
+        for version in (4, 6):
+            networks = sorted((e for e in entries if e.network.version == version),
+                              key=lambda e: (int(e.network.network_address), e.network.prefixlen))
+            last = None
+            for entry in networks:
+                if last is not None and entry.network.subnet_of(last):
+                    continue
+                last = entry.network
+                element = str(entry.network if entry.network.prefixlen < entry.network.max_prefixlen
+                              else entry.network.network_address)
+                if entry.expires is not None:
+                    element += f" timeout {max(1, int(entry.expires - now))}s"
+                elements[version].append(element)
+        
+        t = self.table
+        lines = [
+            f"add table inet {t}",
+            f"delete table inet {t}",
+            f"table inet {t} {{",
+            "  set blocklist4 { type ipv4_addr; flags interval, timeout; }",
+            "  set blocklist6 { type ipv6_addr; flags interval, timeout; }",
+            "  chain input { type filter hook input priority -10; policy accept;",
+            "    ip saddr @blocklist4 drop; ip6 saddr @blocklist6 drop; }",
+            "  chain forward { type filter hook forward priority -10; policy accept;",
+            "    ip saddr @blocklist4 drop; ip6 saddr @blocklist6 drop;",
+            "    ip daddr @blocklist4 drop; ip6 daddr @blocklist6 drop; }",
+            "  chain output { type filter hook output priority -10; policy accept;",
+            "    ip daddr @blocklist4 drop; ip6 daddr @blocklist6 drop; }",
+            "}",
+        ]
+        for version in (4, 6):
+            if elements[version]:
+                lines.append(f"add element inet {t} blocklist{version} {{ "
+                             + ", ".join(elements[version]) + " }")
+        return "\n".join(lines) + "\n"
+    
+    def sync(self, entries: List[BlocklistEntry], now: float) -> bool:
+        if not self.enabled:
+            return False
+        try:
+            result = subprocess.run(["nft", "-f", "-"], input=self.script(entries, now),
+                                    capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self.logger.error(f"nftables sync disabled: {e}")
+            self.enabled = False
+            return False
+        if result.returncode:
+            self.logger.error(f"nftables sync failed: {result.stderr.strip()}")
+            return False
+        self.synced += 1
+        self.logger.info(f"Synced {len(entries)} blocklist entries to nftables table inet {self.table}")
+        return True
+
+
+# ============================================================================
+# PACKET PARSING (raw frames)
+# ============================================================================
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86DD
+ETH_P_8021Q = 0x8100
+ETH_P_8021AD = 0x88A8
+
+ARPHRD_ETHER = 1
+ARPHRD_LOOPBACK = 772
+ARPHRD_NONE = 65534          # tun devices: frames start at the IP header
+ARPHRD_RAWIP = 519
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_CBPF = 6
+
+IPPROTO_NAMES = {6: "tcp", 17: "udp", 1: "icmp"}
+IPV6_EXT_HEADERS = {0, 43, 60}   # hop-by-hop, routing, destination options
+IPV6_FRAGMENT = 44
+
+_unpack_u16 = struct.Struct("!H").unpack_from
+_unpack_ports = struct.Struct("!HH").unpack_from
+_unpack_ipv4 = struct.Struct("!4s4s").unpack_from
+_unpack_ipv6 = struct.Struct("!16s16s").unpack_from
+
+
+def parse_ip(buf, offset: int = 0) -> Optional[tuple]:
+    """Parse an IPv4/IPv6 packet at ``offset`` of ``buf`` (a memoryview).
+
+    Returns ``(src_ip, dst_ip, src_port, dst_port, protocol, payload_offset)``
+    with packed addresses, or None for anything that is not IP.
+    ``payload_offset`` is where the transport payload starts in ``buf``.
+    """
+    version = buf[offset] >> 4
+    if version == 4:
+        proto = buf[offset + 9]
+        src_ip, dst_ip = _unpack_ipv4(buf, offset + 12)
+        l4 = offset + (buf[offset] & 0x0F) * 4
+        if _unpack_u16(buf, offset + 6)[0] & 0x1FFF:
+            # Non-first fragment: no transport header to read
+            return src_ip, dst_ip, 0, 0, "other", l4
+    elif version == 6:
+        proto = buf[offset + 6]
+        src_ip, dst_ip = _unpack_ipv6(buf, offset + 8)
+        l4 = offset + 40
+        while proto in IPV6_EXT_HEADERS:
+            proto = buf[l4]
+            l4 += (buf[l4 + 1] + 1) * 8
+        if proto == IPV6_FRAGMENT:
+            if _unpack_u16(buf, l4 + 2)[0] & 0xFFF8:
+                return src_ip, dst_ip, 0, 0, "other", l4 + 8
+            proto = buf[l4]
+            l4 += 8
+        if proto == 58:
+            proto = 1   # ICMPv6 is reported as plain "icmp"
+    else:
+        return None
+
+    name = IPPROTO_NAMES.get(proto, "other")
+    if proto == 6:
+        src_port, dst_port = _unpack_ports(buf, l4)
+        return src_ip, dst_ip, src_port, dst_port, name, l4 + (buf[l4 + 12] >> 4) * 4
+    if proto == 17:
+        src_port, dst_port = _unpack_ports(buf, l4)
+        return src_ip, dst_ip, src_port, dst_port, name, l4 + 8
+    if proto == 1:
+        return src_ip, dst_ip, 0, 0, name, l4 + 8
+    return src_ip, dst_ip, 0, 0, name, l4
+
+
+def parse_ethernet(buf) -> Optional[tuple]:
+    """Parse an Ethernet II frame (with optional 802.1Q/802.1ad tags)."""
+    ethertype = _unpack_u16(buf, 12)[0]
+    offset = 14
+    while ethertype == ETH_P_8021Q or ethertype == ETH_P_8021AD:
+        ethertype = _unpack_u16(buf, offset + 2)[0]
+        offset += 4
+    if ethertype == ETH_P_IP or ethertype == ETH_P_IPV6:
+        return parse_ip(buf, offset)
+    return None
+
+
+def parse_linux_sll(buf) -> Optional[tuple]:
+    """Parse a Linux "cooked" capture (LINKTYPE_LINUX_SLL) frame."""
+    ethertype = _unpack_u16(buf, 14)[0]
+    if ethertype == ETH_P_IP or ethertype == ETH_P_IPV6:
+        return parse_ip(buf, 16)
+    return None
+
+
+def parse_linux_sll2(buf) -> Optional[tuple]:
+    """Parse a LINKTYPE_LINUX_SLL2 frame."""
+    ethertype = _unpack_u16(buf, 0)[0]
+    if ethertype == ETH_P_IP or ethertype == ETH_P_IPV6:
+        return parse_ip(buf, 20)
+    return None
+
+
+def parse_null(buf) -> Optional[tuple]:
+    """Parse a BSD loopback (LINKTYPE_NULL/LOOP) frame: 4-byte family header."""
+    return parse_ip(buf, 4)
+
+
+# pcap/pcapng link types understood by the offline reader
+LINKTYPE_PARSERS = {
+    0: parse_null, 108: parse_null,
+    1: parse_ethernet,
+    12: parse_ip, 101: parse_ip, 228: parse_ip, 229: parse_ip,
+    113: parse_linux_sll, 276: parse_linux_sll2,
+}
+
+
+def default_interface() -> str:
+    """Interface holding the IPv4 default route (Linux), or '' if unknown."""
+    try:
+        with open("/proc/net/route") as f:
+            next(f)
+            for line in f:
+                fields = line.split()
+                if fields[1] == "00000000" and int(fields[3], 16) & 0x2:
+                    return fields[0]
+    except (OSError, StopIteration, IndexError, ValueError):
+        pass
+    return ""
+
+
+SIOCGIFADDR = 0x8915
+
+
+def interface_ipv4(name: str) -> Optional[bytes]:
+    """Packed IPv4 address of interface ``name`` via SIOCGIFADDR (Linux), or None."""
+    try:
+        import fcntl
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            ifreq = fcntl.ioctl(s.fileno(), SIOCGIFADDR, struct.pack("256s", name.encode()[:15]))
+    except (ImportError, OSError):
+        return None                              # no IPv4 address, or not Linux
+    return ifreq[20:24]
+
+
+def interface_addresses() -> List[bytes]:
+    """Packed addresses of this host's interfaces.
+    
+    Uses psutil when installed; otherwise reads /proc/net/if_inet6 and asks
+    each interface for its IPv4 address (Linux).
+    """
+    try:
+        import psutil
+        addresses = []
+        for addrs in psutil.net_if_addrs().values():
+            for addr in addrs:
+                if addr.family in (socket.AF_INET, socket.AF_INET6):
+                    try:
+                        addresses.append(pack_ip(addr.address))
+                    except OSError:
+                        pass
+        return addresses
+    except ImportError:
+        pass
+    
+    addresses = []
+    try:
+        with open("/proc/net/if_inet6") as f:
+            for line in f:
+                addresses.append(bytes.fromhex(line.split()[0]))
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        names = [name for _, name in socket.if_nameindex()]
+    except (OSError, AttributeError):
+        names = []
+    for name in names:
+        address = interface_ipv4(name)
+        if address is not None:
+            addresses.append(address)
+    return addresses
+
+
+def primary_address(interface: str = "") -> bytes:
+    """Packed IPv4 address of ``interface``, or of the default-route interface.
+    
+    Falls back to the first non-loopback IPv4 interface address, then
+    0.0.0.0. Nothing is sent, so this works on hosts without a route out.
+    """
+    name = interface or default_interface()
+    if name:
+        try:
+            import psutil
+            for addr in psutil.net_if_addrs().get(name, ()):
+                if addr.family == socket.AF_INET:
+                    return pack_ip(addr.address)
+        except ImportError:
+            address = interface_ipv4(name)
+            if address is not None:
+                return address
+    for address in interface_addresses():
+        if len(address) == 4 and address[0] != 127:
+            return address
+    return bytes(4)
+
+
+def local_networks(cidrs: List[str], local_ip: bytes = b"") -> PrefixTable:
+    """Prefix table of local addresses: ``cidrs``, the interfaces and ``local_ip``."""
+    networks = [ipaddress.ip_network(cidr, strict=False) for cidr in cidrs]
+    for address in interface_addresses() + ([local_ip] if local_ip else []):
+        networks.append(ipaddress.ip_network(ipaddress.ip_address(address)))
+    return PrefixTable((network, True) for network in networks)
+
+# ============================================================================
+# KERNEL PACKET FILTER (classic BPF)
+# ============================================================================
+
+SO_ATTACH_FILTER = 26
+DLT_EN10MB = 1
+DLT_RAW = 12
+
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_LD_H_IND = 0x48
+BPF_LDX_B_MSH = 0xB1
+BPF_ALU_AND_K = 0x54
+BPF_ALU_MUL_K = 0x24
+BPF_ALU_RSH_K = 0x74
+BPF_ALU_XOR_X = 0xAC
+BPF_TAX = 0x07
+BPF_JA = 0x05
+BPF_JEQ_K = 0x15
+BPF_JSET_K = 0x45
+BPF_RET_K = 0x06
+BPF_RET_A = 0x16
+BPF_ACCEPT = 0x40000         # snap length returned for accepted packets
+SKF_NET_OFF = 0xFFF00000     # -0x100000: loads relative to the network header
+
+
+@dataclass(frozen=True)
+class ExcludeRule:
+    """Traffic to drop in the kernel: a network, a port, or both (AND)."""
+    network: Optional[Any] = None    # ipaddress.IPv4Network / IPv6Network
+    port: Optional[int] = None
+    
+    def expression(self) -> str:
+        parts = []
+        if self.network is not None:
+            parts.append(f"net {self.network}")
+        if self.port is not None:
+            parts.append(f"port {self.port}")
+        return " and ".join(parts)
+
+
+def parse_exclude(item: str) -> List[ExcludeRule]:
+    """Parse an --exclude item: a port, an IP/CIDR, or a hostname."""
+    item = item.strip()
+    if item.isdigit():
+        port = int(item)
+        if port > 65535:
+            raise ValueError(f"invalid port: {item}")
+        return [ExcludeRule(port=port)]
+    try:
+        return [ExcludeRule(network=ipaddress.ip_network(item, strict=False))]
+    except ValueError:
+        pass
+    try:
+        infos = socket.getaddrinfo(item, None, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ValueError(f"cannot resolve {item}: {e}")
+    addrs = sorted({info[4][0] for info in infos})
+    return [ExcludeRule(network=ipaddress.ip_network(a)) for a in addrs]
+
+
+def backend_exclude_rules(url: str) -> List[ExcludeRule]:
+    """Rules matching the agent's own upload connections to ``url``."""
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    try:
+        infos = socket.getaddrinfo(parts.hostname, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError):
+        return []
+    addrs = sorted({info[4][0] for info in infos})
+    return [ExcludeRule(network=ipaddress.ip_network(a), port=port) for a in addrs]
+
+
+def exclude_expression(rules: List[ExcludeRule]) -> str:
+    return " or ".join(f"({r.expression()})" for r in rules)
+
+
+def _emit_exclude_rule(prog: list, n: int, rule: ExcludeRule, l3: int, v6: bool):
+    """Append the instructions dropping packets matched by ``rule``.
+    
+    Jump targets are label names resolved by compile_exclude_filter(); every
+    jump stays inside the rule so the 8-bit jt/jf offsets never overflow.
+    """
+    nxt, hit, drop = f"next{n}", f"hit{n}", f"drop{n}"
+    net = rule.network
+    if net is not None:
+        if v6:
+            addr = int(net.network_address).to_bytes(16, "big")
+            mask = int(net.netmask).to_bytes(16, "big")
+            for side, side_off in (("src", 8), ("dst", 24)):
+                miss = f"{side}miss{n}" if side == "src" else nxt
+                for i in range(4):
+                    m = int.from_bytes(mask[4 * i:4 * i + 4], "big")
+                    if not m:
+                        break
+                    prog.append((BPF_LD_W_ABS, 0, 0, l3 + side_off + 4 * i))
+                    if m != 0xFFFFFFFF:
+                        prog.append((BPF_ALU_AND_K, 0, 0, m))
+                    prog.append((BPF_JEQ_K, 0, miss,
+                                 int.from_bytes(addr[4 * i:4 * i + 4], "big")))
+                prog.append((BPF_JA, 0, 0, hit))
+                if side == "src":
+                    prog.append(miss)
+        else:
+            value, m = int(net.network_address), int(net.netmask)
+            for side_off, miss in ((12, None), (16, nxt)):
+                prog.append((BPF_LD_W_ABS, 0, 0, l3 + side_off))
+                if m != 0xFFFFFFFF:
+                    prog.append((BPF_ALU_AND_K, 0, 0, m))
+                prog.append((BPF_JEQ_K, hit, miss or 0, value))
+    prog.append(hit)
+    if rule.port is not None:
+        ports = f"ports{n}"
+        prog.append((BPF_LD_B_ABS, 0, 0, l3 + (6 if v6 else 9)))
+        prog.append((BPF_JEQ_K, ports, 0, 6))           # TCP, UDP and SCTP, as in pcap
+        prog.append((BPF_JEQ_K, ports, 0, 17))
+        prog.append((BPF_JEQ_K, ports, nxt, 132))
+        prog.append(ports)
+        if v6:
+            prog.append((BPF_LD_H_ABS, 0, 0, l3 + 40))
+            prog.append((BPF_JEQ_K, drop, 0, rule.port))
+            prog.append((BPF_LD_H_ABS, 0, 0, l3 + 42))
+        else:
+            prog.append((BPF_LD_H_ABS, 0, 0, l3 + 6))
+            prog.append((BPF_JSET_K, nxt, 0, 0x1FFF))
+            prog.append((BPF_LDX_B_MSH, 0, 0, l3))
+            prog.append((BPF_LD_H_IND, 0, 0, l3))
+            prog.append((BPF_JEQ_K, drop, 0, rule.port))
+            prog.append((BPF_LD_H_IND, 0, 0, l3 + 2))
+        prog.append((BPF_JEQ_K, drop, nxt, rule.port))
+    prog.append(drop)
+    prog.append((BPF_RET_K, 0, 0, 0))
+    prog.append(nxt)
+
+
+def compile_exclude_filter(rules: List[ExcludeRule], raw_ip: bool = False) -> List[tuple]:
+    """Compile exclude rules to a classic BPF program without libpcap.
+    
+    Returns ``(code, jt, jf, k)`` tuples for frames starting at the Ethernet
+    header, or at the IP header when ``raw_ip`` is set.
+    """
+    l3 = 0 if raw_ip else 14
+    prog: list = []
+    if raw_ip:
+        prog += [(BPF_LD_B_ABS, 0, 0, 0), (BPF_ALU_AND_K, 0, 0, 0xF0)]
+        v4_tag, v6_tag = 0x40, 0x60
+    else:
+        prog.append((BPF_LD_H_ABS, 0, 0, 12))
+        v4_tag, v6_tag = ETH_P_IP, ETH_P_IPV6
+    prog += [
+        (BPF_JEQ_K, 0, 1, v4_tag), (BPF_JA, 0, 0, "v4"),
+        (BPF_JEQ_K, 0, 1, v6_tag), (BPF_JA, 0, 0, "v6"),
+        (BPF_RET_K, 0, 0, BPF_ACCEPT),
+    ]
+    for family, v6 in (("v4", False), ("v6", True)):
+        prog.append(family)
+        for n, rule in enumerate(rules):
+            if rule.network is not None and (rule.network.version == 6) != v6:
+                continue
+            _emit_exclude_rule(prog, f"{family}_{n}", rule, l3, v6)
+        prog.append((BPF_RET_K, 0, 0, BPF_ACCEPT))
+    
+    # Resolve labels into relative jump offsets
+    labels, code = {}, []
+    for ins in prog:
+        if isinstance(ins, str):
+            labels[ins] = len(code)
+        else:
+            code.append(ins)
+    resolved = []
+    for pc, (op, jt, jf, k) in enumerate(code):
+        if op == BPF_JA:
+            k = labels[k] - pc - 1 if isinstance(k, str) else k
+        else:
+            jt = labels[jt] - pc - 1 if isinstance(jt, str) else jt
+            jf = labels[jf] - pc - 1 if isinstance(jf, str) else jf
+            if jt > 255 or jf > 255:
+                raise ValueError("exclude rule too large for a BPF jump")
+        resolved.append((op, jt, jf, k))
+    return resolved
+
+
+def compile_pcap_filter(expression: str, linktype: int) -> List[tuple]:
+    """Compile a tcpdump-style expression with libpcap's pcap_compile()."""
+    import ctypes
+    import ctypes.util
+    
+    name = ctypes.util.find_library("pcap")
+    if not name:
+        raise ValueError("--filter needs libpcap (e.g. apt install libpcap0.8)")
+    lib = ctypes.CDLL(name)
+    
+    class BpfProgram(ctypes.Structure):
+        _fields_ = [("bf_len", ctypes.c_uint), ("bf_insns", ctypes.c_void_p)]
+    
+    lib.pcap_open_dead.restype = ctypes.c_void_p
+    lib.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+    lib.pcap_compile.argtypes = [ctypes.c_void_p, ctypes.POINTER(BpfProgram),
+                                 ctypes.c_char_p, ctypes.c_int, ctypes.c_uint32]
+    lib.pcap_geterr.restype = ctypes.c_char_p
+    lib.pcap_geterr.argtypes = [ctypes.c_void_p]
+    lib.pcap_freecode.argtypes = [ctypes.POINTER(BpfProgram)]
+    lib.pcap_close.argtypes = [ctypes.c_void_p]
+    
+    handle = lib.pcap_open_dead(linktype, CAPTURE_SNAPLEN)
+    program = BpfProgram()
+    try:
+        if lib.pcap_compile(handle, ctypes.byref(program), expression.encode(),
+                            1, 0xFFFFFFFF) != 0:
+            raise ValueError(f"invalid filter: {lib.pcap_geterr(handle).decode()}")
+        raw = ctypes.string_at(program.bf_insns, program.bf_len * 8)
+        lib.pcap_freecode(ctypes.byref(program))
+    finally:
+        lib.pcap_close(handle)
+    return [struct.unpack_from("HBBI", raw, i * 8) for i in range(len(raw) // 8)]
+
+
+def build_capture_filter(expression: str, rules: List[ExcludeRule],
+                         raw_ip: bool = False) -> Optional[List[tuple]]:
+    """BPF program for --filter/--exclude, or None when nothing is filtered."""
+    if expression:
+        if rules:
+            expression = f"({expression}) and not ({exclude_expression(rules)})"
+        return compile_pcap_filter(expression, DLT_RAW if raw_ip else DLT_EN10MB)
+    if rules:
+        return compile_exclude_filter(rules, raw_ip)
+    return None
+
+
+def _xor_words(offsets: List[int]) -> List[tuple]:
+    """Load the first word into A and XOR the others into it (clobbers X)."""
+    code = [(BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + offsets[0])]
+    for offset in offsets[1:]:
+        code += [(BPF_TAX, 0, 0, 0), (BPF_LD_W_ABS, 0, 0, SKF_NET_OFF + offset),
+                 (BPF_ALU_XOR_X, 0, 0, 0)]
+    return code
+
+
+def compile_fanout_program() -> List[tuple]:
+    """Classic BPF fanout selector hashing on the source address.
+    
+    The kernel takes the return value modulo the number of sockets in the
+    group, so every packet of one source reaches the same worker. Loads are
+    relative to the network header, which is where ``skb->data`` points on
+    receive but not on transmit, and which also covers devices without a
+    link-layer header.
+    """
+    mix = [(BPF_ALU_MUL_K, 0, 0, 0x9E3779B1), (BPF_ALU_RSH_K, 0, 0, 16), (BPF_RET_A, 0, 0, 0)]
+    v4 = _xor_words([12]) + mix                          # source address
+    v6 = _xor_words(list(range(8, 24, 4))) + mix         # 128-bit source address
+    return [
+        (BPF_LD_B_ABS, 0, 0, SKF_NET_OFF),
+        (BPF_ALU_AND_K, 0, 0, 0xF0),                     # IP version nibble
+        (BPF_JEQ_K, 0, len(v4), 0x40),
+        *v4,
+        (BPF_JEQ_K, 0, len(v6), 0x60),
+        *v6,
+        (BPF_RET_K, 0, 0, 0),
+    ]
+
+
+def _sock_fprog(program: List[tuple]):
+    """Pack ``struct sock_fprog``; the returned buffer must outlive setsockopt()."""
+    import ctypes
+    
+    insns = b"".join(struct.pack("HBBI", *ins) for ins in program)
+    buf = ctypes.create_string_buffer(insns, len(insns))
+    # struct sock_fprog { unsigned short len; struct sock_filter *filter; }
+    return struct.pack("HL", len(program), ctypes.addressof(buf)), buf
+
+
+def attach_filter(sock: socket.socket, program: List[tuple]):
+    """Attach a classic BPF program with SO_ATTACH_FILTER."""
+    fprog, _buf = _sock_fprog(program)
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+def join_fanout(sock: socket.socket, group: int):
+    """Join a PACKET_FANOUT group that distributes packets by source address."""
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT, (group & 0xFFFF) | (PACKET_FANOUT_CBPF << 16))
+    fprog, _buf = _sock_fprog(compile_fanout_program())
+    sock.setsockopt(SOL_PACKET, PACKET_FANOUT_DATA, fprog)
 
 # ============================================================================
-# PACKET CAPTURE (with Scapy)
+# PACKET CAPTURE (raw AF_PACKET socket, Scapy fallback)
 # ============================================================================
 
+class OverloadController:
+    """Picks the flow sampling rate from kernel drops and capture lag.
+    
+    Every overloaded tick doubles the rate, up to ``max_rate``; after
+    OVERLOAD_RECOVER_TICKS calm ticks in a row it is halved again. Rates
+    are powers of two, so a flow kept at 1 in 2N is also kept at 1 in N
+    and flows are not reshuffled when the rate steps down.
+    """
+    
+    def __init__(self, max_rate: int = OVERLOAD_MAX_SAMPLING):
+        self.max_rate = max_rate
+        self.rate = 1
+        self._calm = 0
+    
+    def update(self, packets: int, drops: int, lag: float) -> int:
+        """Sampling rate after a tick with these kernel counts and lag (seconds)."""
+        if drops > packets * OVERLOAD_DROP_RATIO or lag > OVERLOAD_LAG:
+            self._calm = 0
+            self.rate = min(self.rate * 2, self.max_rate)
+        else:
+            self._calm += 1
+            if self.rate > 1 and self._calm >= OVERLOAD_RECOVER_TICKS:
+                self._calm = 0
+                self.rate //= 2
+        return self.rate
+
+
 class PacketCapture:
-    def __init__(self, interface: str, logger: logging.Logger, detector: ThreatDetector):
+    def __init__(self, interface: str, logger: logging.Logger, detector: ThreatDetector,
+                 options: Optional[CaptureOptions] = None):
         self.interface = interface
         self.logger = logger
         self.detector = detector
-        self.flows: Dict[str, Flow] = {}
-        self.local_ip = self._get_local_ip()
+        self.options = options or CaptureOptions()
+        self.local_ip = primary_address(interface)
+        self.local_networks = local_networks(self.options.local_networks, self.local_ip)
+        self.flows = FlowTable(self.local_networks.__contains__, self.options.active_timeout,
+                               self.options.idle_timeout)
         self.packet_count = 0
+        self.parse_errors = 0
         self.running = False
-        self.pending_alerts: List[Alert] = []
+        # Alerts are handed to the agent through a lock-free queue
+        self.alert_queue: "queue.SimpleQueue[Alert]" = queue.SimpleQueue()
         self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._kernel_stats = {"kernel_packets": 0, "kernel_drops": 0, "kernel_freeze_q": 0}
+        # Sampled stage timing (--metrics): packet number of the next timed packet
+        self.timings = StageTimings()
+        self._next_sample = self.options.metrics_sample
+        self._parse: Optional[Callable] = None   # the capture loop's parser, re-run when timing
+        # Overload sampling: new flows whose hash is not 0 mod sampling_rate are skipped
+        self.sampling_rate = 1
+        self.sampled_out = 0                     # packets skipped by sampling
+        self.capture_lag = 0.0                   # age of the oldest unread ring block
+        self.overload = OverloadController() if self.options.overload_sampling else None
+        self._last_kernel = (0, 0)
+        # Set by capture workers: PACKET_FANOUT group; periodic loop callback
+        self.fanout_group: Optional[int] = None
+        self._tick: Optional[Callable[[], None]] = (
+            self._adjust_sampling if self.overload is not None else None)
         
-    def _get_local_ip(self) -> str:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "0.0.0.0"
+    def _record_packet(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+                       proto: str, payload_offset: int, length: int, now: float,
+                       frame=None):
+        """Account one parsed packet to its flow and run threat detection."""
+        self.packet_count += 1
+        if self.packet_count == self._next_sample:
+            self._next_sample += self.options.metrics_sample
+            self._account(src_ip, dst_ip, src_port, dst_port, proto, payload_offset,
+                          length, now, frame, time.perf_counter_ns)
+        else:
+            self._account(src_ip, dst_ip, src_port, dst_port, proto, payload_offset,
+                          length, now, frame)
+    
+    def _account(self, src_ip: bytes, dst_ip: bytes, src_port: int, dst_port: int,
+                 proto: str, payload_offset: int, length: int, now: float,
+                 frame=None, clock: Optional[Callable[[], int]] = None):
+        """Threat detection, flow update and signatures for one packet.
+        
+        The detector sees every packet. Under overload sampling, only the
+        flow update and signature matching are skipped for flows left out.
+        A new flow on a malicious port or with a blocklisted address is
+        always kept, at rate 1.
+        
+        With a ``clock`` (one packet in ``metrics_sample``) every stage is
+        timed into ``timings``; the frame is parsed a second time to time
+        the parser.
+        """
+        detector = self.detector
+        rate = self.sampling_rate
+        if rate != 1 and detector.is_critical(src_ip, dst_ip, src_port, dst_port, now):
+            rate = 1
+        if clock:
+            observe = self.timings.observe
+            if self._parse is not None:
+                start = clock()
+                self._parse(frame)
+                observe("parse", clock() - start)
+            start = clock()
+        alerts = detector.analyze_packet(
+            src_ip, dst_ip, src_port, dst_port, proto, self.local_ip, now
+        )
+        if clock:
+            done = clock()
+            observe("analyze", done - start)
+        with self._lock:
+            if clock:
+                acquired = clock()
+            kept = self.flows.update(src_ip, dst_ip, src_port, dst_port, proto, length, now, rate)
+        if clock:
+            start = clock()
+            observe("lock_wait", acquired - done)
+            observe("flow_update", start - acquired)
+        if not kept:
+            self.sampled_out += 1
+        elif detector.signatures is not None:
+            alerts += detector.match_signatures(
+                src_ip, dst_ip, src_port, dst_port, proto, frame, payload_offset, now
+            )
+            if clock:
+                observe("signatures", clock() - start)
+        if alerts:
+            self._emit_alerts(alerts, src_ip)
     
-    def _flow_key(self, src_ip: str, dst_ip: str, src_port: int, 
-                  dst_port: int, proto: str) -> str:
-        return f"{src_ip}:{src_port}->{dst_ip}:{dst_port}:{proto}"
+    def _adjust_sampling(self):
+        """Capture-loop tick: set the sampling rate from this tick's drops and lag."""
+        stats = self.capture_stats()
+        packets, drops = stats["kernel_packets"], stats["kernel_drops"]
+        last_packets, last_drops = self._last_kernel
+        self._last_kernel = (packets, drops)
+        drops -= last_drops
+        lag = self.capture_lag
+        rate = self.overload.update(packets - last_packets, drops, lag)
+        if rate > self.sampling_rate:
+            self.logger.warning(
+                f"Capture overloaded ({drops} kernel drops{f', {lag:.1f}s behind' if lag else ''}): "
+                f"keeping 1 in {rate} flows, counters scaled to match")
+        elif rate < self.sampling_rate:
+            self.logger.info(f"Load easing: keeping 1 in {rate} flows" if rate > 1
+                             else "Load back to normal: flow sampling off")
+        self.sampling_rate = rate
+    
+    def _emit_alerts(self, alerts: List[Alert], src_ip: bytes):
+        for alert in alerts:
+            self.alert_queue.put(alert)
+            self.logger.warning(f"🚨 ALERT: {alert.signature_name} from {format_ip(src_ip)}")
     
     def _process_packet(self, packet):
+        """Scapy engine callback."""
         try:
-            from scapy.all import IP, TCP, UDP, ICMP
+            IP, TCP, UDP, ICMP = self._scapy_layers
             
             if not packet.haslayer(IP):
                 return
             
             ip = packet[IP]
-            src_ip = ip.src
-            dst_ip = ip.dst
+            src_ip = pack_ip(ip.src)
+            dst_ip = pack_ip(ip.dst)
             proto = "other"
             src_port = 0
             dst_port = 0
             
+            layer = ip
             if packet.haslayer(TCP):
                 proto = "tcp"
-                src_port = packet[TCP].sport
-                dst_port = packet[TCP].dport
+                layer = packet[TCP]
+                src_port = layer.sport
+                dst_port = layer.dport
             elif packet.haslayer(UDP):
                 proto = "udp"
-                src_port = packet[UDP].sport
-                dst_port = packet[UDP].dport
+                layer = packet[UDP]
+                src_port = layer.sport
+                dst_port = layer.dport
             elif packet.haslayer(ICMP):
                 proto = "icmp"
+                layer = packet[ICMP]
             
-            length = len(packet)
-            self.packet_count += 1
-            
-            # Create or update flow
-            key = self._flow_key(src_ip, dst_ip, src_port, dst_port, proto)
-            
-            with self._lock:
-                if key not in self.flows:
-                    self.flows[key] = Flow(
-                        src_ip=src_ip, dst_ip=dst_ip,
-                        src_port=src_port, dst_port=dst_port,
-                        protocol=proto
-                    )
-                
-                flow = self.flows[key]
-                flow.end_time = time.time()
+            self._record_packet(src_ip, dst_ip, src_port, dst_port, proto, 0,
+                                len(packet), float(packet.time), bytes(layer.payload))
+                    
+        except Exception as e:
+            self.logger.debug(f"Packet processing error: {e}")
+    
+    def _open_raw_socket(self) -> socket.socket:
+        sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, CAPTURE_RCVBUF)
+        except OSError:
+            pass
+        if self.interface:
+            sock.bind((self.interface, ETH_P_ALL))
+        
+        opts = self.options
+        program = build_capture_filter(opts.filter, opts.exclude, self._is_raw_ip(sock))
+        if program:
+            attach_filter(sock, program)
+            # Discard frames queued before the filter was in place
+            sock.setblocking(False)
+            try:
+                while True:
+                    sock.recv(1)
+            except BlockingIOError:
+                pass
+            sock.setblocking(True)
+            self.logger.info(f"Kernel filter attached ({len(program)} BPF instructions)")
+        return sock
+    
+    @staticmethod
+    def _is_raw_ip(sock: socket.socket) -> bool:
+        return sock.getsockname()[3] in (ARPHRD_NONE, ARPHRD_RAWIP)
+    
+    def _frame_parser(self, sock: socket.socket):
+        """Pick the link-layer parser; also report whether to drop outgoing copies."""
+        parse = parse_ip if self._is_raw_ip(sock) else parse_ethernet
+        # Loopback delivers every frame twice (outgoing + host); keep one copy
+        return parse, sock.getsockname()[3] == ARPHRD_LOOPBACK
+    
+    def _capture_raw(self):
+        """Read frames from an AF_PACKET socket and parse them in place."""
+        sock = self._open_raw_socket()
+        sock.settimeout(CAPTURE_TICK)
+        parse, skip_outgoing = self._frame_parser(sock)
+        self._parse = parse
+        self._sock = sock
+        if self.fanout_group is not None:
+            join_fanout(sock, self.fanout_group)
+        
+        buf = bytearray(CAPTURE_SNAPLEN)
+        view = memoryview(buf)
+        recv_into = sock.recv_into
+        recvfrom_into = sock.recvfrom_into
+        record = self._record_packet
+        tick = self._tick
+        next_tick = time.monotonic() + CAPTURE_TICK
+        
+        self.logger.info(f"Starting packet capture on {self.interface or 'all interfaces'} (raw)...")
+        try:
+            while self.running:
+                if tick is not None and time.monotonic() >= next_tick:
+                    tick()
+                    next_tick = time.monotonic() + CAPTURE_TICK
+                try:
+                    if skip_outgoing:
+                        length, addr = recvfrom_into(buf, CAPTURE_SNAPLEN, socket.MSG_TRUNC)
+                        if addr[2] == socket.PACKET_OUTGOING:
+                            continue
+                    else:
+                        length = recv_into(buf, CAPTURE_SNAPLEN, socket.MSG_TRUNC)
+                except socket.timeout:
+                    continue
+                frame = view[:min(length, CAPTURE_SNAPLEN)]
+                try:
+                    parsed = parse(frame)
+                except (IndexError, struct.error):
+                    self.parse_errors += 1
+                    continue
+                if parsed:
+                    record(*parsed, length, time.time(), frame)
+        finally:
+            self._close_socket()
+    
+    def _capture_ring(self):
+        """Walk TPACKET_V3 blocks of a memory-mapped PACKET_RX_RING.
+        
+        Frames are parsed straight out of the shared ring through memoryviews;
+        a block is handed back to the kernel once all of its frames are done.
+        """
+        opts = self.options
+        sock = self._open_raw_socket()
+        sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+        frame_size = 2048
+        sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack(
+            "IIIIIII",
+            opts.ring_block_size, opts.ring_blocks,
+            frame_size, opts.ring_block_size * opts.ring_blocks // frame_size,
+            opts.ring_timeout, 0, 0
+        ))
+        parse, skip_outgoing = self._frame_parser(sock)
+        self._parse = parse
+        self._sock = sock
+        
+        block_size = opts.ring_block_size
+        ring = mmap.mmap(sock.fileno(), block_size * opts.ring_blocks,
+                         mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        view = memoryview(ring)
+        poller = select.poll()
+        poller.register(sock, select.POLLIN | select.POLLERR)
+        if self.fanout_group is not None:
+            join_fanout(sock, self.fanout_group)
+        
+        # tpacket_hdr_v1: block_status, num_pkts, offset_to_first_pkt
+        block_hdr = struct.Struct("=III")
+        # tpacket3_hdr: next_offset, sec, nsec, snaplen, len, status, mac
+        frame_hdr = struct.Struct("=IIIIIIH")
+        status_at = struct.Struct("=I")
+        first_ts_at = struct.Struct("=II")       # tpacket_hdr_v1.ts_first_pkt (sec, nsec)
+        record = self._record_packet
+        tick = self._tick
+        next_tick = time.monotonic() + CAPTURE_TICK
+        block = 0
+        
+        self.logger.info(
+            f"Starting packet capture on {self.interface or 'all interfaces'} "
+            f"(ring: {opts.ring_blocks} x {block_size >> 10} KiB)..."
+        )
+        try:
+            while self.running:
+                if tick is not None and time.monotonic() >= next_tick:
+                    base = block * block_size
+                    if status_at.unpack_from(view, base + 8)[0] & TP_STATUS_USER:
+                        sec, nsec = first_ts_at.unpack_from(view, base + 32)
+                        self.capture_lag = max(0.0, time.time() - sec - nsec * 1e-9)
+                    else:
+                        self.capture_lag = 0.0
+                    tick()
+                    next_tick = time.monotonic() + CAPTURE_TICK
+                base = block * block_size
+                status, num_pkts, offset = block_hdr.unpack_from(view, base + 8)
+                if not status & TP_STATUS_USER:
+                    poller.poll(int(CAPTURE_TICK * 1000))
+                    continue
                 
-                # Determine direction
-                is_outbound = (src_ip == self.local_ip or 
-                              src_ip.startswith("192.168.") or
-                              src_ip.startswith("10.") or
-                              src_ip.startswith("172."))
+                offset += base
+                for _ in range(num_pkts):
+                    next_offset, sec, nsec, snaplen, length, _, mac = frame_hdr.unpack_from(view, offset)
+                    # sockaddr_ll follows the 48-byte header; sll_pkttype is at +10
+                    if not (skip_outgoing and view[offset + 58] == socket.PACKET_OUTGOING):
+                        frame = view[offset + mac:offset + mac + snaplen]
+                        try:
+                            parsed = parse(frame)
+                        except (IndexError, struct.error):
+                            self.parse_errors += 1
+                            parsed = None
+                        if parsed:
+                            record(*parsed, length, sec + nsec * 1e-9, frame)
+                    offset += next_offset
                 
-                if is_outbound:
-                    flow.bytes_sent += length
-                    flow.packets_sent += 1
+                status_at.pack_into(view, base + 8, TP_STATUS_KERNEL)
+                block = (block + 1) % opts.ring_blocks
+        finally:
+            view.release()
+            ring.close()
+            self._close_socket()
+    
+    def _close_socket(self):
+        sock = self._sock
+        if sock is not None:
+            self.capture_stats()
+            self._sock = None
+            sock.close()
+    
+    def capture_stats(self) -> dict:
+        """Kernel packet/drop counters (PACKET_STATISTICS) since capture start."""
+        sock = self._sock
+        if sock is not None:
+            try:
+                if self.options.ring:
+                    packets, drops, freeze = struct.unpack(
+                        "III", sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
                 else:
-                    flow.bytes_recv += length
-                    flow.packets_recv += 1
-            
-            # Analyze for threats
-            alerts = self.detector.analyze_packet(
-                src_ip, dst_ip, src_port, dst_port, proto, self.local_ip
+                    packets, drops = struct.unpack(
+                        "II", sock.getsockopt(SOL_PACKET, PACKET_STATISTICS, 8))
+                    freeze = 0
+            except OSError:
+                packets = drops = freeze = 0
+            # The kernel resets its counters on every read
+            with self._lock:
+                stats = self._kernel_stats
+                stats["kernel_packets"] += packets
+                stats["kernel_drops"] += drops
+                stats["kernel_freeze_q"] += freeze
+        with self._lock:
+            return {**self._kernel_stats, "parse_errors": self.parse_errors,
+                    "flow_table_flows": len(self.flows),
+                    "flow_table_evicted": self.flows.evicted,
+                    "sampling_rate": self.sampling_rate,
+                    "sampled_out_packets": self.sampled_out}
+    
+    def _capture_scapy(self):
+        from scapy.all import sniff, IP, TCP, UDP, ICMP
+        self._scapy_layers = (IP, TCP, UDP, ICMP)
+        self.logger.info(f"Starting packet capture on {self.interface} (scapy)...")
+        expression = self.options.filter
+        if self.options.exclude:
+            excluded = f"not ({exclude_expression(self.options.exclude)})"
+            expression = f"({expression}) and {excluded}" if expression else excluded
+        sniff(
+            iface=self.interface,
+            filter=expression or None,
+            prn=self._process_packet,
+            store=False,
+            stop_filter=lambda x: not self.running
+        )
+    
+    def start(self):
+        try:
+            self.running = True
+            if self.options.engine == "scapy":
+                self._capture_scapy()
+            elif self.options.ring:
+                self._capture_ring()
+            else:
+                self._capture_raw()
+        except ImportError:
+            self.logger.error("Scapy not installed! Run: pip install scapy")
+            raise
+        except PermissionError:
+            self.logger.error("Permission denied! Run with sudo/administrator")
+            raise
+    
+    def stop(self):
+        self.running = False
+    
+    def export_flows(self, now: Optional[float] = None, flush: bool = False) -> List[Flow]:
+        """Closed and checkpointed flows since the last export; ``flush`` closes all."""
+        start = time.perf_counter_ns()
+        with self._lock:
+            self.timings.observe("lock_wait", time.perf_counter_ns() - start)
+            flows = self.flows.export(time.time() if now is None else now, flush)
+        self.detector.score_flows(flows)
+        return flows
+    
+    def export_alerts(self) -> List[Alert]:
+        return drain_queue(self.alert_queue)
+
+# ============================================================================
+# SHARDED CAPTURE (--workers, Linux)
+# ============================================================================
+
+class ShardWorkerCapture(PacketCapture):
+    """Capture worker owning one PACKET_FANOUT shard.
+    
+    The worker is the only thread touching its flows, detector state and
+    pending alerts, so the flow table lock is never contended. Once per
+    FLOW_UPLOAD_INTERVAL the capture loop swaps the tables out and ships them
+    to the parent process.
+    """
+    
+    def __init__(self, index: int, interface: str, logger: logging.Logger,
+                 detector: ThreatDetector, options: CaptureOptions, group: int,
+                 results, stop_event, shard_rates, blocklist_updates=None):
+        super().__init__(interface, logger, detector, options)
+        self.index = index
+        self.fanout_group = group
+        self.results = results
+        self.stop_event = stop_event
+        self.shard_rates = shard_rates           # shared: each shard's own sampling rate
+        self.blocklist_updates = blocklist_updates
+        self.pending_alerts: List[Alert] = []    # single-threaded; shipped with the flows
+        self._tick = self._on_tick
+        self._last_ship = time.monotonic()
+        self._last_rules_check = time.monotonic()
+    
+    def _emit_alerts(self, alerts: List[Alert], src_ip: bytes):
+        self.pending_alerts.extend(alerts)
+        for alert in alerts:
+            self.logger.warning(f"🚨 ALERT: {alert.signature_name} from {format_ip(src_ip)}")
+    
+    def _adjust_sampling(self):
+        """Publish this shard's rate and sample at the highest of all shards.
+        
+        The two directions of a connection usually land in different shards,
+        and both must make the same keep-or-skip choice.
+        """
+        self.sampling_rate = self.overload.rate
+        super()._adjust_sampling()
+        self.shard_rates[self.index] = self.sampling_rate
+        self.sampling_rate = max(self.shard_rates)
+    
+    def _on_tick(self):
+        if self.stop_event.is_set():
+            self.running = False
+            return
+        if self.overload is not None:
+            self._adjust_sampling()
+        now = time.monotonic()
+        if now - self._last_ship >= FLOW_UPLOAD_INTERVAL:
+            self.ship()
+        if self.blocklist_updates is not None:
+            entries = None
+            while True:
+                try:
+                    entries = self.blocklist_updates.get_nowait()
+                except queue.Empty:
+                    break
+            if entries is not None:
+                self.detector.blocklist.load(entries)
+        if (self.detector.signatures is not None
+                and now - self._last_rules_check >= RULES_RELOAD_INTERVAL):
+            # Each shard watches the rules file itself; reloads need no IPC
+            self._last_rules_check = now
+            self.detector.signatures.maybe_reload()
+    
+    def ship(self, flush: bool = False):
+        """Send this shard's expired flows and new alerts to the parent."""
+        flows = self.flows.export(time.time(), flush)
+        alerts, self.pending_alerts = self.pending_alerts, []
+        self._last_ship = time.monotonic()
+        self.results.put((
+            self.index, flows, alerts, self.packet_count,
+            {**self.capture_stats(), **self.detector.stats()},
+            self.detector.alert_count, self.timings
+        ))
+
+
+def run_capture_worker(index: int, interface: str, logger: logging.Logger,
+                       detector: ThreatDetector, options: CaptureOptions,
+                       group: int, results, stop_event, shard_rates,
+                       blocklist_updates=None):
+    """Entry point of a capture worker process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)   # the parent coordinates shutdown
+    # The parent forwards SIGUSR1/SIGUSR2; each worker writes its own profile
+    tracemalloc.stop()                             # tracing inherited through fork
+    profiler = Profiler(options.profile_dir, logger, options.profile_memory)
+    signal.signal(signal.SIGUSR1, lambda *_: profiler.start())
+    signal.signal(signal.SIGUSR2, lambda *_: profiler.stop())
+    if options.profile:
+        profiler.start()
+    capture = ShardWorkerCapture(index, interface, logger, detector, options,
+                                 group, results, stop_event, shard_rates, blocklist_updates)
+    try:
+        capture.start()
+    finally:
+        capture.ship(flush=True)
+        profiler.stop(wait=True)
+
+
+class ShardedCapture:
+    """Runs ``options.workers`` capture processes joined to one fanout group.
+    
+    Packets are spread across workers by source address, so the per-source
+    scan, sweep and flood windows of each worker see all of that source's
+    traffic. The two directions of a connection usually reach different
+    workers, and their records are joined when the shard snapshots are
+    merged here at export time.
+    
+    Checks on a destination rather than a source need every shard's view:
+    the sketch detector's distributed-scan counts live in memory shared by
+    the workers, and alerts whose cooldown is keyed on a destination are
+    rate limited again here, so shards do not repeat each other.
+    """
+    
+    def __init__(self, interface: str, logger: logging.Logger,
+                 detector: ThreatDetector, options: CaptureOptions):
+        self.interface = interface
+        self.logger = logger
+        self.detector = detector
+        self.options = options
+        self.local_ip = primary_address(interface)
+        self.running = False
+        self.flows = FlowTable(lambda ip: False)     # merged shard records awaiting export
+        self.alert_queue: "queue.SimpleQueue[Alert]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        self._ctx = multiprocessing.get_context("fork")
+        self._results = self._ctx.Queue()
+        self._stop_event = self._ctx.Event()
+        self._processes: list = []
+        self._blocklist_updates: list = []           # one queue per worker
+        self._shards: Dict[int, tuple] = {}
+        self.duplicate_alerts = 0                    # shard alerts dropped by cooldowns here
+    
+    @property
+    def packet_count(self) -> int:
+        with self._lock:
+            return sum(shard[0] for shard in self._shards.values())
+    
+    @property
+    def timings(self) -> StageTimings:
+        """Stage timings of every shard as of its last snapshot."""
+        merged = StageTimings()
+        with self._lock:
+            for shard in self._shards.values():
+                merged.merge(shard[3])
+        return merged
+    
+    def launch(self):
+        """Fork the capture workers.
+        
+        Call this while the process has no other threads: a forked child
+        gets a copy of every lock, and one held by another thread at fork
+        time (logging, queues, the HTTP pool) stays locked there forever.
+        SNSMAgent launches before starting its upload, spool, metrics and
+        registration threads and the event loop; ``start`` launches only
+        if that has not happened yet.
+        """
+        if self._processes:
+            return
+        self.running = True
+        group = os.getpid() & 0xFFFF
+        self.logger.info(
+            f"Starting {self.options.workers} capture workers on "
+            f"{self.interface or 'all interfaces'} (fanout group {group})..."
+        )
+        # Each shard gets an equal slice of the detector state limits
+        workers = self.options.workers
+        shard_rates = self._ctx.RawArray("i", [1] * workers)
+        shared_sketches = None
+        if isinstance(self.detector, SketchDetector):
+            shared_sketches = (SharedSpreadSketch(self._ctx), SharedSpreadSketch(self._ctx))
+        for index in range(workers):
+            detector = type(self.detector)(
+                self.logger,
+                max(1, self.detector.max_sources // workers),
+                self.detector.memory_budget // workers,
+                self.detector.score_weights
             )
-            if alerts:
-                with self._lock:
-                    self.pending_alerts.extend(alerts)
-                for alert in alerts:
-                    self.logger.warning(f"🚨 ALERT: {alert.signature_name} from {src_ip}")
-                    
-        except Exception as e:
-            self.logger.debug(f"Packet processing error: {e}")
+            detector.signatures = self.detector.signatures
+            detector.blocklist = self.detector.blocklist
+            if shared_sketches is not None:
+                detector.dst_ports, detector.dst_sources = shared_sketches
+            updates = self._ctx.Queue() if detector.blocklist is not None else None
+            self._blocklist_updates.append(updates)
+            proc = self._ctx.Process(
+                target=run_capture_worker,
+                args=(index, self.interface, self.logger, detector, self.options,
+                      group, self._results, self._stop_event, shard_rates, updates),
+                name=f"snsm-capture-{index}",
+                daemon=True
+            )
+            proc.start()
+            self._processes.append(proc)
     
     def start(self):
-        try:
-            from scapy.all import sniff
-            self.running = True
-            self.logger.info(f"Starting packet capture on {self.interface}...")
-            sniff(
-                iface=self.interface,
-                prn=self._process_packet,
-                store=False,
-                stop_filter=lambda x: not self.running
-            )
-        except ImportError:
-            self.logger.error("Scapy not installed! Run: pip install scapy")
-            raise
-        except PermissionError:
-            self.logger.error("Permission denied! Run with sudo/administrator")
-            raise
+        self.launch()
+        while self.running:
+            for proc in self._processes:
+                proc.join(timeout=CAPTURE_TICK / len(self._processes))
+                if not proc.is_alive() and self.running:
+                    self.logger.error(f"Capture worker {proc.name} exited (code {proc.exitcode})")
+                    self.stop()
+                    break
+        
+        self._join_workers()
+    
+    def _join_workers(self):
+        """Wait for workers to ship their final snapshot, draining meanwhile."""
+        deadline = time.monotonic() + CAPTURE_TICK * 3
+        for proc in self._processes:
+            while proc.is_alive() and time.monotonic() < deadline:
+                with self._lock:
+                    self._drain()
+                proc.join(timeout=0.1)
     
     def stop(self):
         self.running = False
+        self._stop_event.set()
+        self._join_workers()
+    
+    def signal_workers(self, sig: int):
+        for proc in self._processes:
+            if proc.is_alive():
+                os.kill(proc.pid, sig)
+    
+    def update_blocklist(self, entries: List[BlocklistEntry]):
+        """Hand a new blocklist to every worker; each loads it on its next tick."""
+        for updates in self._blocklist_updates:
+            if updates is not None:
+                updates.put(entries)
     
-    def export_flows(self) -> List[Flow]:
+    def _drain(self):
+        """Merge every shard snapshot received so far; caller holds ``_lock``."""
+        while True:
+            try:
+                (index, flows, alerts, packets, stats, alert_count,
+                 timings) = self._results.get_nowait()
+            except queue.Empty:
+                break
+            # Directions of a connection usually land in different shards;
+            # merging joins them, and any flow split by checkpoints
+            self.flows.merge(flows)
+            for alert in alerts:
+                if alert.cooldown is not None and self.detector._rate_limited(*alert.cooldown):
+                    self.duplicate_alerts += 1
+                    continue
+                self.alert_queue.put(alert)
+            self._shards[index] = (packets, stats, alert_count, timings)
+        self.detector.alert_count = (sum(shard[2] for shard in self._shards.values())
+                                     - self.duplicate_alerts)
+    
+    def export_flows(self, now: Optional[float] = None, flush: bool = False) -> List[Flow]:
         with self._lock:
-            flows = list(self.flows.values())
-            for flow in flows:
-                flow.threat_score = self.detector.calculate_threat_score(flow, self.local_ip)
-            self.flows = {}
-            return flows
+            self._drain()
+            flows = self.flows.drain()
+        self.detector.score_flows(flows)
+        return flows
     
     def export_alerts(self) -> List[Alert]:
         with self._lock:
-            alerts = self.pending_alerts
-            self.pending_alerts = []
-            return alerts
+            self._drain()
+        return drain_queue(self.alert_queue)
+    
+    def capture_stats(self) -> dict:
+        totals: Dict[str, int] = {}
+        with self._lock:
+            self._drain()
+            for _, stats, _, _ in self._shards.values():
+                for name, value in stats.items():
+                    if name == "sampling_rate":          # the highest shard rate
+                        totals[name] = max(totals.get(name, 1), value)
+                    else:
+                        totals[name] = totals.get(name, 0) + value
+        return totals
+
+# ============================================================================
+# OFFLINE REPLAY (pcap / pcapng)
+# ============================================================================
+
+PCAP_MAGIC_USEC = 0xA1B2C3D4
+PCAP_MAGIC_NSEC = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+
+def _read_exact(f, size: int) -> bytes:
+    data = f.read(size)
+    if len(data) != size:
+        if data:
+            raise ValueError("truncated capture file")
+        raise EOFError
+    return data
+
+
+def _iter_pcap(f, header: bytes):
+    """Yield ``(timestamp, linktype, data, orig_len)`` from a classic pcap stream."""
+    for order in ("<", ">"):
+        magic = struct.unpack(order + "I", header[:4])[0]
+        if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            break
+    else:
+        raise ValueError("not a pcap or pcapng file")
+    scale = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+    header += _read_exact(f, 16)
+    linktype = struct.unpack(order + "I", header[20:24])[0] & 0x0FFFFFFF
+    record = struct.Struct(order + "IIII")
+    while True:
+        try:
+            sec, frac, incl_len, orig_len = record.unpack(_read_exact(f, 16))
+        except EOFError:
+            return
+        yield sec + frac * scale, linktype, _read_exact(f, incl_len), orig_len
+
+
+def _iter_pcapng(f, header: bytes):
+    """Yield ``(timestamp, linktype, data, orig_len)`` from a pcapng stream."""
+    order = "<"
+    interfaces: List[tuple] = []     # (linktype, seconds per timestamp unit)
+    last_ts = 0.0
+    block_type = PCAPNG_SHB
+    while True:
+        if block_type == PCAPNG_SHB:
+            magic = _read_exact(f, 4)
+            order = "<" if struct.unpack("<I", magic)[0] == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            total_len = struct.unpack(order + "I", header[4:8])[0]
+            f.read(total_len - 12)
+            interfaces = []
+        else:
+            total_len = struct.unpack(order + "I", header[4:8])[0]
+            body = _read_exact(f, total_len - 8)[:-4]
+            
+            if block_type == 1:          # Interface Description Block
+                linktype = struct.unpack_from(order + "H", body, 0)[0]
+                resolution = 1e-6
+                pos = 8
+                while pos + 4 <= len(body):
+                    code, length = struct.unpack_from(order + "HH", body, pos)
+                    if code == 0:
+                        break
+                    if code == 9 and length >= 1:    # if_tsresol
+                        value = body[pos + 4]
+                        resolution = 2.0 ** -(value & 0x7F) if value & 0x80 else 10.0 ** -value
+                    pos += 4 + (length + 3) // 4 * 4
+                interfaces.append((linktype, resolution))
+            elif block_type == 6:        # Enhanced Packet Block
+                iface, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(order + "IIIII", body, 0)
+                linktype, resolution = interfaces[iface]
+                last_ts = ((ts_high << 32) | ts_low) * resolution
+                yield last_ts, linktype, body[20:20 + cap_len], orig_len
+            elif block_type == 3:        # Simple Packet Block
+                orig_len = struct.unpack_from(order + "I", body, 0)[0]
+                yield last_ts, interfaces[0][0], body[4:4 + orig_len], orig_len
+            elif block_type == 2:        # Packet Block (obsolete)
+                iface, _, ts_high, ts_low, cap_len, orig_len = struct.unpack_from(order + "HHIIII", body, 0)
+                linktype, resolution = interfaces[iface]
+                last_ts = ((ts_high << 32) | ts_low) * resolution
+                yield last_ts, linktype, body[20:20 + cap_len], orig_len
+        try:
+            header = _read_exact(f, 8)
+        except EOFError:
+            return
+        block_type = struct.unpack(order + "I", header[:4])[0]
+
+
+def iter_capture_file(f):
+    """Stream packets from a pcap or pcapng file object, one record at a time."""
+    try:
+        header = _read_exact(f, 8)
+    except EOFError:
+        return iter(())
+    if struct.unpack("<I", header[:4])[0] == PCAPNG_SHB:
+        return _iter_pcapng(f, header)
+    return _iter_pcap(f, header)
+
+
+class ReplayCapture(PacketCapture):
+    """Feeds a pcap/pcapng file through the live parse → flow → detector path.
+    
+    Packet timestamps drive flow times, detection windows and the export
+    schedule: ``on_interval(now, final)`` is called every FLOW_UPLOAD_INTERVAL
+    of capture time and once more, with ``final`` set, at the end of the file.
+    """
+    
+    def __init__(self, logger: logging.Logger, detector: ThreatDetector,
+                 options: CaptureOptions, on_interval: Callable[[float, bool], None]):
+        super().__init__("", logger, detector, options)
+        self.on_interval = on_interval
+    
+    def start(self):
+        self.running = True
+        path = self.options.read
+        speed = self.options.replay_speed
+        f = sys.stdin.buffer if path == "-" else open(path, "rb")
+        self.logger.info(
+            f"Replaying {'stdin' if path == '-' else path} "
+            f"({f'{speed}x' if speed else 'max speed'})..."
+        )
+        
+        record = self._record_packet
+        parse = last_linktype = None
+        next_export = None
+        first_ts = wall_start = 0.0
+        now = 0.0
+        try:
+            for now, linktype, data, orig_len in iter_capture_file(f):
+                if not self.running:
+                    break
+                if next_export is None:
+                    first_ts, wall_start = now, time.monotonic()
+                    next_export = now + FLOW_UPLOAD_INTERVAL
+                elif now >= next_export:
+                    self.on_interval(next_export, False)
+                    next_export += FLOW_UPLOAD_INTERVAL * (1 + int((now - next_export) // FLOW_UPLOAD_INTERVAL))
+                if speed:
+                    delay = (now - first_ts) / speed - (time.monotonic() - wall_start)
+                    if delay > 0:
+                        time.sleep(delay)
+                
+                if linktype != last_linktype:
+                    last_linktype = linktype
+                    parse = self._parse = LINKTYPE_PARSERS.get(linktype)
+                if parse is None:
+                    continue
+                frame = memoryview(data)
+                try:
+                    parsed = parse(frame)
+                except (IndexError, struct.error):
+                    self.parse_errors += 1
+                    continue
+                if parsed:
+                    record(*parsed, orig_len, now, frame)
+        finally:
+            if f is not sys.stdin.buffer:
+                f.close()
+        if next_export is not None:
+            self.on_interval(now, True)
+        self.running = False
 
 # ============================================================================
 # SIMPLE CAPTURE (No root required)
 # ============================================================================
 
+# sock_diag (NETLINK_INET_DIAG) socket dumps
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_INFO = 2
+TCP_DIAG_STATES = 0xFFF & ~(1 << 6 | 1 << 10)   # all but TIME_WAIT and LISTEN
+UDP_DIAG_STATES = 1 << 1                         # connected UDP sockets
+SOCK_DIAG_BUFFER = 1 << 16
+
+_nlmsghdr = struct.Struct("=IHHII")
+_diag_req = struct.Struct("=BBBBI48x")           # inet_diag_req_v2, wildcard socket id
+_nlattr = struct.Struct("=HH")
+# tcp_info: bytes_acked, bytes_received (u64) and segs_out, segs_in (u32) at offset 120
+TCP_INFO_COUNTERS = slice(120, 144)
+_tcp_counters = struct.Struct("=QQII").unpack
+_V4_MAPPED = bytes(10) + b"\xff\xff"
+
+
+class SockDiag:
+    """Bulk socket table dumps over NETLINK_SOCK_DIAG (Linux; no root needed).
+    
+    One request per family and protocol returns every matching socket in a
+    few large reads, instead of a walk over /proc for every process.
+    """
+    
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_SOCK_DIAG)
+        self._seq = 0
+    
+    def close(self):
+        self.sock.close()
+    
+    def dump(self, family: int, protocol: int, states: int) -> Iterator[tuple]:
+        """Yield ``(cookie, counters, buf, offset)`` for each socket.
+        
+        ``cookie`` identifies the socket for its lifetime. ``counters`` is
+        the raw byte and segment counter block of its tcp_info (None for
+        UDP), so unchanged sockets can be skipped with one comparison;
+        ``endpoints(buf, offset)`` decodes the addresses when needed.
+        """
+        self._seq += 1
+        request = _diag_req.pack(family, protocol, 1 << (INET_DIAG_INFO - 1), 0, states)
+        self.sock.send(_nlmsghdr.pack(_nlmsghdr.size + len(request), SOCK_DIAG_BY_FAMILY,
+                                      NLM_F_REQUEST | NLM_F_DUMP, self._seq, 0) + request)
+        while True:
+            buf = self.sock.recv(SOCK_DIAG_BUFFER)
+            offset = 0
+            while offset < len(buf):
+                length, kind = _nlmsghdr.unpack_from(buf, offset)[:2]
+                if kind == NLMSG_DONE:
+                    return
+                if kind == NLMSG_ERROR:
+                    error = -struct.unpack_from("=i", buf, offset + 16)[0]
+                    raise OSError(error, os.strerror(error))
+                msg = offset + 16
+                counters = None
+                attr = msg + 72                  # past struct inet_diag_msg
+                end = offset + length
+                while attr < end:
+                    attr_len, attr_type = _nlattr.unpack_from(buf, attr)
+                    if attr_type == INET_DIAG_INFO and attr_len >= 4 + TCP_INFO_COUNTERS.stop:
+                        counters = buf[attr + 4:attr + attr_len][TCP_INFO_COUNTERS]
+                    attr += (attr_len + 3) & ~3
+                yield buf[msg + 44:msg + 52], counters, buf, msg
+                offset += (length + 3) & ~3
+    
+    @staticmethod
+    def endpoints(buf, offset: int) -> tuple:
+        """``(local_ip, remote_ip, local_port, remote_port)`` of one dumped socket."""
+        local_port, remote_port = _unpack_ports(buf, offset + 4)
+        if buf[offset] == socket.AF_INET:
+            return buf[offset + 8:offset + 12], buf[offset + 24:offset + 28], local_port, remote_port
+        local_ip, remote_ip = _unpack_ipv6(buf, offset + 8)
+        if local_ip[:12] == _V4_MAPPED:
+            local_ip = local_ip[12:]
+        if remote_ip[:12] == _V4_MAPPED:
+            remote_ip = remote_ip[12:]
+        return local_ip, remote_ip, local_port, remote_port
+
+
 class SimpleCapture:
-    """Fallback capture using psutil - no root required but less detailed."""
+    """Connection-table monitoring without root.
+    
+    On Linux the socket table is dumped over sock_diag and diffed by socket
+    cookie against the previous poll: only new sockets are analyzed, and
+    flows get the real byte and segment deltas from tcp_info. Elsewhere
+    psutil lists the connections, which carry no counters.
+    """
     
     def __init__(self, logger: logging.Logger, detector: ThreatDetector):
         self.logger = logger
         self.detector = detector
-        self.flows: Dict[str, Flow] = {}
-        self.local_ip = self._get_local_ip()
+        # Sockets are local by definition, so flows are recorded local -> remote
+        self.flows = FlowTable(lambda ip: False)
+        self.local_ip = primary_address()
         self.packet_count = 0
         self.running = False
-        self.pending_alerts: List[Alert] = []
+        self.alert_queue: "queue.SimpleQueue[Alert]" = queue.SimpleQueue()
         self._lock = threading.Lock()
-        
-    def _get_local_ip(self) -> str:
+        self._stop_event = threading.Event()
+        self._sockets: dict = {}                 # socket cookie / connection -> counters
+        self._primed = False
+        self.timings = StageTimings()            # no per-packet stages without capture
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "0.0.0.0"
-    
+            self._diag: Optional[SockDiag] = SockDiag()
+        except (AttributeError, OSError):        # not Linux
+            self._diag = None
+        
     def _get_connections(self) -> List[dict]:
         try:
             import psutil
@@ -528,9 +4946,9 @@ class SimpleCapture:
                     continue
                     
                 connections.append({
-                    'local_ip': conn.laddr.ip if conn.laddr else '0.0.0.0',
+                    'local_ip': pack_ip(conn.laddr.ip if conn.laddr else '0.0.0.0'),
                     'local_port': conn.laddr.port if conn.laddr else 0,
-                    'remote_ip': conn.raddr.ip if conn.raddr else '0.0.0.0',
+                    'remote_ip': pack_ip(conn.raddr.ip if conn.raddr else '0.0.0.0'),
                     'remote_port': conn.raddr.port if conn.raddr else 0,
                     'status': conn.status,
                     'protocol': 'tcp' if conn.type == socket.SOCK_STREAM else 'udp'
@@ -544,152 +4962,520 @@ class SimpleCapture:
             self.logger.debug(f"Error getting connections: {e}")
             return []
     
+    def poll(self):
+        """Take one snapshot of the connection table."""
+        now = time.time()
+        if self._diag is not None:
+            try:
+                self._poll_sock_diag(now)
+                return
+            except OSError as e:
+                self.logger.warning(f"sock_diag unavailable ({e}); falling back to psutil")
+                self._diag.close()
+                self._diag = None
+                self._sockets = {}
+                self._primed = False
+        self._poll_psutil(now)
+    
+    def _poll_sock_diag(self, now: float):
+        previous = self._sockets
+        current = {}
+        changes = []
+        for proto, number, states in (("tcp", socket.IPPROTO_TCP, TCP_DIAG_STATES),
+                                      ("udp", socket.IPPROTO_UDP, UDP_DIAG_STATES)):
+            for family in (socket.AF_INET, socket.AF_INET6):
+                for cookie, counters, buf, offset in self._diag.dump(family, number, states):
+                    current[cookie] = counters
+                    old = previous.get(cookie, previous)
+                    if old is counters or old == counters:
+                        continue
+                    changes.append((proto, SockDiag.endpoints(buf, offset), counters,
+                                    None if old is previous else old))
+        self._sockets = current
+        primed, self._primed = self._primed, True
+        
+        # Both ends of a connection within this host are dumped; count one
+        ends = {(proto, endpoints) for proto, endpoints, _, _ in changes}
+        new = []
+        with self._lock:
+            for proto, endpoints, counters, old in changes:
+                local_ip, remote_ip, local_port, remote_port = endpoints
+                if not remote_port:
+                    continue                     # not connected
+                if ((local_ip, local_port) > (remote_ip, remote_port)
+                        and (proto, (remote_ip, local_ip, remote_port, local_port)) in ends):
+                    continue
+                if old is None:
+                    new.append((proto, endpoints))
+                    if not primed:
+                        continue                 # first poll: counters are the baseline
+                if counters is None:
+                    # UDP: no counters, the socket is recorded once when it appears
+                    sent, received, segs_out, segs_in = 0, 0, 1, 0
+                else:
+                    sent, received, segs_out, segs_in = _tcp_counters(counters)
+                    if old is not None:
+                        old_sent, old_received, old_out, old_in = _tcp_counters(old)
+                        sent -= old_sent
+                        received -= old_received
+                        segs_out -= old_out
+                        segs_in -= old_in
+                self.flows.add(local_ip, remote_ip, local_port, remote_port, proto,
+                               sent, received, segs_out, segs_in, now)
+                self.packet_count += segs_out + segs_in
+        
+        for proto, (local_ip, remote_ip, local_port, remote_port) in new:
+            self._analyze(local_ip, remote_ip, local_port, remote_port, proto, now)
+    
+    def _poll_psutil(self, now: float):
+        previous = self._sockets
+        current = {}
+        for conn in self._get_connections():
+            key = (conn['protocol'], conn['local_ip'], conn['local_port'],
+                   conn['remote_ip'], conn['remote_port'])
+            current[key] = None
+            if key in previous:
+                continue
+            # psutil has no counters: a connection is recorded once when it appears
+            with self._lock:
+                self.flows.add(
+                    conn['local_ip'], conn['remote_ip'],
+                    conn['local_port'], conn['remote_port'],
+                    conn['protocol'], 0, 0, 1, 0, now
+                )
+                self.packet_count += 1
+            self._analyze(conn['local_ip'], conn['remote_ip'], conn['local_port'],
+                          conn['remote_port'], conn['protocol'], now)
+        self._sockets = current
+    
+    def _analyze(self, local_ip: bytes, remote_ip: bytes, local_port: int,
+                 remote_port: int, proto: str, now: float):
+        """Run threat detection once for a newly seen connection."""
+        alerts = self.detector.analyze_packet(
+            remote_ip, local_ip, remote_port, local_port, proto, self.local_ip, now
+        )
+        for alert in alerts:
+            self.alert_queue.put(alert)
+            self.logger.warning(f"🚨 ALERT: {alert.signature_name}")
+    
     def start(self):
         self.running = True
         self.logger.info("Starting simple connection monitoring...")
-        
         while self.running:
-            connections = self._get_connections()
-            
-            for conn in connections:
-                key = f"{conn['local_ip']}:{conn['local_port']}->{conn['remote_ip']}:{conn['remote_port']}:{conn['protocol']}"
-                
-                with self._lock:
-                    if key not in self.flows:
-                        self.flows[key] = Flow(
-                            src_ip=conn['local_ip'],
-                            dst_ip=conn['remote_ip'],
-                            src_port=conn['local_port'],
-                            dst_port=conn['remote_port'],
-                            protocol=conn['protocol']
-                        )
-                    
-                    flow = self.flows[key]
-                    flow.end_time = time.time()
-                    flow.packets_sent += 1
-                    flow.bytes_sent += 500  # Estimated
-                    self.packet_count += 1
-                
-                # Analyze for threats
-                alerts = self.detector.analyze_packet(
-                    conn['remote_ip'], conn['local_ip'],
-                    conn['remote_port'], conn['local_port'],
-                    conn['protocol'], self.local_ip
-                )
-                if alerts:
-                    with self._lock:
-                        self.pending_alerts.extend(alerts)
-                    for alert in alerts:
-                        self.logger.warning(f"🚨 ALERT: {alert.signature_name}")
-            
-            time.sleep(1)
+            self.poll()
+            self._stop_event.wait(SIMPLE_POLL_INTERVAL)
     
     def stop(self):
         self.running = False
+        self._stop_event.set()
     
-    def export_flows(self) -> List[Flow]:
+    def export_flows(self, now: Optional[float] = None, flush: bool = False) -> List[Flow]:
+        """Closed and checkpointed flows since the last export; ``flush`` closes all."""
         with self._lock:
-            flows = list(self.flows.values())
-            for flow in flows:
-                flow.threat_score = self.detector.calculate_threat_score(flow, self.local_ip)
-            self.flows = {}
-            return flows
+            flows = self.flows.export(time.time() if now is None else now, flush)
+        self.detector.score_flows(flows)
+        return flows
     
     def export_alerts(self) -> List[Alert]:
-        with self._lock:
-            alerts = self.pending_alerts
-            self.pending_alerts = []
-            return alerts
+        return drain_queue(self.alert_queue)
+
+    def capture_stats(self) -> dict:
+        return {"simple_sockets": len(self._sockets), "flow_table_flows": len(self.flows),
+                "flow_table_evicted": self.flows.evicted}
 
 # ============================================================================
 # MAIN AGENT
 # ============================================================================
 
 class SNSMAgent:
-    def __init__(self, interface: str, simple_mode: bool, verbose: bool):
+    def __init__(self, interface: str, simple_mode: bool, verbose: bool,
+                 capture_options: Optional[CaptureOptions] = None, output: str = "",
+                 max_sources: int = DETECTOR_MAX_SOURCES,
+                 state_memory_mb: int = DETECTOR_MEMORY_MB, detector: str = "exact",
+                 upload_options: Optional[UploadOptions] = None,
+                 score_weights: Optional[Dict[str, int]] = None, rules: str = "",
+                 blocklist: bool = True, nft_sync: bool = False,
+                 metrics_address: Optional[tuple] = None, identity_file: str = IDENTITY_FILE,
+                 reregister: bool = False, aggregate: bool = False):
         self.logger = setup_logging(verbose)
-        self.client = SNSMClient(BACKEND_URL, API_KEY, self.logger)
-        self.detector = ThreatDetector(self.logger)
+        self.upload_options = upload_options or UploadOptions()
+        self.uploads: Optional[UploadPipeline] = None   # set up by run(), see _start_uploads
+        self.spool: Optional[Spool] = None
+        self.blocklist: Optional[Blocklist] = None
+        self.firewall: Optional[NftBlocklistSync] = None
+        if output:
+            self.client = NDJSONWriter(output, self.logger)
+        else:
+            self.client = SNSMClient(BACKEND_URL, API_KEY, self.logger, self.upload_options)
+            if blocklist:
+                self.blocklist = Blocklist()
+                if nft_sync:
+                    self.firewall = NftBlocklistSync(self.logger)
+        self.detector = DETECTORS[detector](self.logger, max_sources, state_memory_mb << 20,
+                                            score_weights)
+        self.detector.blocklist = self.blocklist
+        if rules:
+            if simple_mode:
+                self.logger.warning("Signature rules need packet capture; ignored in simple mode")
+            else:
+                self.detector.signatures = SignatureEngine(rules, self.logger)
         self.simple_mode = simple_mode
         self.interface = interface
+        self.capture_options = capture_options or CaptureOptions()
         self.capture = None
         self.running = False
         self.start_time = time.time()
         self.total_flows = 0
+        self.identity_file = identity_file
+        self.reregister = reregister
+        self._last_heartbeat = self.start_time
+        self._stopped = threading.Event()        # ends background registration retries
+        self.timings = StageTimings()            # export stage
+        self.aggregator = FlowAggregator() if aggregate else None
+        self.profiler = Profiler(self.capture_options.profile_dir, self.logger,
+                                 self.capture_options.profile_memory)
+        self.metrics_server: Optional[MetricsServer] = None
+        if metrics_address:
+            self.capture_options.metrics_sample = METRICS_SAMPLE
+            self.metrics_server = MetricsServer(*metrics_address, self._metrics, self.logger)
         
+    def _start_uploads(self):
+        """Open the spool and start the upload pipeline (both run threads)."""
+        if isinstance(self.client, NDJSONWriter):
+            return
+        options = self.upload_options
+        if options.spool_dir:
+            try:
+                self.spool = Spool(options.spool_dir, self.client, self.logger,
+                                   options.spool_max_mb << 20, options.spool_fsync)
+            except OSError as e:
+                self.logger.warning(f"Spool disabled, cannot use {options.spool_dir}: {e}")
+        self.uploads = UploadPipeline(self.client, self.logger, options.overflow, self.spool)
+    
     def _get_public_ip(self) -> str:
         try:
             req = Request("https://api.ipify.org?format=json")
             with urlopen(req, timeout=5) as resp:
                 return json.loads(resp.read().decode())["ip"]
         except:
-            return socket.gethostbyname(socket.gethostname())
+            return format_ip(primary_address(self.interface))
+    
+    def _load_identity(self, hostname: str) -> bool:
+        """Reuse the agent_id saved by an earlier run instead of registering again."""
+        if self.reregister:
+            return False
+        identity = load_identity(self.identity_file, self.client.backend_url, hostname)
+        if identity is None:
+            return False
+        self.client.agent_id = identity["agent_id"]
+        self.client.registration = identity
+        self.logger.info(f"✓ Agent ID: {self.client.agent_id[:8]}... "
+                         f"(registered {identity.get('registered_at', 'earlier')})")
+        return True
+    
+    def _register(self, hostname: str) -> bool:
+        if not self.client.register(hostname, self._get_public_ip()):
+            return False
+        try:
+            save_identity(self.identity_file, self.client.registration)
+        except OSError as e:
+            self.logger.warning(f"Cannot save agent identity to {self.identity_file}: {e}")
+        return True
+    
+    def _background_startup(self, hostname: str):
+        """Register (retrying with backoff) and fetch the blocklist while capture runs.
+        
+        Until an agent_id exists, uploads fail and go to the spool, which
+        replays them under the new ID.
+        """
+        delay = REGISTER_RETRY_MIN
+        while not self.client.agent_id:
+            if self._register(hostname):
+                break
+            wait = random.uniform(delay / 2, delay)
+            self.logger.warning(f"Registration failed, retrying in {wait:.0f}s (capture continues)")
+            if self._stopped.wait(wait):
+                return
+            delay = min(delay * 2, REGISTER_RETRY_MAX)
+        if self.blocklist is not None and not self._stopped.is_set():
+            self._refresh_blocklist()
+    
+    def _pipeline_stats(self) -> dict:
+        return {
+            **self.detector.stats(),
+            **self.client.stats(),
+            **(self.uploads.stats() if self.uploads else {}),
+            **(self.spool.stats() if self.spool else {}),
+            **(self.detector.signatures.stats() if self.detector.signatures else {}),
+            **(self.blocklist.stats() if self.blocklist is not None else {}),
+            **(self.aggregator.stats() if self.aggregator else {}),
+            **(self.capture.capture_stats() if self.capture else {})
+        }
+    
+    def _metrics(self) -> tuple:
+        """(StageTimings, gauges) for the metrics endpoint; no psutil sampling."""
+        timings = StageTimings()
+        timings.merge(self.timings)
+        timings.merge(self.client.timings)
+        if self.capture is not None:
+            timings.merge(self.capture.timings)
+        gauges = {
+            **self._pipeline_stats(),
+            "packets_captured": self.capture.packet_count if self.capture else 0,
+            "alerts_generated": self.detector.alert_count,
+            "alert_queue": self.capture.alert_queue.qsize() if self.capture else 0,
+            "uptime_seconds": round(time.time() - self.start_time, 1),
+        }
+        return timings, gauges
     
     def _get_system_stats(self) -> dict:
+        capture_stats = self._pipeline_stats()
         try:
             import psutil
             return {
                 "cpu_percent": psutil.cpu_percent(),
                 "memory_percent": psutil.virtual_memory().percent,
                 "packets_captured": self.capture.packet_count if self.capture else 0,
-                "alerts_generated": self.detector.alert_count
+                "alerts_generated": self.detector.alert_count,
+                **capture_stats
             }
         except ImportError:
             return {
                 "cpu_percent": 0,
                 "memory_percent": 0,
                 "packets_captured": self.capture.packet_count if self.capture else 0,
-                "alerts_generated": self.detector.alert_count
+                "alerts_generated": self.detector.alert_count,
+                **capture_stats
             }
     
-    def _upload_loop(self):
-        last_heartbeat = time.time()
-        
-        while self.running:
-            time.sleep(FLOW_UPLOAD_INTERVAL)
-            
-            if not self.capture:
+    def _flush(self, now: float, timestamp: Optional[float] = None, final: bool = False):
+        """Export flows and alerts and queue them for upload; heartbeat when one is due."""
+        self._export_flows(now, timestamp, final)
+        self._dispatch_alerts(timestamp)
+        if now - self._last_heartbeat >= HEARTBEAT_INTERVAL:
+            self._heartbeat()
+            self._last_heartbeat = now
+    
+    def _export_flows(self, now: Optional[float] = None, timestamp: Optional[float] = None,
+                      final: bool = False):
+        """Export flows (all of them on the final flush) and queue them for upload."""
+        start = time.perf_counter_ns()
+        flows = self.capture.export_flows(now, flush=final)
+        self.timings.observe("export", time.perf_counter_ns() - start)
+        if self.aggregator:
+            flows = self.aggregator.add(flows, time.time() if now is None else now, final)
+        if flows:
+            if self.uploads:
+                self.uploads.put(flows, timestamp)
+            elif self.client.send_flows(flows, timestamp):
+                self.total_flows += len(flows)
+    
+    def _dispatch_alerts(self, timestamp: Optional[float] = None):
+        alerts = self.capture.export_alerts()
+        if alerts:
+            self.client.submit(self._send_alerts, alerts, timestamp)
+    
+    def _heartbeat(self):
+        self.client.heartbeat(self._get_system_stats())
+    
+    def _refresh_blocklist(self):
+        """Poll the backend blocklist (conditional GET) and expire old entries."""
+        blocklist = self.blocklist
+        now = time.time()
+        result = self.client.fetch_blocklist(blocklist.etag)
+        if result is not None and result[1] is not None:
+            bad = blocklist.update(result[1], result[0], now)
+            self.logger.info(f"Blocklist updated: {len(blocklist)} entries"
+                             f"{f' ({bad} unparseable)' if bad else ''}")
+            changed = True
+        else:
+            if result is not None:
+                blocklist.not_modified += 1
+            changed = blocklist.purge(now) > 0
+        if not changed:
+            return
+        if isinstance(self.capture, ShardedCapture):
+            self.capture.update_blocklist(blocklist.entries)
+        if self.firewall:
+            self.firewall.sync(blocklist.entries, now)
+    
+    def _send_alerts(self, alerts: List[Alert], timestamp: Optional[float]) -> bool:
+        if self.client.send_alerts(alerts, timestamp):
+            return True
+        if self.spool:
+            self.spool.write_alerts(alerts, timestamp)
+        return False
+    
+    def _replay_flush(self, now: float, final: bool):
+        self._flush(now, timestamp=now, final=final)
+    
+    def _tasks(self) -> List[tuple]:
+        """(name, interval, job, timeout) for each periodic task of the event loop."""
+        tasks = [
+            ("flow export", FLOW_UPLOAD_INTERVAL, self._export_flows, FLOW_UPLOAD_INTERVAL * 2),
+            ("alert dispatch", ALERT_INTERVAL, self._dispatch_alerts, ALERT_INTERVAL * 10),
+            ("heartbeat", HEARTBEAT_INTERVAL, self._heartbeat, HTTP_TIMEOUT),
+        ]
+        if isinstance(self.capture, SimpleCapture):
+            tasks.append(("connection poll", SIMPLE_POLL_INTERVAL, self.capture.poll,
+                          SIMPLE_POLL_INTERVAL * 10))
+        if self.blocklist is not None:
+            tasks.append(("blocklist refresh", BLOCKLIST_REFRESH_INTERVAL,
+                          self._refresh_blocklist, HTTP_TIMEOUT * 2))
+        if self.detector.signatures is not None:
+            tasks.append(("rule reload", RULES_RELOAD_INTERVAL,
+                          self.detector.signatures.maybe_reload, RULES_RELOAD_INTERVAL * 10))
+        return tasks
+    
+    async def _periodic(self, name: str, interval: float, job: Callable[[], Any],
+                        timeout: float, executor: ThreadPoolExecutor):
+        """Run ``job`` on a thread every ``interval``; a round still running is not doubled up."""
+        loop = asyncio.get_running_loop()
+        next_run = loop.time() + interval
+        running = None
+        while True:
+            await asyncio.sleep(max(0.0, next_run - loop.time()))
+            next_run = max(next_run + interval, loop.time())
+            if running is not None and not running.done():
+                self.logger.warning(f"{name} still running, skipping a round")
                 continue
+            running = loop.run_in_executor(executor, job)
+            try:
+                await asyncio.wait_for(asyncio.shield(running), timeout)
+            except asyncio.TimeoutError:
+                self.logger.warning(f"{name} took longer than {timeout:g}s")
+            except Exception as e:
+                self.logger.error(f"{name} failed: {e}")
+    
+    def _install_signal_handlers(self, loop: asyncio.AbstractEventLoop, stopping: asyncio.Event):
+        def request_stop():
+            if stopping.is_set():
+                self.logger.warning("Forced exit")
+                os._exit(1)
+            self.logger.info("Stopping, sending what is left (Ctrl+C again to force)...")
+            stopping.set()
+        
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, request_stop)
+            except (NotImplementedError, RuntimeError):      # Windows, or not the main thread
+                try:
+                    signal.signal(sig, lambda *_: loop.call_soon_threadsafe(request_stop))
+                except ValueError:
+                    pass
+        self._install_profile_signals()
+    
+    def _install_profile_signals(self):
+        """SIGUSR1 starts the profiler and SIGUSR2 stops it, here and in capture workers."""
+        if not hasattr(signal, "SIGUSR1"):                   # Windows
+            return
+        
+        def toggle(sig, _frame):
+            if sig == signal.SIGUSR1:
+                self.profiler.start()
+            else:
+                self.profiler.stop()
+            if isinstance(self.capture, ShardedCapture):
+                self.capture.signal_workers(sig)
+        
+        try:
+            signal.signal(signal.SIGUSR1, toggle)
+            signal.signal(signal.SIGUSR2, toggle)
+        except ValueError:                                   # not the main thread
+            pass
+    
+    async def _main(self):
+        """Capture reader and periodic tasks until the capture ends or a stop signal."""
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        self._install_signal_handlers(loop, stopping)
+        tasks = self._tasks()
+        executor = ThreadPoolExecutor(len(tasks) + 2, thread_name_prefix="snsm-task")
+        
+        waiters = [asyncio.ensure_future(stopping.wait())]
+        reader = None
+        if not isinstance(self.capture, SimpleCapture):
+            reader = loop.run_in_executor(executor, self.capture.start)
+            waiters.append(reader)
+        periodic = [asyncio.ensure_future(self._periodic(*task, executor)) for task in tasks]
+        
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in periodic + waiters[:1]:
+                task.cancel()
+            await asyncio.gather(*periodic, *waiters[:1], return_exceptions=True)
             
-            # Export and send flows
-            flows = self.capture.export_flows()
-            if flows:
-                if self.client.send_flows(flows):
-                    self.total_flows += len(flows)
-                    self.logger.debug(f"Sent {len(flows)} flows (total: {self.total_flows})")
-            
-            # Export and send alerts
-            alerts = self.capture.export_alerts()
-            if alerts:
-                self.client.send_alerts(alerts)
-            
-            # Heartbeat
-            if time.time() - last_heartbeat >= HEARTBEAT_INTERVAL:
-                self.client.heartbeat(self._get_system_stats())
-                last_heartbeat = time.time()
+            # Let the reader wind down, then flush and drain the uploads
+            await loop.run_in_executor(executor, self.capture.stop)
+            failure = None
+            if reader is not None:
+                try:
+                    await asyncio.wait_for(reader, CAPTURE_TICK * 5)
+                except asyncio.TimeoutError:
+                    self.logger.warning("Capture did not stop in time")
+                except Exception as e:
+                    failure = e
+            await loop.run_in_executor(executor, self.stop)
+            executor.shutdown(wait=False)
+            if failure is not None:
+                raise failure
     
     def run(self):
         self._print_banner()
         
-        # Get IP and register
-        public_ip = self._get_public_ip()
         hostname = socket.gethostname()
+        offline = isinstance(self.client, NDJSONWriter)
+        if offline:
+            self.client.register(hostname, "0.0.0.0")
+        else:
+            self._load_identity(hostname)
         
-        if not self.client.register(hostname, public_ip):
-            self.logger.error("Failed to register with backend!")
-            return
+        if not self.capture_options.read:
+            # Keep our own uploads out of the capture path
+            if not self.simple_mode:
+                self.capture_options.exclude.extend(backend_exclude_rules(BACKEND_URL))
+            
+            # Initialize capture
+            if self.simple_mode:
+                self.capture = SimpleCapture(self.logger, self.detector)
+            elif self.capture_options.workers > 1:
+                self.capture = ShardedCapture(self.interface, self.logger, self.detector,
+                                              self.capture_options)
+                # Fork the workers before this process starts any thread
+                self.capture.launch()
+            else:
+                self.capture = PacketCapture(self.interface, self.logger, self.detector,
+                                             self.capture_options)
+        self._start_uploads()
         
-        # Initialize capture
-        if self.simple_mode:
-            self.capture = SimpleCapture(self.logger, self.detector)
-        else:
-            self.capture = PacketCapture(self.interface, self.logger, self.detector)
+        if self.capture_options.read:
+            # A replay has no live traffic to miss, so set up before it starts
+            if not self.client.agent_id and not self._register(hostname):
+                self.logger.error("Failed to register with backend!")
+                return
+            if self.blocklist is not None:
+                self._refresh_blocklist()
         
-        self.running = True
+        if self.capture_options.profile:
+            self.profiler.start()
+        
+        if self.metrics_server:
+            try:
+                self.metrics_server.start()
+            except OSError as e:
+                self.logger.warning(f"Metrics endpoint disabled, cannot listen: {e}")
+                self.metrics_server = None
+        
+        if self.capture_options.read:
+            self._replay()
+            return
         
-        # Start upload thread
-        upload_thread = threading.Thread(target=self._upload_loop, daemon=True)
-        upload_thread.start()
+        self.running = True
+        if not offline:
+            # Registration and the first blocklist fetch must not hold up capture
+            threading.Thread(target=self._background_startup, args=(hostname,),
+                             name="snsm-register", daemon=True).start()
         
         self.logger.info("")
         self.logger.info("=" * 50)
@@ -697,17 +5483,43 @@ class SNSMAgent:
         self.logger.info("=" * 50)
         self.logger.info("")
         
+        asyncio.run(self._main())
+    
+    def _replay(self):
+        """Run a capture file through the pipeline on capture-file time."""
+        self.capture = ReplayCapture(self.logger, self.detector, self.capture_options,
+                                     self._replay_flush)
+        self.running = True
+        self._last_heartbeat = 0.0
+        self._install_profile_signals()
         try:
             self.capture.start()
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Cannot replay {self.capture_options.read}: {e}")
         except KeyboardInterrupt:
             pass
         finally:
             self.stop()
     
     def stop(self):
+        was_running = self.running
         self.running = False
+        self._stopped.set()
         if self.capture:
             self.capture.stop()
+            # Close out flows still in the table (replay does this at end of file)
+            if was_running and not self.capture_options.read:
+                self._flush(time.time(), final=True)
+        # Waits for queued uploads
+        if self.uploads:
+            self.uploads.close(timeout=HTTP_TIMEOUT)
+            self.total_flows = self.uploads.sent_flows
+        self.client.close()
+        if self.spool:
+            self.spool.close()
+        if self.metrics_server:
+            self.metrics_server.stop()
+        self.profiler.stop(wait=True)
         
         runtime = time.time() - self.start_time
         self.logger.info("")
@@ -768,6 +5580,221 @@ def main():
         action="store_true",
         help="Use simple mode (no root required, uses psutil)"
     )
+    parser.add_argument(
+        "--engine",
+        choices=["raw", "scapy"],
+        default="raw" if hasattr(socket, "AF_PACKET") else "scapy",
+        help="Capture engine: raw AF_PACKET socket (Linux, default) or scapy"
+    )
+    parser.add_argument(
+        "--ring",
+        action="store_true",
+        help="Capture through a TPACKET_V3 memory-mapped ring (raw engine, Linux)"
+    )
+    parser.add_argument(
+        "--ring-block-size",
+        type=int,
+        default=RING_BLOCK_SIZE,
+        help=f"Ring block size in bytes, a multiple of the page size (default: {RING_BLOCK_SIZE})"
+    )
+    parser.add_argument(
+        "--ring-blocks",
+        type=int,
+        default=RING_BLOCKS,
+        help=f"Number of ring blocks (default: {RING_BLOCKS})"
+    )
+    parser.add_argument(
+        "--ring-timeout",
+        type=int,
+        default=RING_RETIRE_TIMEOUT,
+        help=f"Block retire timeout in ms (default: {RING_RETIRE_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--filter",
+        default="",
+        help="tcpdump-style capture filter compiled to BPF (needs libpcap)"
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        default=[],
+        metavar="ITEM",
+        help="Drop traffic in the kernel: a port, IP/CIDR or hostname (repeatable)"
+    )
+    parser.add_argument(
+        "--local-net",
+        action="append",
+        default=[],
+        metavar="CIDR",
+        help="Network whose hosts count as local when ports do not orient a flow (repeatable; "
+             f"replaces the default {', '.join(LOCAL_NETWORKS)})"
+    )
+    parser.add_argument(
+        "--no-overload-sampling",
+        action="store_true",
+        help="Keep every flow even when the kernel drops packets (raw engine)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Capture processes sharing the interface via PACKET_FANOUT (raw engine, Linux)"
+    )
+    parser.add_argument(
+        "--read",
+        default="",
+        metavar="FILE",
+        help="Replay a pcap/pcapng file ('-' for stdin) instead of capturing live"
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=0.0,
+        metavar="X",
+        help="Replay at X times the recorded speed (default: as fast as possible)"
+    )
+    parser.add_argument(
+        "--output",
+        default="",
+        metavar="FILE",
+        help="Write flows/alerts/heartbeats as NDJSON to FILE ('-' for stdout) instead of the backend"
+    )
+    parser.add_argument(
+        "--active-timeout",
+        type=float,
+        default=FLOW_ACTIVE_TIMEOUT,
+        metavar="SEC",
+        help=f"Checkpoint flows running longer than this (default: {FLOW_ACTIVE_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=FLOW_IDLE_TIMEOUT,
+        metavar="SEC",
+        help=f"Close flows idle for this long (default: {FLOW_IDLE_TIMEOUT})"
+    )
+    parser.add_argument(
+        "--detector",
+        choices=sorted(DETECTORS),
+        default="exact",
+        help="Threat detector: exact per-source windows, or fixed-memory sketches for very many sources"
+    )
+    parser.add_argument(
+        "--max-sources",
+        type=int,
+        default=DETECTOR_MAX_SOURCES,
+        metavar="N",
+        help=f"Source addresses tracked by the detector (default: {DETECTOR_MAX_SOURCES})"
+    )
+    parser.add_argument(
+        "--state-memory",
+        type=int,
+        default=DETECTOR_MEMORY_MB,
+        metavar="MB",
+        help=f"Detector state memory budget in MB (default: {DETECTOR_MEMORY_MB})"
+    )
+    parser.add_argument(
+        "--score-weight",
+        action="append",
+        default=[],
+        metavar="RULE=N",
+        help=f"Flow threat score weight, e.g. malicious_port=60 (repeatable; "
+             f"rules: {', '.join(SCORE_WEIGHTS)})"
+    )
+    parser.add_argument(
+        "--rules",
+        default="",
+        metavar="PATH",
+        help=f"Signature rules file (Suricata subset); re-read when it changes, "
+             f"checked every {RULES_RELOAD_INTERVAL}s"
+    )
+    parser.add_argument(
+        "--no-blocklist",
+        action="store_true",
+        help="Do not fetch the backend blocklist"
+    )
+    parser.add_argument(
+        "--nft-sync",
+        action="store_true",
+        help=f"Drop blocklisted traffic with nftables (table inet {NFT_TABLE}, Linux, needs root)"
+    )
+    parser.add_argument(
+        "--upload-format",
+        choices=FlowBatchEncoder.FORMATS,
+        default=UPLOAD_FORMAT,
+        help=f"Wire format for flow uploads (default: {UPLOAD_FORMAT})"
+    )
+    parser.add_argument(
+        "--compress",
+        action="store_true",
+        default=UPLOAD_COMPRESS,
+        help="Gzip flow uploads (needs the updated agent-flows function)"
+    )
+    parser.add_argument(
+        "--aggregate",
+        action="store_true",
+        help=f"Upload low-value flows as per-{AGGREGATE_INTERVAL}s summaries and report "
+             f"top talkers and services"
+    )
+    parser.add_argument(
+        "--upload-overflow",
+        choices=UploadPipeline.OVERFLOW,
+        default=UPLOAD_OVERFLOW,
+        help=f"What to do with flows the backend cannot keep up with (default: {UPLOAD_OVERFLOW})"
+    )
+    parser.add_argument(
+        "--spool-dir",
+        default=SPOOL_DIR,
+        metavar="DIR",
+        help=f"Keep undelivered flows and alerts here until the backend is back (default: {SPOOL_DIR})"
+    )
+    parser.add_argument(
+        "--no-spool",
+        action="store_true",
+        help="Do not spool undelivered flows and alerts to disk"
+    )
+    parser.add_argument(
+        "--spool-max",
+        type=int,
+        default=SPOOL_MAX_MB,
+        metavar="MB",
+        help=f"Spool size cap; the oldest records are deleted beyond it (default: {SPOOL_MAX_MB})"
+    )
+    parser.add_argument(
+        "--spool-fsync",
+        choices=Spool.FSYNC,
+        default=SPOOL_FSYNC,
+        help=f"When spool writes are flushed to disk (default: {SPOOL_FSYNC})"
+    )
+    parser.add_argument(
+        "--reregister",
+        action="store_true",
+        help=f"Register with the backend again instead of reusing the agent ID saved in "
+             f"{IDENTITY_FILE}"
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="[HOST:]PORT",
+        help=f"Serve /metrics (Prometheus) and /metrics.json with per-stage timings "
+             f"(host defaults to {METRICS_HOST})"
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile from startup until SIGUSR2 or exit (SIGUSR1/SIGUSR2 start and "
+             "stop profiling at any time)"
+    )
+    parser.add_argument(
+        "--profile-memory",
+        action="store_true",
+        help="Also trace allocations while profiling (slows capture several times over)"
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=PROFILE_DIR,
+        metavar="DIR",
+        help=f"Where profiles are written (default: {PROFILE_DIR})"
+    )
     parser.add_argument(
         "-v", "--verbose",
         action="store_true",
@@ -781,31 +5808,105 @@ def main():
     
     args = parser.parse_args()
     
-    if args.list:
-        list_interfaces()
-        return
+    if args.ring and args.engine != "raw":
+        parser.error("--ring requires the raw capture engine")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and (args.engine != "raw" or args.simple):
+        parser.error("--workers requires the raw capture engine")
+    if args.read and (args.simple or args.workers > 1):
+        parser.error("--read cannot be combined with --simple or --workers")
+    if args.active_timeout <= 0 or args.idle_timeout <= 0:
+        parser.error("--active-timeout and --idle-timeout must be positive")
+    if args.max_sources < 1 or args.state_memory < 1:
+        parser.error("--max-sources and --state-memory must be at least 1")
+    if args.spool_max < 1:
+        parser.error("--spool-max must be at least 1")
+    if args.nft_sync and (args.no_blocklist or args.output):
+        parser.error("--nft-sync needs the backend blocklist (not --no-blocklist or --output)")
+    if args.rules and not os.path.isfile(args.rules):
+        parser.error(f"--rules: {args.rules} is not a file")
+    
+    score_weights = {}
+    for item in args.score_weight:
+        rule, _, value = item.partition("=")
+        if rule not in SCORE_WEIGHTS:
+            parser.error(f"--score-weight: unknown rule {rule!r}")
+        try:
+            score_weights[rule] = int(value)
+        except ValueError:
+            parser.error(f"--score-weight: {item!r} needs an integer weight")
+    
+    exclude = []
+    for item in args.exclude:
+        try:
+            exclude.extend(parse_exclude(item))
+        except ValueError as e:
+            parser.error(f"--exclude: {e}")
     
-    # Handle Ctrl+C gracefully
-    agent = None
+    for cidr in args.local_net:
+        try:
+            ipaddress.ip_network(cidr, strict=False)
+        except ValueError as e:
+            parser.error(f"--local-net: {e}")
     
-    def signal_handler(sig, frame):
-        if agent:
-            agent.stop()
-        sys.exit(0)
+    metrics_address = None
+    if args.metrics:
+        host, _, port = args.metrics.rpartition(":")
+        host = host.strip("[]") or METRICS_HOST
+        try:
+            metrics_address = (host, int(port))
+        except ValueError:
+            parser.error(f"--metrics: {args.metrics!r} needs a port number")
+        if not 0 <= metrics_address[1] <= 65535:
+            parser.error(f"--metrics: port {metrics_address[1]} out of range")
     
-    signal.signal(signal.SIGINT, signal_handler)
+    if args.list:
+        list_interfaces()
+        return
     
     # Auto-detect interface if not specified
     interface = args.interface
-    if not interface and not args.simple:
-        try:
-            from scapy.all import conf
-            interface = conf.iface
-        except:
-            interface = "eth0"
+    if not interface and not args.simple and not args.read:
+        interface = default_interface()
+        if not interface and args.engine == "scapy":
+            try:
+                from scapy.all import conf           # slow import; only when /proc has no answer
+                interface = conf.iface
+            except:
+                interface = "eth0"
     
-    agent = SNSMAgent(interface, args.simple, args.verbose)
-    agent.run()
+    capture_options = CaptureOptions(
+        engine=args.engine,
+        ring=args.ring,
+        ring_block_size=args.ring_block_size,
+        ring_blocks=args.ring_blocks,
+        ring_timeout=args.ring_timeout,
+        filter=args.filter,
+        exclude=exclude,
+        local_networks=args.local_net or list(LOCAL_NETWORKS),
+        workers=args.workers,
+        read=args.read,
+        replay_speed=args.replay_speed,
+        active_timeout=args.active_timeout,
+        idle_timeout=args.idle_timeout,
+        overload_sampling=not args.no_overload_sampling,
+        profile=args.profile,
+        profile_memory=args.profile_memory,
+        profile_dir=args.profile_dir
+    )
+    agent = SNSMAgent(interface, args.simple, args.verbose, capture_options, args.output,
+                      args.max_sources, args.state_memory, args.detector,
+                      UploadOptions(args.upload_format, args.compress,
+                                    args.upload_overflow,
+                                    "" if args.no_spool else args.spool_dir,
+                                    args.spool_max, args.spool_fsync),
+                      score_weights, args.rules, not args.no_blocklist, args.nft_sync,
+                      metrics_address, reregister=args.reregister, aggregate=args.aggregate)
+    try:
+        agent.run()
+    except KeyboardInterrupt:                    # before the event loop took over
+        agent.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,728 @@
+#!/usr/bin/env python3
+"""
+SNSM Agent Benchmarks
+=====================
+
+Measures the agent's per-packet hot path and its export/upload path with
+synthetic traffic. Needs no network access and no root: frames are built
+in memory and fed through the same parse -> flow -> detector code as the
+raw capture engine, and uploads go to a local stub of the Supabase
+functions.
+
+Usage:
+    python3 snsm-bench.py                           # All scenarios, JSON to stdout
+    python3 snsm-bench.py -o results.json           # Save results for comparison
+    python3 snsm-bench.py --scenarios web,synflood  # Selected scenarios
+    python3 snsm-bench.py --packets 50000           # Packets per scenario
+    python3 snsm-bench.py --detector sketch         # Fixed-memory detector
+
+Results are JSON so that runs can be compared across releases.
+"""
+
+import argparse
+import gzip
+import importlib.util
+import json
+import logging
+import multiprocessing
+import operator
+import os
+import platform
+import random
+import resource
+import socket
+import string
+import struct
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Tuple
+
+# ============================================================================
+# CONFIGURATION
+# ============================================================================
+
+AGENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snsm-agent.py")
+
+DEFAULT_PACKETS = 100_000
+EXPORT_BATCH_SIZES = [100, 1_000, 10_000]
+UPLOAD_BATCH_SIZES = [100, 1_000, 5_000]
+UPLOAD_ROUNDS = 5
+PIPELINE_FLOWS = 50_000
+SIGNATURE_RULE_COUNTS = [10, 100, 1_000, 10_000]
+SIGNATURE_PACKETS = 20_000
+FANOUT_WORKERS = 4
+FANOUT_CONNECTIONS = 64      # loopback UDP exchanges sent through the fanout group
+
+DETECTOR = "exact"
+SAMPLING = 8                 # overload sampling rate for sampled_pps
+
+LOCAL_NET = "192.168.1."
+SERVER_IP = "192.168.1.10"
+
+# ============================================================================
+# AGENT LOADING
+# ============================================================================
+
+def load_agent():
+    """Import snsm-agent.py as a module (its file name is not importable)."""
+    spec = importlib.util.spec_from_file_location("snsm_agent", AGENT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["snsm_agent"] = module
+    spec.loader.exec_module(module)
+    return module
+
+agent = load_agent()
+
+def quiet_logger() -> logging.Logger:
+    logger = logging.getLogger("snsm-bench")
+    logger.setLevel(logging.CRITICAL)
+    logger.propagate = False
+    return logger
+
+# ============================================================================
+# SYNTHETIC TRAFFIC
+# ============================================================================
+
+def ethernet_frame(src_ip: str, dst_ip: str, src_port: int, dst_port: int,
+                   proto: int = 6, payload_len: int = 0, payload: bytes = b"") -> bytes:
+    """Build an Ethernet/IPv4/TCP-or-UDP frame; the payload is zeroed unless given."""
+    payload = payload or b"\x00" * payload_len
+    payload_len = len(payload)
+    if proto == 6:
+        l4 = struct.pack("!HHIIBBHHH", src_port, dst_port, 0, 0, 0x50, 0x18, 65535, 0, 0)
+    else:
+        l4 = struct.pack("!HHHH", src_port, dst_port, 8 + payload_len, 0)
+    total = 20 + len(l4) + payload_len
+    ip = struct.pack("!BBHHHBBH4s4s", 0x45, 0, total, 0, 0, 64, proto, 0,
+                     socket.inet_aton(src_ip), socket.inet_aton(dst_ip))
+    return b"\x00" * 12 + b"\x08\x00" + ip + l4 + payload
+
+def gen_web(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """Normal web browsing: many short client/server exchanges, ~5k pps."""
+    servers = [f"93.184.{rng.randrange(256)}.{rng.randrange(1, 255)}" for _ in range(50)]
+    packets, ts = [], 1_700_000_000.0
+    while len(packets) < count:
+        client = LOCAL_NET + str(rng.randrange(2, 250))
+        server = rng.choice(servers)
+        port = rng.choice((80, 443, 443, 443))
+        eph = rng.randrange(32768, 61000)
+        for i in range(rng.randrange(4, 40)):
+            if i % 3 == 0:
+                frame = ethernet_frame(client, server, eph, port, payload_len=rng.randrange(0, 600))
+            else:
+                frame = ethernet_frame(server, client, port, eph, payload_len=rng.randrange(200, 1400))
+            packets.append((frame, ts))
+            ts += 0.0002
+    return packets[:count]
+
+def gen_portscan(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """One scanner sweeping every port of one host, ~20k pps."""
+    scanner = "203.0.113.66"
+    return [
+        (ethernet_frame(scanner, SERVER_IP, 40000 + (i % 1000), 1 + (i % 65535)),
+         1_700_000_000.0 + i * 0.00005)
+        for i in range(count)
+    ]
+
+def gen_synflood(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """SYN flood from random spoofed sources at one web server, ~100k pps."""
+    return [
+        (ethernet_frame(socket.inet_ntoa(struct.pack("!I", rng.getrandbits(32))),
+                        SERVER_IP, rng.randrange(1024, 65535), 80),
+         1_700_000_000.0 + i * 0.00001)
+        for i in range(count)
+    ]
+
+def gen_flood(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """100k pps from a single source to one service."""
+    frame = ethernet_frame("203.0.113.99", SERVER_IP, 55555, 80)
+    return [(frame, 1_700_000_000.0 + i * 0.00001) for i in range(count)]
+
+def gen_distscan(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """Thousands of sources each probing a few ports of one host."""
+    return [
+        (ethernet_frame(f"198.18.{rng.randrange(256)}.{rng.randrange(1, 255)}", SERVER_IP,
+                        rng.randrange(1024, 65535), 1 + rng.randrange(10000)),
+         1_700_000_000.0 + i * 0.0001)
+        for i in range(count)
+    ]
+
+def gen_elephant(count: int, rng: random.Random) -> List[Tuple[bytes, float]]:
+    """A handful of long-lived bulk transfers with full-size frames."""
+    flows = [(LOCAL_NET + str(20 + i), f"198.51.100.{i + 1}", 50000 + i, 443) for i in range(8)]
+    packets = []
+    for i in range(count):
+        client, server, eph, port = flows[i % len(flows)]
+        if i % 10:
+            frame = ethernet_frame(server, client, port, eph, payload_len=1400)
+        else:
+            frame = ethernet_frame(client, server, eph, port)
+        packets.append((frame, 1_700_000_000.0 + i * 0.0001))
+    return packets
+
+SCENARIOS: Dict[str, Callable[[int, random.Random], List[Tuple[bytes, float]]]] = {
+    "web": gen_web,
+    "portscan": gen_portscan,
+    "synflood": gen_synflood,
+    "flood": gen_flood,
+    "distscan": gen_distscan,
+    "elephant": gen_elephant,
+}
+
+# ============================================================================
+# HOT PATH BENCHMARKS
+# ============================================================================
+
+def percentile(sorted_values: List[int], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))
+    return sorted_values[index]
+
+def new_capture(options=None):
+    logger = quiet_logger()
+    detector = agent.DETECTORS[DETECTOR](logger)
+    return agent.PacketCapture("", logger, detector, options)
+
+def run_scenario(name: str, count: int, seed: int) -> dict:
+    """Throughput, latency and memory for one traffic mix (runs in a child process)."""
+    packets = SCENARIOS[name](count, random.Random(seed))
+    parse = agent.parse_ethernet
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Parser alone
+    start = time.perf_counter()
+    for frame, _ in packets:
+        parse(memoryview(frame))
+    parse_elapsed = time.perf_counter() - start
+
+    # Detector alone
+    parsed = [(parse(memoryview(frame)), ts) for frame, ts in packets]
+    detector = agent.DETECTORS[DETECTOR](quiet_logger())
+    server_ip = agent.pack_ip(SERVER_IP)
+    start = time.perf_counter()
+    for (src_ip, dst_ip, src_port, dst_port, proto, _), ts in parsed:
+        detector.analyze_packet(src_ip, dst_ip, src_port, dst_port, proto, server_ip, ts)
+    analyze_elapsed = time.perf_counter() - start
+
+    # Full per-packet path: parse + flow update + detection
+    capture = new_capture()
+    record = capture._record_packet
+    start = time.perf_counter()
+    for frame, ts in packets:
+        view = memoryview(frame)
+        record(*parse(view), len(frame), ts, view)
+    full_elapsed = time.perf_counter() - start
+
+    # Same path with --metrics stage sampling on
+    capture = new_capture(agent.CaptureOptions(metrics_sample=agent.METRICS_SAMPLE))
+    capture._parse = parse
+    record = capture._record_packet
+    start = time.perf_counter()
+    for frame, ts in packets:
+        view = memoryview(frame)
+        record(*parse(view), len(frame), ts, view)
+    metrics_elapsed = time.perf_counter() - start
+
+    # Same path under overload sampling (1 in SAMPLING flows kept)
+    capture = new_capture()
+    capture.sampling_rate = SAMPLING
+    record = capture._record_packet
+    start = time.perf_counter()
+    for frame, ts in packets:
+        view = memoryview(frame)
+        record(*parse(view), len(frame), ts, view)
+    sampled_elapsed = time.perf_counter() - start
+
+    # Per-packet latency on fresh state
+    capture = new_capture()
+    record = capture._record_packet
+    clock = time.perf_counter_ns
+    latencies = []
+    for frame, ts in packets:
+        t0 = clock()
+        view = memoryview(frame)
+        record(*parse(view), len(frame), ts, view)
+        latencies.append(clock() - t0)
+    # Cost trend: mean latency per tenth of the run (flat means O(1) per packet)
+    tenth = max(1, len(latencies) // 10)
+    trend = [round(sum(latencies[i:i + tenth]) / len(latencies[i:i + tenth]) / 1000, 2)
+             for i in range(0, len(latencies), tenth)][:10]
+    latencies.sort()
+    flows = len(capture.flows)
+    alerts = capture.alert_queue.qsize()
+    # Upload rows left after --aggregate rolls up the final export
+    aggregated = agent.FlowAggregator().add(capture.export_flows(flush=True), packets[-1][1],
+                                            flush=True)
+
+    return {
+        "packets": len(packets),
+        "pps": round(len(packets) / full_elapsed),
+        "metrics_pps": round(len(packets) / metrics_elapsed),
+        "sampled_pps": round(len(packets) / sampled_elapsed),
+        "parse_pps": round(len(packets) / parse_elapsed),
+        "analyze_pps": round(len(packets) / analyze_elapsed),
+        "latency_us": {
+            "p50": round(percentile(latencies, 50) / 1000, 2),
+            "p99": round(percentile(latencies, 99) / 1000, 2),
+            "max": round(latencies[-1] / 1000, 2),
+        },
+        "latency_trend_us": trend,
+        "flows": flows,
+        "aggregated_rows": len(aggregated),
+        "alerts": alerts,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before,
+    }
+
+def _scenario_child(name: str, count: int, seed: int, conn):
+    conn.send(run_scenario(name, count, seed))
+    conn.close()
+
+def run_isolated(name: str, count: int, seed: int) -> dict:
+    """Run a scenario in a fresh process so peak RSS is per scenario."""
+    ctx = multiprocessing.get_context("fork")
+    parent, child = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_scenario_child, args=(name, count, seed, child))
+    proc.start()
+    child.close()
+    result = parent.recv()
+    proc.join()
+    return result
+
+# ============================================================================
+# EXPORT / SERIALIZE BENCHMARKS
+# ============================================================================
+
+def fill_flows(capture, count: int):
+    rng = random.Random(count)
+    now = 1_700_000_000.0
+    for i in range(count):
+        capture._record_packet(
+            agent.pack_ip(LOCAL_NET + str(2 + i % 240)),
+            agent.pack_ip(f"198.51.{i // 250 % 256}.{i % 250 + 1}"),
+            32768 + i % 28000, rng.choice((80, 443, 22, 4444)), "tcp", 54,
+            rng.randrange(60, 1500), now + i * 0.0001
+        )
+
+def make_flows(count: int) -> list:
+    capture = new_capture()
+    fill_flows(capture, count)
+    return capture.export_flows(flush=True)
+
+def score_flows_numpy(np, detector, flows: list) -> list:
+    """NumPy column version of ``ThreatDetector.score_flows``, for comparison.
+    
+    Returns the scores instead of setting them. The agent does not use
+    this: filling the columns from Flow objects costs as much as the whole
+    scalar loop, so the result is no faster.
+    """
+    n = len(flows)
+    weights = detector.score_weights
+    table = np.zeros(65536, dtype=np.int64)
+    for port, score in detector._port_scores.items():
+        table[port] = score
+    
+    def column(name, dtype=np.int64):
+        return np.fromiter(map(operator.attrgetter(name), flows), dtype, count=n)
+    
+    scores = table[column("dst_port")]
+    scores += (column("bytes_sent") > agent.SCORE_UPLOAD_BYTES) * weights["large_upload"]
+    scores += (column("bytes_recv") > agent.SCORE_DOWNLOAD_BYTES) * weights["large_download"]
+    burst = ((column("packets_sent") + column("packets_recv") > agent.SCORE_BURST_PACKETS)
+             & (column("end_time", np.float64) - column("start_time", np.float64)
+                < agent.SCORE_BURST_SECONDS))
+    scores += burst * weights["packet_burst"]
+    np.minimum(scores, 100, out=scores)
+    return scores.tolist()
+
+
+def bench_export(sizes: List[int]) -> List[dict]:
+    results = []
+    for size in sizes:
+        capture = new_capture()
+        fill_flows(capture, size)
+        start = time.perf_counter()
+        flows = capture.export_flows(flush=True)
+        export_elapsed = time.perf_counter() - start
+
+        detector = capture.detector
+        server_ip = agent.pack_ip(SERVER_IP)
+        start = time.perf_counter()
+        for flow in flows:
+            detector.calculate_threat_score(flow, server_ip)
+        score_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        detector.score_flows(flows)
+        batch_elapsed = time.perf_counter() - start
+
+        numpy_result = None
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+        if np is not None:
+            start = time.perf_counter()
+            scores = score_flows_numpy(np, detector, flows)
+            numpy_result = {
+                "score_flows_numpy_ms": round((time.perf_counter() - start) * 1000, 3),
+                "matches_score_flows": scores == [f.threat_score for f in flows],
+            }
+
+        start = time.perf_counter()
+        rows = [f.to_dict() for f in flows]
+        to_dict_elapsed = time.perf_counter() - start
+
+        start = time.perf_counter()
+        body = json.dumps({"agent_id": "bench", "flows": rows}).encode()
+        dumps_elapsed = time.perf_counter() - start
+
+        # Batch encoder, per wire format
+        encoders = {}
+        for fmt in agent.FlowBatchEncoder.FORMATS:
+            for compress in (False, True):
+                encoder = agent.FlowBatchEncoder(fmt, compress)
+                start = time.perf_counter()
+                encoded = b"".join(encoder.encode("bench", flows))
+                encoders[fmt + ("+gzip" if compress else "")] = {
+                    "encode_ms": round((time.perf_counter() - start) * 1000, 3),
+                    "body_bytes": len(encoded),
+                }
+
+        results.append({
+            "batch_size": size,
+            "export_flows_ms": round(export_elapsed * 1000, 3),
+            "calculate_threat_score_ms": round(score_elapsed * 1000, 3),
+            "score_flows_ms": round(batch_elapsed * 1000, 3),
+            "numpy": numpy_result,
+            "to_dict_ms": round(to_dict_elapsed * 1000, 3),
+            "json_dumps_ms": round(dumps_elapsed * 1000, 3),
+            "body_bytes": len(body),
+            "encoders": encoders,
+        })
+    return results
+
+# ============================================================================
+# SIGNATURE BENCHMARKS
+# ============================================================================
+
+def signature_rules(count: int, rng: random.Random) -> str:
+    """A rules file mixing port-only, content, nocase-content and CIDR rules."""
+    lines = []
+    for sid in range(1, count + 1):
+        port = rng.randrange(1, 65536)
+        pattern = "".join(rng.choice(string.ascii_letters) for _ in range(10))
+        kind = sid % 4
+        if sid == 1:
+            lines.append(f'alert tcp any any -> any 8080 (msg:"bench"; content:"user-agent: BENCH"; nocase; sid:{sid};)')
+        elif kind == 0:
+            lines.append(f'alert tcp any any -> $HOME_NET {port} (msg:"port {port}"; sid:{sid};)')
+        elif kind == 1:
+            lines.append(f'alert tcp any any -> any any (msg:"{pattern}"; content:"{pattern}"; sid:{sid};)')
+        elif kind == 2:
+            lines.append(f'alert tcp any any -> any {port} (content:"{pattern}"; nocase; sid:{sid};)')
+        else:
+            lines.append(f'alert ip 10.{rng.randrange(256)}.0.0/16 any -> any any (sid:{sid};)')
+    return "\n".join(lines)
+
+def bench_signatures(counts: List[int], packets: int) -> List[dict]:
+    """Per-packet match cost as the rule count grows (flat means no per-rule loop)."""
+    rng = random.Random(7)
+    words = [b"GET ", b"/index.html ", b"HTTP/1.1\r\n", b"Host: example.com\r\n",
+             b"Accept: */*\r\n", b"User-Agent: bench\r\n"]
+    frames = []
+    for i in range(packets):
+        payload = b"".join(rng.choice(words) for _ in range(rng.randrange(2, 40)))
+        frames.append(memoryview(ethernet_frame(
+            LOCAL_NET + str(2 + i % 240), f"93.184.{i % 256}.{i % 250 + 1}",
+            32768 + i % 28000, rng.choice((80, 443, 8080)), payload=payload)))
+    parsed = [(agent.parse_ethernet(frame), frame) for frame in frames]
+    payload_bytes = sum(len(frame) - fields[5] for fields, frame in parsed)
+
+    results = []
+    for count in counts:
+        start = time.perf_counter()
+        rules, _ = agent.parse_rules(signature_rules(count, random.Random(count)))
+        ruleset = agent.RuleSet(rules)
+        compile_elapsed = time.perf_counter() - start
+
+        match = ruleset.match
+        matches = 0
+        start = time.perf_counter()
+        for (src_ip, dst_ip, src_port, dst_port, proto, offset), frame in parsed:
+            matches += len(match(src_ip, dst_ip, src_port, dst_port, proto, frame, offset))
+        elapsed = time.perf_counter() - start
+        results.append({
+            "rules": count,
+            "compile_ms": round(compile_elapsed * 1000, 1),
+            "automaton_kb": ruleset.memory_bytes() >> 10,
+            "match_us_per_packet": round(elapsed / packets * 1e6, 2),
+            "payload_mb_per_sec": round(payload_bytes / elapsed / 1e6, 1),
+            "matches": matches,
+        })
+    return results
+
+# ============================================================================
+# UPLOAD BENCHMARKS (local stub backend)
+# ============================================================================
+
+class StubBackendHandler(BaseHTTPRequestHandler):
+    """Answers like the Supabase agent-* functions without touching a database."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True   # keep-alive replies go out as two writes
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b"".join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_POST(self):
+        body = self._read_body()
+        self.server.bytes_received += len(body)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        self.server.requests += 1
+        if self.path.endswith("/agent-register"):
+            reply = {"success": True, "agent_id": "bench-agent-0000"}
+        else:
+            reply = {"success": True}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_backend() -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBackendHandler)
+    server.daemon_threads = True
+    server.bytes_received = 0
+    server.requests = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_upload(sizes: List[int], rounds: int) -> List[dict]:
+    server = start_stub_backend()
+    url = f"http://127.0.0.1:{server.server_address[1]}/functions/v1"
+
+    results = []
+    try:
+        for size, (fmt, compress) in (
+                (size, variant) for size in sizes
+                for variant in (("json", False), ("columnar", True))):
+            client = agent.SNSMClient(url, "bench-key", quiet_logger(),
+                                      agent.UploadOptions(fmt, compress))
+            client.register("bench-host", "127.0.0.1")
+            flows = make_flows(size)
+            server.bytes_received = 0
+            latencies = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                ok = client.send_flows(flows)
+                latencies.append(time.perf_counter() - start)
+                if not ok:
+                    raise RuntimeError("stub backend rejected upload")
+            latencies.sort()
+            pool = client.stats()
+            client.close()
+            results.append({
+                "batch_size": size,
+                "format": fmt + ("+gzip" if compress else ""),
+                "rounds": rounds,
+                "send_flows_ms_p50": round(percentile(latencies, 50) * 1000, 3),
+                "send_flows_ms_max": round(latencies[-1] * 1000, 3),
+                "flows_per_sec": round(size * rounds / sum(latencies)),
+                "wire_bytes_per_batch": server.bytes_received // rounds,
+                "connections": pool["upload_connections"],
+                "reuse_ratio": pool["upload_reuse_ratio"],
+            })
+    finally:
+        server.shutdown()
+    return results
+
+def bench_fanout(workers: int, connections: int) -> dict:
+    """Spread of loopback traffic over a --workers fanout group (needs root).
+    
+    Each connection is one request and one reply between 127.0.0.1 and
+    127.0.0.x. On ``lo`` every packet is seen twice: once on transmit
+    (PACKET_OUTGOING) and once on receive (PACKET_HOST). Both must be spread
+    across workers, and each source address must stay on one worker. The
+    two directions of a connection may be split; the parent merges them.
+    """
+    group = (os.getpid() + 1) & 0xFFFF
+    try:
+        socks = []
+        for _ in range(workers):
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(agent.ETH_P_ALL))
+            sock.bind(("lo", 0))
+            agent.join_fanout(sock, group)
+            sock.setblocking(False)
+            socks.append(sock)
+    except (PermissionError, AttributeError, OSError) as e:
+        return {"skipped": str(e)}
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+    for i in range(connections):
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind((f"127.0.0.{2 + i}", 0))
+        client.sendto(b"ping", ("127.0.0.1", port))
+        _, peer = server.recvfrom(64)
+        server.sendto(b"pong", peer)
+        client.recv(64)
+        client.close()
+    server.close()
+    time.sleep(0.1)
+
+    per_type = {socket.PACKET_HOST: [0] * workers, socket.PACKET_OUTGOING: [0] * workers}
+    shards: Dict[tuple, set] = {}
+    sources: Dict[bytes, set] = {}
+    for index, sock in enumerate(socks):
+        while True:
+            try:
+                frame, addr = sock.recvfrom(2048)
+            except BlockingIOError:
+                break
+            if len(frame) < 42 or frame[23] != 17:         # IPv4 UDP only
+                continue
+            sport, dport = struct.unpack_from("!HH", frame, 34)
+            if port not in (sport, dport) or addr[2] not in per_type:
+                continue
+            per_type[addr[2]][index] += 1
+            pair = tuple(sorted((frame[26:30], frame[30:34])))
+            shards.setdefault(pair, set()).add(index)
+            sources.setdefault(frame[26:30], set()).add(index)
+        sock.close()
+    return {
+        "workers": workers,
+        "connections": connections,
+        "host_per_worker": per_type[socket.PACKET_HOST],
+        "outgoing_per_worker": per_type[socket.PACKET_OUTGOING],
+        "split_sources": sum(len(seen) > 1 for seen in sources.values()),
+        "split_connections": sum(len(seen) > 1 for seen in shards.values()),
+    }
+
+def bench_pipeline(total: int) -> dict:
+    """One large export pushed through the batching upload pipeline."""
+    server = start_stub_backend()
+    url = f"http://127.0.0.1:{server.server_address[1]}/functions/v1"
+    try:
+        client = agent.SNSMClient(url, "bench-key", quiet_logger())
+        client.register("bench-host", "127.0.0.1")
+        pipeline = agent.UploadPipeline(client, quiet_logger())
+        flows = make_flows(total)
+        start = time.perf_counter()
+        pipeline.put(flows)
+        pipeline.close()
+        elapsed = time.perf_counter() - start
+        client.close()
+    finally:
+        server.shutdown()
+    return {
+        "flows": total,
+        "batches": pipeline.sent_batches,
+        "final_batch_flows": pipeline.batch_rows,
+        "elapsed_ms": round(elapsed * 1000, 1),
+        "flows_per_sec": round(pipeline.sent_flows / elapsed),
+        "connections": client.stats()["upload_connections"],
+    }
+
+# ============================================================================
+# ENTRY POINT
+# ============================================================================
+
+def main():
+    global DETECTOR
+    parser = argparse.ArgumentParser(description="SNSM Agent benchmarks")
+    parser.add_argument(
+        "--scenarios",
+        default=",".join(SCENARIOS),
+        help=f"Comma-separated traffic mixes (default: {','.join(SCENARIOS)})"
+    )
+    parser.add_argument(
+        "--packets",
+        type=int,
+        default=DEFAULT_PACKETS,
+        help=f"Packets per scenario (default: {DEFAULT_PACKETS})"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed for the synthetic traffic"
+    )
+    parser.add_argument(
+        "--detector",
+        choices=sorted(agent.DETECTORS),
+        default=DETECTOR,
+        help=f"Threat detector mode (default: {DETECTOR})"
+    )
+    parser.add_argument(
+        "--skip-upload",
+        action="store_true",
+        help="Skip the stub-backend upload benchmark"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        default="-",
+        help="Write JSON results to this file (default: stdout)"
+    )
+
+    args = parser.parse_args()
+    names = [n for n in args.scenarios.split(",") if n]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    DETECTOR = args.detector
+
+    results = {
+        "meta": {
+            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "packets_per_scenario": args.packets,
+            "seed": args.seed,
+            "detector": args.detector,
+        },
+        "scenarios": {},
+    }
+    for name in names:
+        print(f"scenario {name}...", file=sys.stderr)
+        results["scenarios"][name] = run_isolated(name, args.packets, args.seed)
+
+    print("export...", file=sys.stderr)
+    results["export"] = bench_export(EXPORT_BATCH_SIZES)
+    print("signatures...", file=sys.stderr)
+    results["signatures"] = bench_signatures(SIGNATURE_RULE_COUNTS, SIGNATURE_PACKETS)
+    print("fanout...", file=sys.stderr)
+    results["fanout"] = bench_fanout(FANOUT_WORKERS, FANOUT_CONNECTIONS)
+    if not args.skip_upload:
+        print("upload...", file=sys.stderr)
+        results["upload"] = bench_upload(UPLOAD_BATCH_SIZES, UPLOAD_ROUNDS)
+        results["pipeline"] = bench_pipeline(PIPELINE_FLOWS)
+
+    text = json.dumps(results, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        print(f"results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Shared setup for the agent tests.
+
+snsm-agent.py is a script, not a package, so it is loaded by path under the
+same module name snsm-bench.py uses. Tests then ``import snsm_agent``.
+"""
+
+import importlib.util
+import os
+import struct
+import sys
+
+import pytest
+
+AGENT_PATH = os.path.join(os.path.dirname(__file__), os.pardir, "snsm-agent.py")
+
+if "snsm_agent" not in sys.modules:
+    spec = importlib.util.spec_from_file_location("snsm_agent", AGENT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["snsm_agent"] = module
+    spec.loader.exec_module(module)
+
+import snsm_agent as agent  # noqa: E402
+
+
+def ipv4_packet(src: str, dst: str, src_port: int = 0, dst_port: int = 0, proto: int = 6,
+                payload: bytes = b"", frag: int = 0, options: bytes = b"") -> bytes:
+    """An IPv4 packet with a TCP, UDP or bare transport header."""
+    if proto == 6:
+        l4 = struct.pack("!HHIIBBHHH", src_port, dst_port, 0, 0, 0x50, 0x18, 65535, 0, 0)
+    elif proto in (17, 132):
+        l4 = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0)
+    else:
+        l4 = b"\x08\x00\x00\x00\x00\x00\x00\x00"
+    ihl = 5 + len(options) // 4
+    total = ihl * 4 + len(l4) + len(payload)
+    header = struct.pack("!BBHHHBBH4s4s", 0x40 | ihl, 0, total, 0, frag, 64, proto, 0,
+                         agent.pack_ip(src), agent.pack_ip(dst))
+    return header + options + l4 + payload
+
+
+def ipv6_packet(src: str, dst: str, src_port: int = 0, dst_port: int = 0, proto: int = 6,
+                payload: bytes = b"", extension: bytes = b"") -> bytes:
+    """An IPv6 packet; ``extension`` is one hop-by-hop header placed before TCP/UDP."""
+    if proto == 6:
+        l4 = struct.pack("!HHIIBBHHH", src_port, dst_port, 0, 0, 0x50, 0x18, 65535, 0, 0)
+    else:
+        l4 = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0)
+    next_header = proto
+    if extension:
+        extension = bytes([proto]) + extension[1:]
+        next_header = 0
+    body = extension + l4 + payload
+    header = struct.pack("!IHBB16s16s", 6 << 28, len(body), next_header, 64,
+                         agent.pack_ip(src), agent.pack_ip(dst))
+    return header + body
+
+
+def ethernet(packet: bytes, vlans: int = 0) -> bytes:
+    """Wrap an IP packet in an Ethernet II header, with ``vlans`` 802.1Q tags."""
+    ethertype = 0x86DD if packet[0] >> 4 == 6 else 0x0800
+    tags = b"".join(struct.pack("!HH", 0x8100, 100 + i) for i in range(vlans))
+    return b"\x02" * 6 + b"\x04" * 6 + tags + struct.pack("!H", ethertype) + packet
+
+
+@pytest.fixture
+def logger():
+    import logging
+
+    log = logging.getLogger("snsm-test")
+    log.addHandler(logging.NullHandler())
+    log.propagate = False
+    return log
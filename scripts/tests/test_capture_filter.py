@@ -0,0 +1,170 @@
+"""Kernel filters: the --exclude compiler and the PACKET_FANOUT selector.
+
+Programs are run through a small classic BPF interpreter. The exclude
+compiler is checked against libpcap's pcap_compile() for the same
+expression when libpcap is installed.
+"""
+
+import ctypes.util
+import ipaddress
+import itertools
+
+import pytest
+
+import snsm_agent as agent
+from conftest import ethernet, ipv4_packet, ipv6_packet
+
+SKF_NET_OFF = 0xFFF00000
+
+
+def run_bpf(program, packet: bytes, net_offset: int = 0) -> int:
+    """Return value of a classic BPF program (0 drops the packet)."""
+    a = x = 0
+    mem = [0] * 16
+    pc = 0
+    while True:
+        code, jt, jf, k = program[pc]
+        pc += 1
+        cls, mode = code & 0x07, code & 0xE0
+        if cls == 0x00:                                   # LD
+            if mode == 0x00:
+                a = k
+            elif mode == 0x60:
+                a = mem[k]
+            elif mode == 0x80:
+                a = len(packet)
+            else:
+                offset = k + x if mode == 0x40 else k
+                if offset >= SKF_NET_OFF:
+                    offset += net_offset - SKF_NET_OFF
+                size = {0x00: 4, 0x08: 2, 0x10: 1}[code & 0x18]
+                if offset + size > len(packet):
+                    return 0
+                a = int.from_bytes(packet[offset:offset + size], "big")
+        elif cls == 0x01:                                 # LDX
+            if mode == 0xA0:
+                if k >= len(packet):
+                    return 0
+                x = (packet[k] & 0x0F) * 4
+            elif mode == 0x60:
+                x = mem[k]
+            elif mode == 0x80:
+                x = len(packet)
+            else:
+                x = k
+        elif cls == 0x02:
+            mem[k] = a
+        elif cls == 0x03:
+            mem[k] = x
+        elif cls == 0x04:                                 # ALU
+            operand = x if code & 0x08 else k
+            op = code & 0xF0
+            a = {
+                0x00: lambda: a + operand, 0x10: lambda: a - operand,
+                0x20: lambda: a * operand, 0x30: lambda: a // operand,
+                0x40: lambda: a | operand, 0x50: lambda: a & operand,
+                0x60: lambda: a << operand, 0x70: lambda: a >> operand,
+                0x80: lambda: -a, 0x90: lambda: a % operand, 0xA0: lambda: a ^ operand,
+            }[op]() & 0xFFFFFFFF
+        elif cls == 0x05:                                 # JMP
+            operand = x if code & 0x08 else k
+            op = code & 0xF0
+            if op == 0x00:
+                pc += k
+                continue
+            taken = {0x10: a == operand, 0x20: a > operand,
+                     0x30: a >= operand, 0x40: bool(a & operand)}[op]
+            pc += jt if taken else jf
+        elif cls == 0x06:                                 # RET
+            return a if code & 0x18 == 0x10 else k
+        else:                                             # MISC
+            if code & 0xF8 == 0x80:
+                a = x
+            else:
+                x = a
+
+
+def rule(network=None, port=None):
+    return agent.ExcludeRule(None if network is None else ipaddress.ip_network(network), port)
+
+
+PACKETS = [
+    ipv4_packet("10.0.0.1", "192.0.2.7", 50000, 443),
+    ipv4_packet("192.0.2.7", "10.0.0.1", 443, 50000),
+    ipv4_packet("10.1.2.3", "198.51.100.1", 40000, 53, 17),
+    ipv4_packet("198.51.100.1", "10.1.2.3", 53, 40000, 17),
+    ipv4_packet("172.16.0.5", "172.16.0.6", 443, 22),
+    ipv4_packet("172.16.0.5", "10.0.0.1", 0, 0, 1),
+    ipv4_packet("172.16.0.5", "10.0.0.1", 1234, 443, frag=10),
+    ipv4_packet("172.16.0.5", "192.0.2.7", 1234, 443, options=b"\x01" * 8),
+    ipv6_packet("2001:db8::1", "2001:db8:1::2", 50000, 443),
+    ipv6_packet("2001:db8:1::2", "2001:db8::1", 443, 50000),
+    ipv6_packet("fd00::5", "fd00::6", 40000, 53, 17),
+    ipv6_packet("fd00::5", "2001:db8::1", 443, 40000),
+]
+
+# pcap's "port" also covers SCTP, whose ports the agent does not parse
+SCTP_PACKETS = [
+    ipv4_packet("10.0.0.1", "192.0.2.7", 50000, 443, 132),
+    ipv6_packet("2001:db8::1", "fd00::6", 53, 40000, 132),
+]
+
+RULE_SETS = [
+    [rule(port=443)],
+    [rule("10.0.0.0/8")],
+    [rule("10.1.2.3/32", 53)],
+    [rule("2001:db8::/32")],
+    [rule("2001:db8::1/128", 443)],
+    [rule("192.0.2.7/32"), rule(port=53), rule("fd00::/8", 443)],
+]
+
+
+@pytest.mark.parametrize("rules", RULE_SETS, ids=lambda rules: agent.exclude_expression(rules))
+def test_exclude_filter_semantics(rules):
+    """A packet is dropped exactly when some rule's network and port both match."""
+    program = agent.compile_exclude_filter(rules)
+    for packet in PACKETS:
+        parsed = agent.parse_ip(memoryview(packet))
+        src, dst, sport, dport = (ipaddress.ip_address(parsed[0]), ipaddress.ip_address(parsed[1]),
+                                  parsed[2], parsed[3])
+        excluded = any(
+            (r.network is None or src in r.network or dst in r.network)
+            and (r.port is None or r.port in (sport, dport))
+            for r in rules
+        )
+        assert bool(run_bpf(program, ethernet(packet))) != excluded
+        assert bool(run_bpf(agent.compile_exclude_filter(rules, raw_ip=True), packet)) != excluded
+
+
+@pytest.mark.skipif(not ctypes.util.find_library("pcap"), reason="libpcap not installed")
+@pytest.mark.parametrize("rules", RULE_SETS, ids=lambda rules: agent.exclude_expression(rules))
+def test_exclude_filter_matches_pcap_compile(rules):
+    expression = f"not ({agent.exclude_expression(rules)})"
+    for raw_ip, linktype in ((False, agent.DLT_EN10MB), (True, agent.DLT_RAW)):
+        ours = agent.compile_exclude_filter(rules, raw_ip)
+        theirs = agent.compile_pcap_filter(expression, linktype)
+        for packet in PACKETS + SCTP_PACKETS:
+            frame = packet if raw_ip else ethernet(packet)
+            assert bool(run_bpf(ours, frame)) == bool(run_bpf(theirs, frame)), packet.hex()
+
+
+def test_exclude_filter_passes_non_ip():
+    arp = b"\xff" * 12 + b"\x08\x06" + b"\x00" * 28
+    assert run_bpf(agent.compile_exclude_filter([rule(port=443)]), arp)
+
+
+def test_fanout_hashes_on_the_source_address():
+    program = agent.compile_fanout_program()
+    shards = 4
+    for make, addresses in ((ipv4_packet, [f"10.0.{i}.{j}" for i in range(4) for j in range(8)]),
+                            (ipv6_packet, [f"2001:db8::{i:x}" for i in range(32)])):
+        seen = set()
+        for src in addresses:
+            picks = {run_bpf(program, make(src, dst, sport, 443)) % shards
+                     for dst, sport in itertools.product(addresses[:6], (1000, 2000))}
+            assert len(picks) == 1                       # every destination, every port
+            seen |= picks
+        assert seen == set(range(shards))                # and sources spread over shards
+    # Loads are relative to the network header, whatever precedes it
+    packet = ipv4_packet("10.0.0.1", "10.0.0.2", 1, 2)
+    assert run_bpf(program, ethernet(packet), 14) == run_bpf(program, packet)
@@ -0,0 +1,99 @@
+"""FlowTable: orientation, timeouts, eviction, overload sampling and shard merge."""
+
+import snsm_agent as agent
+
+CLIENT, SERVER = agent.pack_ip("10.0.0.5"), agent.pack_ip("192.0.2.80")
+
+
+def table(**kwargs):
+    return agent.FlowTable(lambda ip: ip.startswith(b"\x0a"), **kwargs)
+
+
+def test_first_packet_from_the_server_is_oriented_client_first():
+    flows = table()
+    flows.update(SERVER, CLIENT, 443, 50000, "tcp", 1500, 1.0)
+    flows.update(CLIENT, SERVER, 50000, 443, "tcp", 100, 1.1)
+    [flow] = flows.export(2.0, flush=True)
+    assert (flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port) == (CLIENT, 50000, SERVER, 443)
+    assert (flow.bytes_sent, flow.packets_sent) == (100, 1)
+    assert (flow.bytes_recv, flow.packets_recv) == (1500, 1)
+
+
+def test_equal_ports_take_the_local_endpoint_as_client():
+    flows = table()
+    flows.update(SERVER, CLIENT, 0, 0, "icmp", 84, 1.0)
+    [flow] = flows.export(2.0, flush=True)
+    assert (flow.src_ip, flow.dst_ip, flow.packets_recv) == (CLIENT, SERVER, 1)
+
+
+def test_idle_flows_are_closed():
+    flows = table(idle_timeout=15, active_timeout=60)
+    flows.update(CLIENT, SERVER, 50000, 443, "tcp", 100, 100.0)
+    assert flows.export(114.0) == []
+    [flow] = flows.export(115.0)
+    assert flow.packets_sent == 1 and len(flows) == 0
+
+
+def test_long_running_flows_are_checkpointed():
+    flows = table(idle_timeout=15, active_timeout=60)
+    for second in range(0, 70, 5):
+        flows.update(CLIENT, SERVER, 50000, 443, "tcp", 100, 100.0 + second)
+    [record] = flows.export(165.0)
+    assert (record.start_time, record.end_time, record.packets_sent) == (100.0, 165.0, 14)
+    # The flow stays open and counts again from the checkpoint
+    assert len(flows) == 1
+    flows.update(CLIENT, SERVER, 50000, 443, "tcp", 100, 166.0)
+    [rest] = flows.export(200.0)
+    assert (rest.start_time, rest.packets_sent) == (165.0, 1)
+
+
+def test_full_table_closes_the_least_recently_active_flow():
+    flows = table(max_flows=2)
+    flows.update(CLIENT, SERVER, 50001, 443, "tcp", 100, 1.0)
+    flows.update(CLIENT, SERVER, 50002, 443, "tcp", 100, 2.0)
+    flows.update(CLIENT, SERVER, 50001, 443, "tcp", 100, 3.0)     # 50002 is now oldest
+    flows.update(CLIENT, SERVER, 50003, 443, "tcp", 100, 4.0)
+    assert flows.evicted == 1
+    [closed] = flows.export(5.0)
+    assert closed.src_port == 50002
+    assert sorted(f.src_port for f in flows.export(5.0, flush=True)) == [50001, 50003]
+
+
+def test_sampling_is_decided_once_when_a_flow_starts():
+    flows = table()
+    ports = range(40000, 40256)
+    kept = [port for port in ports
+            if flows.update(CLIENT, SERVER, port, 443, "tcp", 100, 1.0, rate=8)]
+    assert 0 < len(kept) < len(ports) and len(flows) == len(kept)
+    # Replies share the decision
+    for port in ports:
+        assert flows.update(SERVER, CLIENT, 443, port, "tcp", 1000, 2.0, rate=8) == (port in kept)
+    # Kept flows count at their creation rate after it drops
+    for port in kept:
+        assert flows.update(CLIENT, SERVER, port, 443, "tcp", 100, 2.5, rate=1)
+    records = flows.export(3.0, flush=True)
+    assert {f.sampling_rate for f in records} == {8}
+    assert all((f.packets_sent, f.bytes_sent, f.packets_recv, f.bytes_recv) == (16, 1600, 8, 8000)
+               for f in records)
+
+
+def test_flows_started_before_sampling_stay_exact():
+    flows = table()
+    for port in range(40000, 40064):
+        flows.update(CLIENT, SERVER, port, 443, "tcp", 100, 1.0)
+    assert all(flows.update(CLIENT, SERVER, port, 443, "tcp", 100, 2.0, rate=64)
+               for port in range(40000, 40064))
+    records = flows.export(3.0, flush=True)
+    assert {(f.sampling_rate, f.packets_sent) for f in records} == {(1, 2)}
+
+
+def test_merge_joins_directions_from_different_shards():
+    outbound, inbound = table(), table()
+    outbound.update(CLIENT, SERVER, 50000, 443, "tcp", 100, 1.0)
+    inbound.update(SERVER, CLIENT, 443, 50000, "tcp", 1500, 1.5)
+    merged = table()
+    merged.merge(outbound.export(2.0, flush=True))
+    merged.merge(inbound.export(2.0, flush=True))
+    [flow] = merged.drain()
+    assert (flow.src_ip, flow.bytes_sent, flow.bytes_recv) == (CLIENT, 100, 1500)
+    assert (flow.start_time, flow.end_time) == (1.0, 1.5)
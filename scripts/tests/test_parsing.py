@@ -0,0 +1,56 @@
+"""Packet parsing: parse_ethernet and the IP layer beneath it."""
+
+import struct
+
+import snsm_agent as agent
+from conftest import ethernet, ipv4_packet, ipv6_packet
+
+
+def parse(frame: bytes):
+    return agent.parse_ethernet(memoryview(frame))
+
+
+def test_ipv4_tcp():
+    frame = ethernet(ipv4_packet("10.0.0.1", "192.0.2.7", 50000, 443, payload=b"hello"))
+    src, dst, sport, dport, proto, payload_offset = parse(frame)
+    assert (agent.format_ip(src), agent.format_ip(dst)) == ("10.0.0.1", "192.0.2.7")
+    assert (sport, dport, proto) == (50000, 443, "tcp")
+    assert frame[payload_offset:] == b"hello"
+
+
+def test_ipv4_udp_with_options():
+    options = b"\x01\x01\x01\x00"                    # NOP NOP NOP EOL
+    frame = ethernet(ipv4_packet("10.0.0.1", "10.0.0.2", 5353, 53, 17, b"q", options=options))
+    src, dst, sport, dport, proto, payload_offset = parse(frame)
+    assert (sport, dport, proto) == (5353, 53, "udp")
+    assert frame[payload_offset:] == b"q"
+
+
+def test_vlan_tags():
+    packet = ipv4_packet("10.0.0.1", "10.0.0.2", 1234, 80)
+    assert parse(ethernet(packet, vlans=2))[2:5] == (1234, 80, "tcp")
+
+
+def test_ipv4_non_first_fragment_has_no_ports():
+    frame = ethernet(ipv4_packet("10.0.0.1", "10.0.0.2", 1234, 80, frag=185))
+    assert parse(frame)[2:5] == (0, 0, "other")
+
+
+def test_icmp():
+    frame = ethernet(ipv4_packet("10.0.0.1", "10.0.0.2", proto=1))
+    assert parse(frame)[2:5] == (0, 0, "icmp")
+
+
+def test_ipv6_tcp_after_extension_header():
+    extension = b"\x00\x00" + b"\x01\x04\x00\x00\x00\x00"   # hop-by-hop, PadN
+    frame = ethernet(ipv6_packet("2001:db8::1", "2001:db8::2", 40000, 22, payload=b"SSH",
+                                 extension=extension))
+    src, dst, sport, dport, proto, payload_offset = parse(frame)
+    assert agent.format_ip(src) == "2001:db8::1"
+    assert (sport, dport, proto) == (40000, 22, "tcp")
+    assert frame[payload_offset:] == b"SSH"
+
+
+def test_non_ip_is_ignored():
+    arp = b"\xff" * 6 + b"\x04" * 6 + struct.pack("!H", 0x0806) + b"\x00" * 28
+    assert parse(arp) is None
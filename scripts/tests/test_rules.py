@@ -0,0 +1,107 @@
+"""Signature rules: parse_rules and RuleSet.match on real frames."""
+
+import snsm_agent as agent
+from conftest import ethernet, ipv4_packet, ipv6_packet
+
+RULES = r"""
+# Lab ruleset
+var ADMIN_NET [192.0.2.0/24, 2001:db8:a::/48]
+alert tcp any any -> $HOME_NET 23 (msg:"Telnet to home"; sid:1; severity:high;)
+alert tcp $EXTERNAL_NET any -> $HOME_NET $HTTP_PORTS (msg:"Shell probe"; \
+    content:"/bin/sh"; classtype:web-application-attack; sid:2; priority:1;)
+alert tcp any any -> any any (msg:"Agent string"; content:"SNSM-TEST"; nocase; sid:3;)
+alert udp any any -> any 53 (msg:"Two parts"; content:"|de ad|"; content:"beef"; sid:4;)
+alert ip $ADMIN_NET any -> any ![22,1024:] (msg:"Admin low port"; sid:5; priority:3;)
+alert tcp any any <> 198.51.100.9 any (msg:"Either way"; sid:6;)
+alert tcp any any -> any 80 (msg:"Broken"; content:"x"; sid:7; bogus;)
+alert tcp any any -> any 80 (msg:"Again"; sid:1;)
+drop tcp any any -> any 80 (msg:"Unsupported action"; sid:8;)
+"""
+
+
+def ruleset():
+    rules, skipped = agent.parse_rules(RULES)
+    return agent.RuleSet(rules), skipped
+
+
+def sids(rules, packet, vlans=0):
+    frame = memoryview(ethernet(packet, vlans))
+    src, dst, sport, dport, proto, payload_offset = agent.parse_ethernet(frame)
+    return sorted(rule.sid for rule in rules.match(src, dst, sport, dport, proto,
+                                                   frame, payload_offset))
+
+
+def test_parse_rules_skips_bad_lines_and_duplicate_sids(logger):
+    rules, skipped = agent.parse_rules(RULES, logger)
+    assert skipped == 3                                  # bad option, duplicate sid, drop
+    assert sorted({rule.sid for rule in rules}) == [1, 2, 3, 4, 5, 6]
+    assert len(rules) == 7                               # <> adds the reverse direction
+    by_sid = {rule.sid: rule for rule in rules}
+    assert (by_sid[1].severity, by_sid[2].severity, by_sid[5].severity) == ("high", "high", "low")
+    assert by_sid[2].category == "web-application-attack"
+    assert by_sid[3].contents == [(b"snsm-test", True)]
+    assert by_sid[4].contents == [(b"\xde\xad", False), (b"beef", False)]
+    assert by_sid[5].dst_ports == ((0, 21), (23, 1023))
+
+
+def test_header_only_rules():
+    rules, _ = ruleset()
+    assert sids(rules, ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 23)) == [1]
+    assert sids(rules, ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 23, 17)) == []
+    assert sids(rules, ipv4_packet("203.0.113.1", "8.8.8.8", 40000, 23)) == []
+
+
+def test_bidirectional_rule_matches_both_ways():
+    rules, _ = ruleset()
+    assert sids(rules, ipv4_packet("10.0.0.5", "198.51.100.9", 40000, 443)) == [6]
+    assert sids(rules, ipv4_packet("198.51.100.9", "10.0.0.5", 443, 40000)) == [6]
+
+
+def test_content_and_variables():
+    rules, _ = ruleset()
+    probe = b"GET /cgi-bin/x?c=/bin/sh HTTP/1.1\r\n"
+    assert sids(rules, ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 8080, payload=probe)) == [2]
+    # $EXTERNAL_NET excludes the home networks
+    assert sids(rules, ipv4_packet("10.0.0.9", "10.0.0.5", 40000, 8080, payload=probe)) == []
+    # not an $HTTP_PORTS port
+    assert sids(rules, ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 8081, payload=probe)) == []
+    assert sids(rules, ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 8080, payload=b"GET /")) == []
+
+
+def test_nocase_content_through_vlan_tags():
+    rules, _ = ruleset()
+    packet = ipv6_packet("2001:db8::1", "2001:db8::2", 40000, 9000, payload=b"ua: Snsm-Test/1.0")
+    assert sids(rules, packet, vlans=1) == [3]
+    assert sids(rules, ipv6_packet("2001:db8::1", "2001:db8::2", 40000, 9000,
+                                   payload=b"SNSM_TEST")) == []
+
+
+def test_every_content_of_a_rule_must_match():
+    rules, _ = ruleset()
+    both = b"\x00\xde\xad\x00 beef"
+    assert sids(rules, ipv4_packet("10.0.0.5", "10.0.0.53", 5353, 53, 17, both)) == [4]
+    assert sids(rules, ipv4_packet("10.0.0.5", "10.0.0.53", 5353, 53, 17, b"\xde\xad")) == []
+    assert sids(rules, ipv4_packet("10.0.0.5", "10.0.0.53", 5353, 53, 17, b"beef")) == []
+
+
+def test_negated_port_list_and_any_protocol():
+    rules, _ = ruleset()
+    assert sids(rules, ipv4_packet("192.0.2.4", "8.8.8.8", 40000, 443)) == [5]
+    assert sids(rules, ipv4_packet("192.0.2.4", "8.8.8.8", 40000, 53, 17)) == [5]
+    assert sids(rules, ipv6_packet("2001:db8:a::4", "2001:db8::2", 40000, 21)) == [5]
+    assert sids(rules, ipv4_packet("192.0.2.4", "8.8.8.8", 40000, 22)) == []
+    assert sids(rules, ipv4_packet("192.0.2.4", "8.8.8.8", 40000, 8080)) == []
+    assert sids(rules, ipv4_packet("192.0.2.5", "8.8.8.8", proto=1)) == [5]
+
+
+def test_detector_rate_limits_signature_alerts(logger):
+    rules, _ = agent.parse_rules(RULES)
+    detector = agent.ThreatDetector(logger)
+    detector.signatures = type("Engine", (), {"match": agent.RuleSet(rules).match})()
+    frame = memoryview(ethernet(ipv4_packet("203.0.113.1", "10.0.0.5", 40000, 23)))
+    parsed = agent.parse_ethernet(frame)
+    first = detector.match_signatures(*parsed[:5], frame, parsed[5], now=100.0)
+    assert [alert.signature_id for alert in first] == ["SNSM-SIG-1"]
+    assert detector.match_signatures(*parsed[:5], frame, parsed[5], now=110.0) == []
+    assert len(detector.match_signatures(*parsed[:5], frame, parsed[5],
+                                         now=100.0 + agent.SIGNATURE_COOLDOWN + 1)) == 1
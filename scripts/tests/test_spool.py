@@ -0,0 +1,133 @@
+"""Spool: batches written while the backend is down are replayed intact."""
+
+import threading
+import time
+
+import pytest
+
+import snsm_agent as agent
+
+
+class Backend:
+    """Stands in for SNSMClient; refuses everything until ``up`` is set."""
+
+    def __init__(self, up=True):
+        self.up = up
+        self.flows = []
+        self.alerts = []
+        self.received = threading.Event()
+
+    def send_flows(self, flows, timestamp=None):
+        if self.up:
+            self.flows.append((flows, timestamp))
+            self.received.set()
+        return self.up
+
+    def send_alerts(self, alerts, timestamp=None):
+        if self.up:
+            self.alerts.append((alerts, timestamp))
+            self.received.set()
+        return self.up
+
+
+@pytest.fixture(autouse=True)
+def fast_replay(monkeypatch):
+    monkeypatch.setattr(agent, "SPOOL_DRAIN_RATE", 1000)
+    monkeypatch.setattr(agent, "SPOOL_RETRY_INTERVAL", 0.05)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+FLOW = agent.Flow(agent.pack_ip("10.0.0.5"), agent.pack_ip("2001:db8::1"), 50000, 443, "tcp",
+                  1200, 34000, 10, 30, 100.0, 102.5, "HTTPS", 12, 8)
+ALERT = agent.Alert("PORTSCAN", "Port Scan Detected", "high", "reconnaissance",
+                    agent.pack_ip("198.51.100.9"), agent.pack_ip("10.0.0.5"), 0, 0, "tcp")
+
+
+def fields(flow):
+    return [getattr(flow, name) for name in agent.Flow.__slots__]
+
+
+def test_flows_and_alerts_are_replayed_with_their_timestamps(tmp_path, logger):
+    backend = Backend()
+    spool = agent.Spool(str(tmp_path), backend, logger, fsync="never")
+    try:
+        spool.write_flows([FLOW], 1000.0)
+        spool.write_alerts([ALERT], 2000.0)
+        wait_for(lambda: backend.flows and backend.alerts)
+        [(flows, flows_stamp)] = backend.flows
+        [(alerts, alerts_stamp)] = backend.alerts
+        assert [fields(f) for f in flows] == [fields(FLOW)]
+        assert (flows_stamp, alerts == [ALERT], alerts_stamp) == (1000.0, True, 2000.0)
+        wait_for(lambda: spool.stats()["spool_bytes"] == 0)
+        assert spool.stats()["spool_replayed_batches"] == 2
+    finally:
+        spool.close()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_segments_from_a_previous_run_are_replayed(tmp_path, logger):
+    down = Backend(up=False)
+    spool = agent.Spool(str(tmp_path), down, logger, fsync="never")
+    for i in range(3):
+        spool.write_flows([FLOW], 1000.0 + i)
+    time.sleep(0.1)                                      # refused at least once
+    spool.close()
+    assert down.flows == [] and spool.stats()["spool_batches"] == 3
+    assert list(tmp_path.iterdir())
+
+    backend = Backend()
+    spool = agent.Spool(str(tmp_path), backend, logger, fsync="never")
+    try:
+        wait_for(lambda: len(backend.flows) == 3)
+        assert [stamp for _, stamp in backend.flows] == [1000.0, 1001.0, 1002.0]
+        wait_for(lambda: spool.stats()["spool_segments"] == 0)
+    finally:
+        spool.close()
+
+
+def test_replay_resumes_after_the_batch_that_failed(tmp_path, logger):
+    backend = Backend(up=False)
+    spool = agent.Spool(str(tmp_path), backend, logger, fsync="never")
+    try:
+        for i in range(3):
+            spool.write_flows([FLOW], 1000.0 + i)
+        time.sleep(0.1)
+        backend.up = True
+        wait_for(lambda: len(backend.flows) == 3)
+        time.sleep(0.1)
+        assert [stamp for _, stamp in backend.flows] == [1000.0, 1001.0, 1002.0]
+    finally:
+        spool.close()
+
+
+def test_oldest_segments_are_evicted_over_the_cap(tmp_path, logger, monkeypatch):
+    monkeypatch.setattr(agent, "SPOOL_SEGMENT_BYTES", 1)   # one batch per segment
+    backend = Backend(up=False)
+    spool = agent.Spool(str(tmp_path), backend, logger, max_bytes=1000, fsync="never")
+    try:
+        for i in range(20):
+            spool.write_flows([FLOW], 1000.0 + i)
+        stats = spool.stats()
+        assert stats["spool_bytes"] <= 1000 and stats["spool_evicted_bytes"] > 0
+        assert stats["spool_segments"] == len(list(tmp_path.iterdir()))
+    finally:
+        spool.close()
+
+
+def test_torn_last_line_is_skipped(tmp_path, logger):
+    (tmp_path / f"{0:012d}.spool").write_bytes(b'{"kind":"flows","timestamp":1,"ro')
+    backend = Backend()
+    spool = agent.Spool(str(tmp_path), backend, logger, fsync="never")
+    try:
+        spool.write_flows([FLOW], 1000.0)
+        wait_for(lambda: backend.flows)
+        wait_for(lambda: spool.stats()["spool_segments"] == 0)
+        assert [stamp for _, stamp in backend.flows] == [1000.0]
+    finally:
+        spool.close()
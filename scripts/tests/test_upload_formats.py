@@ -0,0 +1,99 @@
+"""FlowBatchEncoder: the three body formats decode to the same per-flow rows."""
+
+import gzip
+import json
+
+import pytest
+
+import snsm_agent as agent
+
+STAMP = 1_700_000_000.0
+
+
+def flows():
+    return [
+        agent.Flow(agent.pack_ip("10.0.0.5"), agent.pack_ip("192.0.2.80"), 50000, 443, "tcp",
+                   1200, 34000, 10, 30, 100.0, 102.5, threat_score=5),
+        agent.Flow(agent.pack_ip("2001:db8::1"), agent.pack_ip("2001:db8::53"), 40000, 53, "udp",
+                   64, 128, 1, 1, 100.0, 100.0, service="dns-internal", sampling_rate=8),
+        agent.Flow(agent.pack_ip("10.0.0.5"), agent.pack_ip("198.51.100.9"), 0, 0, "icmp",
+                   84, 0, 1, 0, 101.0, 101.25, threat_score=40, sampling_rate=64),
+    ]
+
+
+EXPECTED = [
+    {"src_ip": "10.0.0.5", "dst_ip": "192.0.2.80", "src_port": 50000, "dst_port": 443,
+     "protocol": "tcp", "bytes_sent": 1200, "bytes_recv": 34000, "packets_sent": 10,
+     "packets_recv": 30, "duration": 2.5, "service": "https", "threat_score": 5,
+     "sampling_rate": 1},
+    {"src_ip": "2001:db8::1", "dst_ip": "2001:db8::53", "src_port": 40000, "dst_port": 53,
+     "protocol": "udp", "bytes_sent": 64, "bytes_recv": 128, "packets_sent": 1,
+     "packets_recv": 1, "duration": 0.0, "service": "dns-internal", "threat_score": 0,
+     "sampling_rate": 8},
+    {"src_ip": "10.0.0.5", "dst_ip": "198.51.100.9", "src_port": 0, "dst_port": 0,
+     "protocol": "icmp", "bytes_sent": 84, "bytes_recv": 0, "packets_sent": 1,
+     "packets_recv": 0, "duration": 0.25, "service": None, "threat_score": 40,
+     "sampling_rate": 64},
+]
+
+
+def encode(fmt, compress, batch, chunk_rows=2):
+    encoder = agent.FlowBatchEncoder(fmt, compress, chunk_rows)
+    body = b"".join(encoder.encode("agent-1", batch, STAMP))
+    if compress:
+        assert encoder.headers()["Content-Encoding"] == "gzip"
+        body = gzip.decompress(body)
+    else:
+        assert "Content-Encoding" not in encoder.headers()
+    return encoder, body.decode()
+
+
+def decode(fmt, text):
+    """Rows as dicts, plus the batch-level fields."""
+    if fmt == "ndjson":
+        header, *lines = text.splitlines()
+        header = json.loads(header)
+        names = header.pop("columns")
+        return [dict(zip(names, json.loads(line))) for line in lines], header
+    document = json.loads(text)
+    if fmt == "columnar":
+        columns = document.pop("columns")
+        assert document.pop("count") == len(columns["src_ip"])
+        return [dict(zip(columns, values)) for values in zip(*columns.values())], document
+    rows = document.pop("flows")
+    for row in rows:
+        assert row.pop("timestamp") == agent.iso_timestamp(STAMP)
+    return rows, document
+
+
+@pytest.mark.parametrize("compress", [False, True], ids=["plain", "gzip"])
+@pytest.mark.parametrize("fmt", agent.FlowBatchEncoder.FORMATS)
+def test_formats_carry_every_flow_field(fmt, compress):
+    encoder, text = encode(fmt, compress, flows())
+    rows, batch = decode(fmt, text)
+    assert rows == EXPECTED
+    assert batch["agent_id"] == "agent-1"
+    assert batch["sampling_rate"] == 64                  # summary: the highest row rate
+    assert encoder.headers()["Content-Type"] == (
+        "application/x-ndjson" if fmt == "ndjson" else "application/json")
+
+
+@pytest.mark.parametrize("fmt", agent.FlowBatchEncoder.FORMATS)
+def test_json_rows_match_flow_to_dict(fmt):
+    batch = flows()
+    rows, _ = decode(fmt, encode(fmt, False, batch)[1])
+    for row, flow in zip(rows, batch):
+        record = flow.to_dict(STAMP)
+        del record["timestamp"]
+        assert row == record
+
+
+@pytest.mark.parametrize("fmt", agent.FlowBatchEncoder.FORMATS)
+def test_empty_batch(fmt):
+    rows, batch = decode(fmt, encode(fmt, True, [])[1])
+    assert rows == [] and batch["sampling_rate"] == 1
+
+
+def test_unknown_format_is_rejected():
+    with pytest.raises(ValueError):
+        agent.FlowBatchEncoder("xml")
@@ -0,0 +1,97 @@
+"""UploadPipeline: overflow shedding and delivery of what is left."""
+
+import threading
+import time
+
+import snsm_agent as agent
+
+CLIENT, SERVER = agent.pack_ip("10.0.0.5"), agent.pack_ip("192.0.2.80")
+
+
+class Backend:
+    """Stands in for SNSMClient; ``send_flows`` blocks until ``release`` is set."""
+
+    def __init__(self):
+        self.encoder = agent.FlowBatchEncoder()
+        self.release = threading.Event()
+        self.batches = []
+
+    def send_flows(self, flows, timestamp=None):
+        self.release.wait(5)
+        self.batches.append((list(flows), timestamp))
+        return True
+
+
+def connections(count, start_port=40000, dst_port=443):
+    return [agent.Flow(CLIENT, SERVER, start_port + i, dst_port, "tcp", 100, 1000, 1, 1,
+                       10.0, 11.0, sampling_rate=1 + (i % 2)) for i in range(count)]
+
+
+def pipeline(backend, logger, **kwargs):
+    """A one-sender pipeline whose sender is already blocked on a first batch."""
+    uploads = agent.UploadPipeline(backend, logger, concurrency=1, **kwargs)
+    uploads.put(connections(1), 1.0)
+    deadline = time.monotonic() + 5
+    while not uploads.in_flight:
+        assert time.monotonic() < deadline, "sender never took the batch"
+        time.sleep(0.01)
+    return uploads
+
+
+def test_aggregate_merges_source_ports_without_touching_the_input():
+    flows = connections(3) + connections(2, dst_port=22)
+    before = [(f.src_port, f.bytes_sent) for f in flows]
+    merged = agent.UploadPipeline.aggregate(flows)
+    assert [(f.src_port, f.dst_port, f.bytes_sent, f.packets_recv, f.sampling_rate)
+            for f in merged] == [(0, 443, 300, 3, 2), (0, 22, 200, 2, 2)]
+    assert [(f.src_port, f.bytes_sent) for f in flows] == before
+    assert agent.UploadPipeline.aggregate(flows[:1])[0] is flows[0]
+
+
+def test_aggregate_overflow_keeps_each_export_timestamp(logger):
+    backend = Backend()
+    uploads = pipeline(backend, logger, max_queued=10)
+    try:
+        uploads.put(connections(6), 2.0)
+        uploads.put(connections(6, 41000), 2.0)         # same export: merged into one item
+        stats = uploads.stats()
+        assert (stats["upload_queue_flows"], stats["upload_aggregated_flows"]) == (1, 11)
+        uploads.put(connections(6, 42000, 22), 3.0)
+        uploads.put(connections(6, 43000, 22), 4.0)     # another export: kept apart
+        stats = uploads.stats()
+        assert (stats["upload_queue_flows"], stats["upload_aggregated_flows"]) == (3, 21)
+        assert stats["upload_dropped_flows"] == 0
+        backend.release.set()
+    finally:
+        uploads.close(timeout=5)
+    assert [(len(flows), stamp) for flows, stamp in backend.batches] == [
+        (1, 1.0), (1, 2.0), (1, 3.0), (1, 4.0)]
+    assert [flows[0].packets_sent for flows, _ in backend.batches] == [1, 12, 6, 6]
+
+
+def test_drop_overflow_sheds_the_oldest_flows(logger):
+    backend = Backend()
+    uploads = pipeline(backend, logger, overflow="drop", max_queued=5)
+    try:
+        uploads.put(connections(4), 2.0)
+        uploads.put(connections(4, 41000), 3.0)
+        assert uploads.stats()["upload_dropped_flows"] == 3
+        backend.release.set()
+    finally:
+        uploads.close(timeout=5)
+    sent = [(f.src_port, stamp) for flows, stamp in backend.batches for f in flows]
+    assert sent == [(40000, 1.0), (40003, 2.0)] + [(41000 + i, 3.0) for i in range(4)]
+
+
+def test_score_flows_matches_calculate_threat_score(logger):
+    detector = agent.ThreatDetector(logger, score_weights={"packet_burst": 7})
+    flows = []
+    for port in (443, 22, 4444, 3389, 53):
+        for sent, recv, packets, duration in ((10, 10, 2, 1.0), (2_000_000, 20_000_000, 500, 1.0),
+                                              (0, 0, 101, 4.9), (0, 0, 101, 5.0)):
+            flows.append(agent.Flow(CLIENT, SERVER, 40000, port, "tcp", sent, recv, packets, 0,
+                                    10.0, 10.0 + duration))
+    expected = [detector.calculate_threat_score(flow, CLIENT) for flow in flows]
+    detector.score_flows(flows)
+    assert [flow.threat_score for flow in flows] == expected
+    assert len(set(expected)) > 4
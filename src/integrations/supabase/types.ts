@@ -29,6 +29,8 @@ export type Database = {
           os: string | null
           packets_captured: number | null
           status: Database["public"]["Enums"]["agent_status"] | null
+          top_services: Json | null
+          top_talkers: Json | null
           updated_at: string | null
           version: string | null
         }
@@ -46,6 +48,8 @@ export type Database = {
           os?: string | null
           packets_captured?: number | null
           status?: Database["public"]["Enums"]["agent_status"] | null
+          top_services?: Json | null
+          top_talkers?: Json | null
           updated_at?: string | null
           version?: string | null
         }
@@ -63,6 +67,8 @@ export type Database = {
           os?: string | null
           packets_captured?: number | null
           status?: Database["public"]["Enums"]["agent_status"] | null
+          top_services?: Json | null
+          top_talkers?: Json | null
           updated_at?: string | null
           version?: string | null
         }
@@ -250,6 +256,7 @@ export type Database = {
           packets_recv: number | null
           packets_sent: number | null
           protocol: Database["public"]["Enums"]["protocol_type"] | null
+          sampling_rate: number
           service: string | null
           src_ip: string
           src_port: number | null
@@ -272,6 +279,7 @@ export type Database = {
           packets_recv?: number | null
           packets_sent?: number | null
           protocol?: Database["public"]["Enums"]["protocol_type"] | null
+          sampling_rate?: number
           service?: string | null
           src_ip: string
           src_port?: number | null
@@ -294,6 +302,7 @@ export type Database = {
           packets_recv?: number | null
           packets_sent?: number | null
           protocol?: Database["public"]["Enums"]["protocol_type"] | null
+          sampling_rate?: number
           service?: string | null
           src_ip?: string
           src_port?: number | null
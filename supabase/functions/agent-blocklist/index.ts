@@ -3,9 +3,17 @@ import { createClient } from "https://esm.sh/@supabase/supabase-js@2";
 
 const corsHeaders = {
   'Access-Control-Allow-Origin': '*',
-  'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type, x-agent-id',
+  'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type, x-agent-id, if-none-match',
+  'Access-Control-Expose-Headers': 'etag',
 };
 
+// Strong ETag over the entries, so agents can poll with If-None-Match
+async function entriesEtag(entries: unknown[]): Promise<string> {
+  const digest = await crypto.subtle.digest('SHA-256', new TextEncoder().encode(JSON.stringify(entries)));
+  const hex = Array.from(new Uint8Array(digest).slice(0, 16), (b) => b.toString(16).padStart(2, '0')).join('');
+  return `"${hex}"`;
+}
+
 serve(async (req) => {
   if (req.method === 'OPTIONS') {
     return new Response(null, { headers: corsHeaders });
@@ -26,7 +34,9 @@ serve(async (req) => {
     let query = supabase
       .from('blocklist')
       .select('ip_address, reason, threat_score, source, expires_at, created_at')
-      .eq('active', true);
+      .eq('active', true)
+      .order('ip_address')
+      .order('created_at');
 
     // Filter by agent or get global blocklist
     if (agentId) {
@@ -49,6 +59,11 @@ serve(async (req) => {
       return new Date(entry.expires_at) > new Date(now);
     });
 
+    const etag = await entriesEtag(activeEntries);
+    if (req.headers.get('if-none-match') === etag) {
+      return new Response(null, { status: 304, headers: { ...corsHeaders, ETag: etag } });
+    }
+
     // Generate nftables rules format
     const nftablesRules = activeEntries.map(entry => ({
       ip: entry.ip_address,
@@ -67,7 +82,7 @@ serve(async (req) => {
         nftables_rules: nftablesRules,
         generated_at: now,
       }),
-      { headers: { ...corsHeaders, 'Content-Type': 'application/json' } }
+      { headers: { ...corsHeaders, 'Content-Type': 'application/json', ETag: etag } }
     );
   } catch (error: unknown) {
     console.error('[SNSM] Blocklist exception:', error);
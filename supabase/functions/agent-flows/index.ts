@@ -3,9 +3,67 @@ import { createClient } from "https://esm.sh/@supabase/supabase-js@2";
 
 const corsHeaders = {
   'Access-Control-Allow-Origin': '*',
-  'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type, x-agent-id',
+  'Access-Control-Allow-Headers': 'authorization, x-client-info, apikey, content-type, content-encoding, x-agent-id',
 };
 
+// Request body, gunzipped when the agent compressed it
+async function readBody(req: Request): Promise<string> {
+  if (req.headers.get('content-encoding') === 'gzip' && req.body) {
+    return await new Response(req.body.pipeThrough(new DecompressionStream('gzip'))).text();
+  }
+  return await req.text();
+}
+
+function zipRow(columns: string[], values: unknown[]): Record<string, unknown> {
+  const row: Record<string, unknown> = {};
+  columns.forEach((name, i) => { row[name] = values[i]; });
+  return row;
+}
+
+// Accepts the original {agent_id, flows: [...]} body, the columnar form
+// {agent_id, timestamp, count, columns: {field: [values]}}, or NDJSON with a
+// {agent_id, timestamp, columns: [...]} header line and one value array per flow.
+// Rows carry their own sampling_rate (agent overload sampling); the batch-level
+// value, the highest in the batch, is only a fallback for rows without one.
+function parseFlows(text: string, contentType: string) {
+  if (contentType.includes('ndjson')) {
+    const lines = text.split('\n').filter((line) => line.trim());
+    const header = JSON.parse(lines[0] || '{}');
+    const columns: string[] = header.columns || [];
+    return {
+      agent_id: header.agent_id,
+      timestamp: header.timestamp,
+      sampling_rate: header.sampling_rate,
+      compact: true,
+      flows: lines.slice(1).map((line) => zipRow(columns, JSON.parse(line))),
+    };
+  }
+
+  const body = JSON.parse(text);
+  if (body.columns && !Array.isArray(body.flows)) {
+    const names = Object.keys(body.columns);
+    const count = body.count ?? (names.length ? body.columns[names[0]].length : 0);
+    const flows = [];
+    for (let i = 0; i < count; i++) {
+      flows.push(zipRow(names, names.map((name) => body.columns[name][i])));
+    }
+    return {
+      agent_id: body.agent_id,
+      timestamp: body.timestamp,
+      sampling_rate: body.sampling_rate,
+      compact: true,
+      flows,
+    };
+  }
+  return {
+    agent_id: body.agent_id,
+    timestamp: undefined,
+    sampling_rate: body.sampling_rate,
+    compact: false,
+    flows: body.flows,
+  };
+}
+
 serve(async (req) => {
   if (req.method === 'OPTIONS') {
     return new Response(null, { headers: corsHeaders });
@@ -16,7 +74,10 @@ serve(async (req) => {
     const supabaseKey = Deno.env.get('SUPABASE_SERVICE_ROLE_KEY')!;
     const supabase = createClient(supabaseUrl, supabaseKey);
 
-    const { agent_id, flows } = await req.json();
+    const { agent_id, timestamp, sampling_rate, compact, flows } = parseFlows(
+      await readBody(req),
+      req.headers.get('content-type') || '',
+    );
 
     if (!agent_id || !Array.isArray(flows)) {
       return new Response(
@@ -45,13 +106,16 @@ serve(async (req) => {
       anomaly_score: flow.anomaly_score || 0,
       ml_score: flow.ml_score || 0,
       flags: flow.flags || null,
-      timestamp: flow.timestamp || new Date().toISOString(),
+      // Counters of a flow kept 1 in N were scaled by N: estimates when > 1
+      sampling_rate: flow.sampling_rate || sampling_rate || 1,
+      timestamp: flow.timestamp || timestamp || new Date().toISOString(),
     }));
 
-    const { data, error } = await supabase
-      .from('flows')
-      .insert(processedFlows)
-      .select();
+    // Compact uploads get a compact reply: echoing the rows back would
+    // cost more than the upload itself
+    const { data, error } = compact
+      ? await supabase.from('flows').insert(processedFlows)
+      : await supabase.from('flows').insert(processedFlows).select();
 
     if (error) {
       console.error('[SNSM] Flow insert error:', error);
@@ -64,7 +128,9 @@ serve(async (req) => {
     console.log(`[SNSM] Inserted ${processedFlows.length} flows`);
 
     return new Response(
-      JSON.stringify({ success: true, processed: processedFlows.length, flows: data }),
+      JSON.stringify(compact
+        ? { success: true, processed: processedFlows.length }
+        : { success: true, processed: processedFlows.length, flows: data }),
       { headers: { ...corsHeaders, 'Content-Type': 'application/json' } }
     );
   } catch (error: unknown) {
@@ -16,7 +16,10 @@ serve(async (req) => {
     const supabaseKey = Deno.env.get('SUPABASE_SERVICE_ROLE_KEY')!;
     const supabase = createClient(supabaseUrl, supabaseKey);
 
-    const { agent_id, cpu, mem, traffic_bps, packets_captured, alerts_generated } = await req.json();
+    const {
+      agent_id, cpu, mem, traffic_bps, packets_captured, alerts_generated,
+      top_talkers, top_services,
+    } = await req.json();
 
     if (!agent_id) {
       return new Response(
@@ -38,6 +41,9 @@ serve(async (req) => {
         network_bps: traffic_bps || 0,
         packets_captured: packets_captured || 0,
         alerts_generated: alerts_generated || 0,
+        // Only agents running with --aggregate report top-K summaries
+        ...(Array.isArray(top_talkers) ? { top_talkers } : {}),
+        ...(Array.isArray(top_services) ? { top_services } : {}),
       })
       .eq('agent_id', agent_id);
 
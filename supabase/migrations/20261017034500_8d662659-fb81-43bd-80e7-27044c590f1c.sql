@@ -0,0 +1,3 @@
+-- Flows kept 1 in N by agent overload sampling have their counters scaled
+-- by N: counts are estimates whenever sampling_rate > 1
+ALTER TABLE public.flows ADD COLUMN sampling_rate INTEGER NOT NULL DEFAULT 1;
@@ -0,0 +1,5 @@
+-- Heaviest talkers and services of the agent's last aggregation interval
+-- (agent --aggregate), as reported in its heartbeat
+ALTER TABLE public.agents
+  ADD COLUMN top_talkers JSONB,
+  ADD COLUMN top_services JSONB;